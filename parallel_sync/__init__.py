@@ -3,7 +3,6 @@ This module is the core package module
 """
 import logging
 from dataclasses import dataclass
-logging.basicConfig(level='INFO')
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
 class IllegalArgumentError(ValueError):
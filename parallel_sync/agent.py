@@ -0,0 +1,346 @@
+"""
+This module is a small helper agent which is uploaded to the remote host
+once per session and serves bulk file operations over a single ssh channel,
+so that whole-tree operations cost one round trip instead of one
+command per path.
+
+The protocol is a sequence of frames. Each frame is a 4 byte big-endian
+length followed by a JSON document. A request is {"op": ..., "args": {...}}
+and a response is {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+An operation with a large result (walk) sends it in parts first,
+one {"ok": true, "part": ...} frame each, so that it is never held whole in memory.
+
+This file is shipped to the remote host and run there (see executor.remote_python)
+so it must only import the standard library at module level.
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import shutil
+import types
+import struct
+import fnmatch
+import hashlib
+import tarfile
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+_FRAME = struct.Struct('>I')
+CHUNK_SIZE = 1024 * 1024
+WALK_PART = 10000 # files per part of a walk
+
+
+class AgentError(Exception):
+    pass
+
+
+def write_frame(out, doc):
+    """
+    @out: binary file object
+    @doc: a JSON serializable object to send
+    """
+    data = json.dumps(doc, separators=(',', ':')).encode('utf-8')
+    out.write(_FRAME.pack(len(data)) + data)
+    out.flush()
+
+
+def read_frame(inp):
+    """
+    @inp: binary file object
+    returns the decoded JSON document or None at the end of the stream
+    """
+    header = __read_exact(inp, _FRAME.size)
+    if header is None:
+        return None
+    length, = _FRAME.unpack(header)
+    data = __read_exact(inp, length)
+    if data is None:
+        raise AgentError('Unexpected end of the agent stream')
+    return json.loads(data.decode('utf-8'))
+
+
+def __read_exact(inp, size: int) -> bytes:
+    """ returns exactly size bytes or None if the stream ended """
+    data = b''
+    while len(data) < size:
+        chunk = inp.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def walk(root: str, include: str='*', exclude: list=None):
+    """
+    @root: str, the folder to walk
+    @include: a wild card pattern matched against file names
+    @exclude: list of wild card patterns matched against full paths
+    yields dictionaries with the 'folders' list and the 'files' list
+        of [path, size, mtime], at most WALK_PART files at a time
+    """
+    exclude_pat = None
+    if exclude:
+        exclude_pat = re.compile('|'.join(exclude).replace('*', '.*'))
+
+    folders = []
+    files = []
+    if os.path.isfile(root):
+        st = os.stat(root)
+        yield {'folders': folders, 'files': [[root, st.st_size, st.st_mtime]]}
+        return
+
+    for dirpath, _, filenames in os.walk(root):
+        if exclude_pat is None or not exclude_pat.match(dirpath):
+            folders.append(dirpath)
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if not fnmatch.fnmatch(name, include):
+                continue
+            if exclude_pat is not None and exclude_pat.match(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue # the file was removed in the meantime
+            files.append([path, st.st_size, st.st_mtime])
+            if len(files) >= WALK_PART:
+                yield {'folders': folders, 'files': files}
+                folders, files = [], []
+    yield {'folders': folders, 'files': files}
+
+
+def stat(paths: list) -> list:
+    """
+    @paths: list of paths
+    returns a list of [size, mtime] or None for the paths which do not exist
+    """
+    result = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            result.append([st.st_size, st.st_mtime])
+        except OSError:
+            result.append(None)
+    return result
+
+
+def __md5(path: str) -> str:
+    md5 = hashlib.md5()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+    except OSError:
+        return None
+    return md5.hexdigest()
+
+
+def hash_files(paths: list, parallelism: int=4) -> dict:
+    """
+    @paths: list of file paths
+    @parallelism: int, how many files to hash at the same time
+    returns a dictionary of path to md5 hex digest (None if it cannot be read)
+    """
+    with ThreadPoolExecutor(max_workers=max(1, parallelism)) as pool:
+        return dict(zip(paths, pool.map(__md5, paths)))
+
+
+def mkdirs(paths: list) -> int:
+    """
+    @paths: list of folder paths to create with their parents
+    returns the number of folders
+    """
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+    return len(paths)
+
+
+def delete(paths: list) -> int:
+    """
+    @paths: list of files or folders to delete
+    returns the number of paths which were deleted
+    """
+    count = 0
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+        else:
+            continue
+        count += 1
+    return count
+
+
+def __check_members(archive: tarfile.TarFile, folder: str):
+    """ raises ValueError if a member would be written outside of the folder.
+    It is for the Pythons without extraction filters, which have filter='data' otherwise.
+    """
+    root = os.path.realpath(folder)
+    for member in archive.getmembers():
+        target = os.path.realpath(os.path.join(root, member.name))
+        if os.path.commonpath([root, target]) != root:
+            raise ValueError(f'Unsafe path in {archive.name}: {member.name}')
+        if member.issym() or member.islnk():
+            link = member.linkname if member.islnk() else os.path.join(os.path.dirname(member.name),
+                                                                        member.linkname)
+            target = os.path.realpath(os.path.join(root, link))
+            if os.path.isabs(member.linkname) or os.path.commonpath([root, target]) != root:
+                raise ValueError(f'Unsafe link in {archive.name}: {member.name}')
+        elif not (member.isfile() or member.isdir()):
+            raise ValueError(f'Unsupported member in {archive.name}: {member.name}')
+
+
+def __untar(path: str, folder: str):
+    """ the same as tar -zxf run in the folder, without writing outside of it """
+    with tarfile.open(path, 'r:gz') as archive:
+        if hasattr(tarfile, 'data_filter'):
+            archive.extractall(folder, filter='data')
+        else:
+            __check_members(archive, folder)
+            archive.extractall(folder)
+
+
+def __gunzip(path: str):
+    """ the same as gunzip: replaces the file with its content and keeps its mode and times """
+    with gzip.open(path, 'rb') as src, open(path[:-3], 'wb') as dst:
+        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+    shutil.copystat(path, path[:-3])
+    os.remove(path)
+
+
+def extract(paths: list, gunzip: bool=False) -> int:
+    """ extracts .tar.gz, .gz and .zip files next to where they are,
+    with the same layout as the commands of compression.get_unzip_cmd:
+    the .tar.gz and .zip archives are kept and the .gz files are replaced.
+    @paths: list of archive paths
+    @gunzip: bool, whether to only decompress the .gz files, .tar.gz included,
+        like the extraction of rsync.upload does
+    returns the number of extracted archives
+    """
+    count = 0
+    for path in paths:
+        folder = os.path.dirname(path)
+        if path.endswith('.tar.gz') and not gunzip:
+            __untar(path, folder)
+        elif path.endswith('.gz'):
+            __gunzip(path)
+        elif path.endswith('.zip') and not gunzip:
+            with zipfile.ZipFile(path) as archive: # it drops absolute paths and '..' like unzip
+                archive.extractall(folder)
+        else:
+            continue
+        count += 1
+    return count
+
+
+OPERATIONS = {'walk': walk, 'stat': stat, 'hash': hash_files,
+              'mkdirs': mkdirs, 'delete': delete, 'extract': extract}
+
+
+def serve(inp, out):
+    """ answers requests until the stream ends or a 'quit' request arrives
+    @inp: binary file object to read the requests from
+    @out: binary file object to write the responses to
+    """
+    while True:
+        request = read_frame(inp)
+        if request is None or request['op'] == 'quit':
+            return
+        try:
+            func = OPERATIONS[request['op']]
+            result = func(**request.get('args', {}))
+            if isinstance(result, types.GeneratorType):
+                for part in result:
+                    write_frame(out, {'ok': True, 'part': part})
+                result = None
+            write_frame(out, {'ok': True, 'result': result})
+        except Exception as e:
+            write_frame(out, {'ok': False, 'error': f'{type(e).__name__}: {e}'})
+
+
+class RemoteAgent:
+    """ the client side of the agent. It can be used as a context manager:
+    with RemoteAgent(creds) as agent:
+        agent.mkdirs(['/tmp/a', '/tmp/b'])
+    The requests are serialized, so one agent can be shared by threads.
+    """
+    def __init__(self, creds):
+        """
+        @creds: ssh credentials
+        """
+        from . import executor
+        with open(os.path.abspath(__file__), 'rb') as f:
+            source = f.read()
+        self.__lock = threading.Lock()
+        self.__client = executor.connect(creds)
+        self.__stdin, self.__stdout, self.__stderr = executor.remote_python(
+            self.__client, source, ['serve'])
+
+    def call(self, op: str, on_part=None, **args):
+        """
+        @op: str, the name of the operation
+        @on_part: function which takes every part of the result of an operation sent in parts
+        @args: the arguments of the operation
+        returns the result of the operation or raises an AgentError
+        """
+        with self.__lock:
+            write_frame(self.__stdin, {'op': op, 'args': args})
+            response = read_frame(self.__stdout)
+            while response is not None and 'part' in response:
+                on_part(response['part'])
+                response = read_frame(self.__stdout)
+        if response is None:
+            raise AgentError('The remote agent exited:\n%s'
+                % self.__stderr.read().decode('utf-8', 'replace'))
+        if not response['ok']:
+            raise AgentError(response['error'])
+        return response['result']
+
+    def walk(self, root: str, include: str='*', exclude: list=None) -> tuple:
+        """ returns a list of folder paths and a FileList of the file paths """
+        from .filelist import FileList
+        folders = []
+        files = FileList()
+        def add(part):
+            folders.extend(part['folders'])
+            for path, size, mtime in part['files']:
+                files.append(path, size, mtime)
+        self.call('walk', on_part=add, root=root, include=include, exclude=exclude)
+        return folders, files
+
+    def stat(self, paths: list) -> list:
+        return self.call('stat', paths=list(paths))
+
+    def hash(self, paths: list, parallelism: int=4) -> dict:
+        return self.call('hash', paths=list(paths), parallelism=parallelism)
+
+    def mkdirs(self, paths) -> int:
+        return self.call('mkdirs', paths=list(paths))
+
+    def delete(self, paths) -> int:
+        return self.call('delete', paths=list(paths))
+
+    def extract(self, paths, gunzip: bool=False) -> int:
+        return self.call('extract', paths=list(paths), gunzip=gunzip)
+
+    def close(self):
+        try:
+            with self.__lock:
+                write_frame(self.__stdin, {'op': 'quit'})
+        except Exception:
+            pass # the channel is already closed
+        self.__client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin.buffer, sys.stdout.buffer)
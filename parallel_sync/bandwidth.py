@@ -0,0 +1,279 @@
+"""
+This module shapes the bandwidth used by the transfers.
+There are three kinds of limits, all in bytes per second:
+- the limit of the process, shared by all the jobs (set_limit)
+- the limit of a host, shared by all the jobs which use it (set_host_limit)
+- the limit of a job, the bwlimit parameter of rsync.upload, download, transfer and watch
+A transfer is bound by all the limits which apply to it.
+The transfers done by the library itself (relay, delta, multistream) take their
+bytes from token buckets. An rsync or scp command cannot be throttled once it runs,
+so it is given an even share of every limit when it starts: the rate divided by the
+number of commands which can run at the same time against that limit, i.e. the total
+parallelism of the jobs which run in the process or against the host, bound by the
+tasks the scheduler allows. The share is reserved in the same buckets while the command
+runs, so the in-process transfers of the job only get what the commands leave.
+The limits can be changed at any time, the rsync commands which start
+afterwards and the in-process transfers follow the new rate.
+Example:
+    from parallel_sync import bandwidth, rsync
+    bandwidth.set_limit(100 * 1024 * 1024)
+    bandwidth.set_host_limit('192.168.168.9', 20 * 1024 * 1024)
+    limit = bandwidth.TokenBucket(10 * 1024 * 1024)
+    rsync.upload('/tmp/x', '/tmp/y', creds=creds, bwlimit=limit) # limit.set_rate() adjusts it
+"""
+import time
+import threading
+from contextlib import contextmanager
+from . import scheduler
+
+MIN_BURST = 64 * 1024 # bytes
+MIN_RATE = 1024 # bytes per second left to the in-process transfers when the commands reserved a limit
+
+
+class TokenBucket:
+    def __init__(self, rate: float=None, burst: float=None):
+        """
+        @rate: float, bytes per second. None means unlimited
+        @burst: float, how many bytes can be sent at once after an idle period.
+            The default is a second worth of the rate.
+        """
+        self.__lock = threading.Lock()
+        self.__burst = burst
+        self.__rate = None
+        self.__reserved = 0.0 # bytes per second taken by the running rsync or scp commands
+        self.__tokens = 0.0
+        self.__updated = time.monotonic()
+        self.set_rate(rate)
+
+    @property
+    def rate(self) -> float:
+        return self.__rate
+
+    def set_rate(self, rate: float):
+        """ changes the rate, the waiting transfers follow it from their next chunk
+        @rate: float, bytes per second. None means unlimited
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError(f'Invalid rate: {rate}. It must be positive or None')
+        with self.__lock:
+            self.__refill()
+            self.__rate = rate
+            if rate is not None:
+                self.__tokens = min(self.__tokens, self.__get_burst())
+
+    def reserve(self, rate: float):
+        """ takes a part of the rate for a command which throttles itself, e.g. rsync --bwlimit
+        @rate: float, bytes per second. A negative rate gives it back.
+        """
+        with self.__lock:
+            self.__refill()
+            self.__reserved = max(0.0, self.__reserved + rate)
+
+    def __get_burst(self) -> float:
+        return self.__burst or max(self.__rate, MIN_BURST)
+
+    def __get_free_rate(self) -> float:
+        """ returns the rate which is left to the callers of consume """
+        return max(self.__rate - self.__reserved, min(self.__rate, MIN_RATE))
+
+    def __refill(self):
+        now = time.monotonic()
+        if self.__rate is not None:
+            self.__tokens = min(self.__get_burst(),
+                                self.__tokens + (now - self.__updated) * self.__get_free_rate())
+        self.__updated = now
+
+    def consume(self, size: int):
+        """ waits until size bytes can be sent
+        The bucket can go into debt so that a chunk larger than the burst is allowed,
+        the next callers wait until the debt is paid.
+        """
+        with self.__lock:
+            if self.__rate is None:
+                return
+            self.__refill()
+            self.__tokens -= size
+            wait = -self.__tokens / self.__get_free_rate() if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+__limit = TokenBucket()
+__host_limits = {}
+__active = {} # None for the process or a host name -> the total parallelism of the running jobs
+__lock = threading.Lock()
+
+
+def set_limit(rate: float):
+    """ limits the bandwidth of all the transfers of the process
+    @rate: float, bytes per second. None removes the limit
+    """
+    __limit.set_rate(rate)
+
+
+def set_host_limit(host: str, rate: float):
+    """ limits the bandwidth of all the transfers to or from a host
+    @host: str, the host name
+    @rate: float, bytes per second. None removes the limit
+    """
+    with __lock:
+        bucket = __host_limits.get(host)
+        if bucket is None:
+            if rate is None:
+                return
+            bucket = __host_limits[host] = TokenBucket()
+    bucket.set_rate(rate)
+
+
+def get_bucket(bwlimit) -> TokenBucket:
+    """
+    @bwlimit: the bwlimit parameter of a job, bytes per second, a TokenBucket or None
+    returns a TokenBucket or None
+    """
+    if bwlimit is None or isinstance(bwlimit, TokenBucket):
+        return bwlimit
+    return TokenBucket(bwlimit)
+
+
+def __get_hosts(host) -> tuple:
+    return (host,) if isinstance(host, str) else tuple(host or ())
+
+
+@contextmanager
+def register_job(host=None, parallelism: int=1):
+    """ counts the commands of a job while it runs, so that the limits are split
+    between the commands which can actually run instead of every task of the scheduler
+    @host: str, a tuple of hosts or None
+    @parallelism: int, how many commands of the job run at the same time
+    """
+    keys = (None,) + __get_hosts(host)
+    with __lock:
+        for key in keys:
+            __active[key] = __active.get(key, 0) + parallelism
+    try:
+        yield
+    finally:
+        with __lock:
+            for key in keys:
+                __active[key] -= parallelism
+                if __active[key] <= 0:
+                    del __active[key]
+
+
+def __get_concurrency(key, slots: int, parallelism: int) -> int:
+    """ returns how many commands can run at the same time against a limit
+    @key: None for the limit of the process or a host name
+    @slots: int, how many tasks the scheduler allows against the limit
+    @parallelism: int, the parallelism of the job, which counts even if it is not registered
+    """
+    with __lock:
+        active = __active.get(key, 0)
+    return max(1, min(slots, max(active, parallelism)))
+
+
+def __get_buckets(host, job: TokenBucket) -> list:
+    """ returns the buckets which apply to a transfer
+    @host: str, a tuple of hosts or None
+    @job: the TokenBucket of the job or None
+    """
+    with __lock:
+        buckets = [__host_limits[name] for name in __get_hosts(host) if name in __host_limits]
+    buckets.append(__limit)
+    if job is not None:
+        buckets.append(job)
+    return buckets
+
+
+def throttle(size: int, host=None, job: TokenBucket=None):
+    """ waits until size bytes can be sent to or from host
+    @size: int, bytes
+    @host: str, a tuple of hosts or None
+    @job: the TokenBucket of the job or None
+    """
+    for bucket in __get_buckets(host, job):
+        bucket.consume(size)
+
+
+def get_throttle(host=None, job: TokenBucket=None):
+    """ returns a function which takes a number of bytes and waits until they can be sent,
+    or None if there is no limit to apply
+    """
+    if __limit.rate is None and job is None and not __host_limits:
+        return None
+    return lambda size: throttle(size, host, job)
+
+
+def get_command_rate(host=None, job: TokenBucket=None, parallelism: int=1) -> float:
+    """ returns the rate of one rsync or scp command in bytes per second, None if it is unlimited
+    @host: str, a tuple of hosts or None
+    @job: the TokenBucket of the job or None
+    @parallelism: int, how many commands of the job run at the same time
+    """
+    sched = scheduler.get_scheduler()
+    rates = []
+    if __limit.rate is not None:
+        rates.append(__limit.rate / __get_concurrency(None, sched.max_workers, parallelism))
+    with __lock:
+        buckets = [(name, __host_limits[name]) for name in __get_hosts(host) if name in __host_limits]
+    for name, bucket in buckets:
+        if bucket.rate is not None:
+            rates.append(bucket.rate / __get_concurrency(name, sched.get_host_slots(name), parallelism))
+    if job is not None and job.rate is not None:
+        rates.append(job.rate / max(1, parallelism))
+    return min(rates) if rates else None
+
+
+@contextmanager
+def command_rate(host=None, job: TokenBucket=None, parallelism: int=1, count: int=1):
+    """ yields the rate of one rsync or scp command (see get_command_rate)
+    and reserves it in the buckets while the commands run
+    @count: int, how many commands run with that rate
+    """
+    rate = get_command_rate(host, job, parallelism=parallelism)
+    buckets = [] if rate is None else __get_buckets(host, job)
+    for bucket in buckets:
+        bucket.reserve(rate * count)
+    try:
+        yield rate
+    finally:
+        for bucket in buckets:
+            bucket.reserve(-rate * count)
+
+
+def get_command_args(args: list, rate: float) -> list:
+    """ adds the bandwidth limit to an rsync or scp command
+    @args: list of the arguments of the command
+    @rate: float, bytes per second or None
+    returns the new list of arguments
+    """
+    if rate is None or not args:
+        return args
+    program = args[0].rsplit('/', 1)[-1]
+    if program == 'rsync':
+        return args[:1] + [f'--bwlimit={max(1, int(rate / 1024))}'] + args[1:] # KiB/s
+    if program == 'scp':
+        return args[:1] + ['-l', str(max(1, int(rate * 8 / 1000)))] + args[1:] # Kbit/s
+    return args
+
+
+class Throttled:
+    """ wraps a binary file object so that its reads and writes are throttled """
+    def __init__(self, fileobj, throttle):
+        """
+        @fileobj: binary file object
+        @throttle: function which takes a number of bytes and waits until they can be sent
+        """
+        self.__file = fileobj
+        self.__throttle = throttle
+
+    def read(self, size: int=-1) -> bytes:
+        data = self.__file.read(size)
+        self.__throttle(len(data))
+        return data
+
+    def write(self, data: bytes):
+        self.__throttle(len(data))
+        return self.__file.write(data)
+
+    def flush(self):
+        self.__file.flush()
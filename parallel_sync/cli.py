@@ -0,0 +1,175 @@
+"""
+This module is the parallel-sync command line entry point.
+Every command prints one JSON document on stdout, logs go to stderr.
+Examples:
+    parallel-sync upload /tmp/x /tmp/y --host 192.168.168.9 --user user --key ~/.ssh/id_rsa
+    parallel-sync download /tmp/y /tmp/z --host 192.168.168.9 --user user --validate
+    parallel-sync wget /tmp/images http://something.png --host 192.168.168.9 --user user
+    parallel-sync fetch /tmp/images http://something.png --parallelism 4
+    parallel-sync validate /tmp/x /tmp/y --host 192.168.168.9 --user user
+The heavy modules are only imported by the command that needs them.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+
+def __add_creds_args(parser):
+    parser.add_argument('--host', required=True, help='the remote host name')
+    parser.add_argument('--user', default=os.environ.get('USER'), help='the ssh user name')
+    parser.add_argument('--key', default='~/.ssh/id_rsa', help='the ssh private key file')
+    parser.add_argument('--port', type=int, default=22)
+    parser.add_argument('--timeout', type=int, default=10, help='ssh connection timeout in seconds')
+
+
+def __add_transfer_args(parser):
+    parser.add_argument('src')
+    parser.add_argument('dst')
+    __add_creds_args(parser)
+    parser.add_argument('--include', default='*', help='wild card pattern of files to include')
+    parser.add_argument('--exclude', action='append', help='wild card pattern to exclude, can be repeated')
+    parser.add_argument('--parallelism', type=int, default=10)
+    parser.add_argument('--tries', type=int, default=1)
+    parser.add_argument('--extract', action='store_true')
+    parser.add_argument('--validate', action='store_true')
+    parser.add_argument('--rsync-params', default='-c', help='additional parameters to pass on to rsync')
+    parser.add_argument('--dedup', choices=['link', 'copy'])
+    parser.add_argument('--agent', action='store_true', help='use the remote helper agent')
+    parser.add_argument('--job-id', help='journal the job so that running it again resumes it')
+    parser.add_argument('--journal-dir', help='where the journals are kept')
+    parser.add_argument('--bwlimit', type=int, metavar='KBPS',
+                        help='the bandwidth limit of the job in KiB per second')
+    parser.add_argument('--compare', choices=['stat', 'checksum'],
+                        help='skip the files which have the same size and time (or md5) on the destination')
+
+
+def __get_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-v', '--verbose', action='store_true', help='log debug messages')
+    common.add_argument('-q', '--quiet', action='store_true', help='only log errors')
+    common.add_argument('--trace', action='store_true', help='add the time spent per phase to the output')
+
+    parser = argparse.ArgumentParser(prog='parallel-sync',
+        description='Parallel file transfers over ssh and url downloads')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    upload = commands.add_parser('upload', parents=[common], help='upload a local file or folder')
+    __add_transfer_args(upload)
+    download = commands.add_parser('download', parents=[common], help='download a remote file or folder')
+    __add_transfer_args(download)
+
+    wget = commands.add_parser('wget', parents=[common], help='download urls on the remote host')
+    wget.add_argument('target_dir')
+    wget.add_argument('urls', nargs='+')
+    __add_creds_args(wget)
+    wget.add_argument('--parallelism', type=int, default=10)
+    wget.add_argument('--tries', type=int, default=3)
+    wget.add_argument('--extract', action='store_true')
+    wget.add_argument('--wget-timeout', type=int, default=40)
+
+    fetch = commands.add_parser('fetch', parents=[common], help='download urls on the local machine')
+    fetch.add_argument('target_dir')
+    fetch.add_argument('urls', nargs='+')
+    fetch.add_argument('--extension')
+    fetch.add_argument('--parallelism', type=int, default=10)
+
+    validate = commands.add_parser('validate', parents=[common], help='compare the checksums of local and remote files')
+    validate.add_argument('local')
+    validate.add_argument('remote')
+    __add_creds_args(validate)
+    validate.add_argument('--parallelism', type=int, default=10)
+    return parser
+
+
+def __get_creds(args):
+    from . import Credential
+    return Credential(key_filename=os.path.expanduser(args.key), username=args.user,
+                      hostname=args.host, port=args.port, timeout=args.timeout)
+
+
+def __transfer(args) -> dict:
+    from . import rsync
+    func = rsync.upload if args.command == 'upload' else rsync.download
+    func(args.src, args.dst, __get_creds(args), tries=args.tries,
+         include=args.include, exclude=args.exclude, parallelism=args.parallelism,
+         extract=args.extract, validate=args.validate,
+         additional_params=args.rsync_params, dedup=args.dedup, agent=args.agent,
+         job_id=args.job_id, journal_dir=args.journal_dir,
+         bwlimit=args.bwlimit * 1024 if args.bwlimit else None, compare=args.compare)
+    return {'src': args.src, 'dst': args.dst}
+
+
+def __wget(args) -> dict:
+    from . import wget
+    wget.download(__get_creds(args), args.target_dir, args.urls,
+                  parallelism=args.parallelism, tries=args.tries,
+                  extract=args.extract, timeout=args.wget_timeout)
+    return {'target_dir': args.target_dir, 'urls': len(args.urls)}
+
+
+def __fetch(args) -> dict:
+    from . import downloader
+    os.makedirs(args.target_dir, exist_ok=True)
+    downloader.download(args.target_dir, args.urls, extension=args.extension,
+                        parallelism=args.parallelism)
+    return {'target_dir': args.target_dir, 'urls': len(args.urls)}
+
+
+def __validate(args) -> dict:
+    from . import rsync, executor
+    local = args.local.rstrip('/') or '/'
+    if os.path.isdir(local):
+        _, files = executor.find_local(local)
+        paths = [(path, rsync.__get_dst_path(local, path, args.remote)) for path in files]
+    else:
+        paths = [(local, args.remote)]
+    rsync.validate_checksums(__get_creds(args), True, args.parallelism, paths)
+    return {'files': len(paths)}
+
+
+COMMANDS = {'upload': __transfer, 'download': __transfer, 'wget': __wget,
+            'fetch': __fetch, 'validate': __validate}
+
+
+def main(argv: list=None) -> int:
+    """
+    @argv: list of command line arguments, defaults to sys.argv[1:]
+    returns the exit code: 0 on success and 1 on failure
+    """
+    args = __get_parser().parse_args(argv)
+    level = 'DEBUG' if args.verbose else 'ERROR' if args.quiet else 'INFO'
+    logging.basicConfig(level=level, stream=sys.stderr)
+
+    collector = None
+    if args.trace:
+        from . import tracing
+        collector = tracing.MemoryExporter()
+        tracing.add_exporter(collector)
+
+    start = time.time()
+    output = {'command': args.command}
+    try:
+        output.update(COMMANDS[args.command](args))
+        output['ok'] = True
+    except Exception as e:
+        logging.debug('The command failed', exc_info=True)
+        output['ok'] = False
+        output['error'] = f'{type(e).__name__}: {e}'
+    output['elapsed'] = round(time.time() - start, 3)
+
+    if collector is not None:
+        tracing.remove_exporter(collector)
+        phases = {}
+        for span in collector.spans:
+            phases[span.name] = round(phases.get(span.name, 0.0) + span.duration, 3)
+        output['phases'] = phases
+
+    print(json.dumps(output))
+    return 0 if output['ok'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+This module compares the source files with the destination before a transfer
+so that the unchanged files are skipped without running a command per file.
+The sizes and modification times of the destination files are read in bulk:
+with one find command on the remote host (or one agent request) or with os.stat locally.
+There are two modes:
+- 'stat' skips the files whose size and modification time are the same, like the
+  quick check of rsync. The times must be kept by the transfer, e.g. rsync -t or -a.
+- 'checksum' skips the files whose size and md5 are the same. Only the files
+  which have the same size on both sides are hashed.
+"""
+import os
+import shlex
+import posixpath
+from array import array
+from . import Credential, executor, delta, localcopy, dedup
+from .filelist import FileList
+
+MODES = ['stat', 'checksum']
+AGENT_BATCH = 10000 # paths stated by one agent request
+
+
+def __stat(path: str) -> tuple:
+    """ returns a tuple of (size, mtime) of a local file or (-1, 0) if it does not exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return -1, 0.0
+    return st.st_size, st.st_mtime
+
+
+def stat_remote(root: str, creds: Credential):
+    """ lists the files under a remote folder with one command
+    @root: str, the remote folder or file
+    @creds: ssh credentials
+    yields tuples of (normalised path, size, mtime) as they are listed.
+        There are none if root does not exist.
+    """
+    cmd = f'find {shlex.quote(root)} -type f -printf "%s %T@ %p\\n" 2>/dev/null || true'
+    for line in executor.stream_remote(cmd, creds):
+        size, mtime, path = line.split(' ', 2)
+        yield posixpath.normpath(path), int(size), float(mtime)
+
+
+def __hash_local(paths: list, parallelism: int=10) -> dict:
+    """ returns a dictionary of path to md5 hex digest of local files """
+    checksums = {}
+    def add(path):
+        checksums[path] = delta.file_md5(path).hex()
+    executor.run_parallel(add, paths, parallelism=parallelism)
+    return checksums
+
+
+def __hash(paths: list, creds: Credential, remote: bool, parallelism: int=10, agent=None) -> dict:
+    """ returns a dictionary of path to md5 hex digest of local or remote files """
+    if len(paths) < 1:
+        return {}
+    if not remote:
+        return __hash_local(paths, parallelism=parallelism)
+    if agent is not None:
+        return agent.hash(paths, parallelism=parallelism)
+    return dedup.hash_remote(paths, creds)
+
+
+def __stat_destinations(srcs, get_dst, creds: Credential, remote_dst: bool, root: str, agent=None) -> tuple:
+    """ returns a tuple of (sizes, mtimes) arrays of the destination files, in the order of srcs.
+    The size of a missing file is -1. The remote listing is streamed into the arrays,
+    it is not kept as a dictionary of the whole destination tree.
+    """
+    count = len(srcs)
+    sizes = array('q', [-1]) * count
+    mtimes = array('d', [0.0]) * count
+    if remote_dst and agent is not None:
+        for start in range(0, count, AGENT_BATCH):
+            paths = [get_dst(srcs[ind]) for ind in range(start, min(start + AGENT_BATCH, count))]
+            for ind, st in enumerate(agent.stat(paths), start):
+                if st is not None:
+                    sizes[ind], mtimes[ind] = st
+    elif remote_dst:
+        # hash of the normalised destination path -> source index, or a list of them for a collision:
+        index = {}
+        for ind, path in enumerate(srcs):
+            key = hash(posixpath.normpath(get_dst(path)))
+            found = index.get(key)
+            index[key] = ind if found is None else (found if isinstance(found, list) else [found]) + [ind]
+        for path, size, mtime in stat_remote(root, creds):
+            found = index.get(hash(path))
+            for ind in ([found] if isinstance(found, int) else found or ()):
+                if posixpath.normpath(get_dst(srcs[ind])) == path:
+                    sizes[ind], mtimes[ind] = size, mtime
+    else:
+        for ind, path in enumerate(srcs):
+            sizes[ind], mtimes[ind] = __stat(get_dst(path))
+    return sizes, mtimes
+
+
+def find_changed(srcs, get_dst, creds: Credential, upstream: bool, root: str, mode: str='stat',
+                 parallelism: int=10, agent=None) -> tuple:
+    """
+    @srcs: sequence of the source file paths. If it is a FileList, its sizes and times are used.
+    @get_dst: a function which takes a source path and returns its destination path
+    @creds: ssh credentials
+    @upstream: bool, whether the sources are local (upload) or remote (download)
+    @root: str, the destination folder of the job
+    @mode: 'stat' or 'checksum'
+    @parallelism: int, how many files to hash at the same time
+    @agent: optional agent.RemoteAgent to stat and hash the remote files
+    returns a tuple of (changed, unchanged) where changed is a FileList of
+        the source files to transfer and unchanged is a FileList of the source files to skip
+    """
+    if mode not in MODES:
+        raise ValueError(f'Invalid compare mode: {mode}. It must be one of {MODES}')
+    remote_dst = upstream and not localcopy.is_local(creds)
+
+    if isinstance(srcs, FileList):
+        entries = srcs.entries()
+    else: # the sizes are only unknown for local sources
+        entries = ((path, *__stat(path)) for path in srcs)
+    dst_sizes, dst_mtimes = __stat_destinations(srcs, get_dst, creds, remote_dst, root, agent=agent)
+
+    changed = FileList()
+    unchanged = FileList()
+    candidates = FileList() # the files of the same size to hash
+    for ind, (path, size, mtime) in enumerate(entries):
+        if size < 0 or size != dst_sizes[ind]:
+            changed.append(path, size, mtime)
+        elif mode == 'checksum':
+            candidates.append(path, size, mtime)
+        elif int(mtime) == int(dst_mtimes[ind]): # whole seconds like rsync
+            unchanged.append(path, size, mtime)
+        else:
+            changed.append(path, size, mtime)
+
+    if len(candidates) > 0:
+        paths = list(candidates)
+        dsts = [get_dst(path) for path in paths]
+        src_checksums = __hash(paths, creds, not upstream, parallelism=parallelism, agent=agent)
+        dst_checksums = __hash(dsts, creds, remote_dst, parallelism=parallelism, agent=agent)
+        for (path, size, mtime), dst in zip(candidates.entries(), dsts):
+            checksum = src_checksums.get(path)
+            if checksum is not None and checksum == dst_checksums.get(dst):
+                unchanged.append(path, size, mtime)
+            else:
+                changed.append(path, size, mtime)
+    return changed, unchanged
@@ -0,0 +1,189 @@
+"""
+This module finds byte-identical files within one transfer
+so that each unique content is only sent once and the duplicates
+are materialised on the destination with hard links or local copies
+"""
+import os
+import shlex
+import shutil
+import hashlib
+import logging
+from . import Credential, executor
+from .filelist import FileList, PathPairs
+
+MODES = ['link', 'copy']
+REMOTE_BATCH = 200 # number of files hashed by one remote command
+CHUNK_SIZE = 1024 * 1024
+
+
+def __md5(path: str) -> str:
+    """ returns the md5 hex digest of a local file """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_candidates(entries) -> list:
+    """
+    @entries: iterable of tuples of (path, size). A negative size means it is unknown.
+    returns the list of paths which can have a duplicate: the files sharing their size
+        with another file and the files whose size is unknown
+    """
+    by_size = {}
+    candidates = []
+    for path, size in entries:
+        if size < 0:
+            candidates.append(path)
+        else:
+            by_size.setdefault(size, []).append(path)
+    candidates.extend(path for group in by_size.values() if len(group) > 1 for path in group)
+    return candidates
+
+
+def __get_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return -1
+
+
+def hash_local(paths: list, parallelism: int=10) -> dict:
+    """
+    @paths: list of local file paths
+    @parallelism: int, how many files to hash at the same time
+    returns a dictionary of path to md5 hex digest
+        Only files sharing their size with another file are hashed
+        since a file with a unique size cannot have a duplicate.
+        The files which cannot be read are left out, they are unique.
+    """
+    candidates = get_candidates((path, __get_size(path)) for path in paths)
+    if len(candidates) < 1:
+        return {}
+
+    checksums = {}
+    def add(path):
+        try:
+            checksums[path] = __md5(path)
+        except OSError as e:
+            logging.warning('Deduplication: cannot read %s: %s', path, e)
+    executor.run_parallel(add, candidates, parallelism=parallelism)
+    return checksums
+
+
+def hash_remote(paths: list, creds: Credential) -> dict:
+    """
+    @paths: list of remote file paths
+    @creds: ssh credentials
+    returns a dictionary of path to md5 hex digest.
+        The files which cannot be read are left out.
+    """
+    checksums = {}
+    for ind in range(0, len(paths), REMOTE_BATCH):
+        batch = paths[ind:ind + REMOTE_BATCH]
+        # md5sum fails if one file cannot be read but it still prints the others:
+        cmd = 'md5sum ' + ' '.join(shlex.quote(path) for path in batch) + ' 2>/dev/null || true'
+        for line in executor.stream_remote(cmd, creds):
+            checksum, _, path = line.partition('  ')
+            if path:
+                checksums[path] = checksum
+    return checksums
+
+
+def split_duplicates(paths: list, checksums: dict) -> tuple:
+    """
+    @paths: PathPairs or list of tuples of (source_path, dest_path)
+    @checksums: dictionary of source path to checksum
+    returns a tuple of (unique paths, duplicates)
+        where unique paths are the (source_path, dest_path) to transfer, PathPairs
+        if paths are PathPairs so that they stay compact, and duplicates is a list of
+        (source_path, dest_path, canonical_dest_path) whose content is the same as
+        the file transferred to canonical_dest_path
+    """
+    keep = bytearray(len(paths))
+    duplicates = []
+    canonical = {}
+    for ind, (src, dst) in enumerate(paths):
+        checksum = checksums.get(src)
+        if checksum is not None and checksum in canonical:
+            duplicates.append((src, dst, canonical[checksum]))
+            continue
+        if checksum is not None:
+            canonical[checksum] = dst
+        keep[ind] = 1
+    if isinstance(paths, PathPairs):
+        return paths.select(keep), duplicates
+    return [pair for pair, flag in zip(paths, keep) if flag], duplicates
+
+
+def find_duplicates(paths: list, creds: Credential, upstream: bool,
+                    parallelism: int=10, agent=None) -> tuple:
+    """
+    @paths: PathPairs or list of tuples of (source_path, dest_path)
+    @creds: ssh credentials
+    @upstream: bool, whether the sources are local (upload) or remote (download)
+    @parallelism: int, how many files to hash at the same time
+    @agent: optional agent.RemoteAgent to hash the remote files in one request
+    returns the same tuple as split_duplicates
+    """
+    srcs = paths.srcs if isinstance(paths, PathPairs) else [src for src, _ in paths]
+    if upstream:
+        checksums = hash_local(srcs, parallelism=parallelism)
+        return split_duplicates(paths, checksums)
+
+    # the remote files are listed with their sizes, only those sharing a size are hashed:
+    if isinstance(srcs, FileList):
+        candidates = get_candidates(zip(srcs, srcs.sizes))
+    else:
+        candidates = srcs
+    if len(candidates) < 1:
+        checksums = {}
+    elif agent is not None:
+        checksums = agent.hash(candidates, parallelism=parallelism)
+    else:
+        checksums = hash_remote(candidates, creds)
+    return split_duplicates(paths, checksums)
+
+
+def materialise(duplicates: list, creds: Credential, upstream: bool,
+                mode: str='link', parallelism: int=10) -> int:
+    """ creates the duplicate files on the destination from their transferred copy
+    @duplicates: list of (source_path, dest_path, canonical_dest_path)
+    @creds: ssh credentials
+    @upstream: bool, whether the destination is remote (upload) or local (download)
+    @mode: 'link' to create hard links (falls back to copying) or 'copy'
+    @parallelism: int, how many remote commands to run at the same time
+    returns the number of bytes that did not need to be transferred
+    """
+    if mode not in MODES:
+        raise ValueError(f'Invalid dedup mode: {mode}. It must be one of {MODES}')
+    if len(duplicates) < 1:
+        return 0
+
+    saved = 0
+    if upstream:
+        cmds = []
+        for src, dst, canonical in duplicates:
+            saved += os.path.getsize(src)
+            copy = f'cp -f {shlex.quote(canonical)} {shlex.quote(dst)}'
+            if mode == 'link':
+                cmds.append(f'ln -f {shlex.quote(canonical)} {shlex.quote(dst)} 2>/dev/null || {copy}')
+            else:
+                cmds.append(copy)
+        executor.run_remote_batch(cmds, creds, parallelism=parallelism)
+    else:
+        for _, dst, canonical in duplicates:
+            saved += os.path.getsize(canonical)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if mode == 'link':
+                try:
+                    os.link(canonical, dst)
+                    continue
+                except OSError:
+                    pass
+            shutil.copy2(canonical, dst)
+
+    logging.info('Deduplication: %s duplicate files, saved %s bytes', len(duplicates), saved)
+    return saved
@@ -0,0 +1,410 @@
+"""
+This module transfers only the changed parts of large files.
+It is used when rsync is not installed on the local machine,
+instead of re-sending whole files with scp.
+
+The block signatures of the old file are computed where that file lives,
+the new file is matched against them block by block and only
+literal data plus copy instructions are sent over the wire.
+Where a block changed, the next blocks of the old file are found again with anchors:
+every block of the old file is known by the bytes at the first occurrence of a marker
+byte in it. Only the occurrences of that byte in the changed region of the new file
+are looked up (mmap.find runs in C), so that data inserted or removed anywhere
+in the file does not turn the rest of it into literal data.
+
+This file is also shipped to the remote host and run there as a helper
+(see executor.remote_python) so it must only import the standard library
+at module level.
+"""
+import os
+import sys
+import mmap
+import zlib
+import struct
+import hashlib
+from dataclasses import dataclass, field
+
+BLOCK_SIZE = 64 * 1024 # bytes
+MIN_SIZE = 16 * 1024 * 1024 # files smaller than this are simply copied
+MAX_LITERAL = 1024 * 1024 # largest literal chunk sent in one instruction
+ANCHOR_SIZE = 32 # bytes from the marker which identify a block after a change
+MARKER_SAMPLES = 256 # how many parts of the old file are sampled to choose the marker byte
+MARKER_SAMPLE_SIZE = 4096 # bytes
+MARKER_MIN_COUNT = 8 # how many times the marker is expected in a block at least
+
+_SIG_HEADER = struct.Struct('>IQQIB') # block_size, file size, block count, anchor size, marker
+_SIG_ENTRY = struct.Struct('>I16s') # weak checksum, md5 digest
+_ANCHOR_OFFSET = struct.Struct('>i') # where the anchor starts in the block, -1 if there is none
+_COPY = b'C'
+_COPY_ARGS = struct.Struct('>QI') # first block index, block count
+_DATA = b'D'
+_DATA_ARGS = struct.Struct('>I') # literal length
+_END = b'E' # followed by the md5 digest of the whole new file
+
+
+class DeltaError(Exception):
+    pass
+
+
+@dataclass
+class Signature:
+    block_size: int
+    size: int # the size of the old file in bytes
+    blocks: list # tuples of (weak checksum, md5 digest), one per block
+    anchors: list = field(default_factory=list) # tuples of (offset, anchor) or None, one per block
+    marker: int = 0 # the byte value where the anchors start
+
+    @property
+    def tail(self) -> int:
+        """ returns the length of the last block """
+        return self.size - (len(self.blocks) - 1) * self.block_size
+
+
+def get_signature(path: str, block_size: int=BLOCK_SIZE) -> Signature:
+    """
+    @path: str, the file to compute the signature of
+    @block_size: int, the size of the blocks in bytes
+    returns a Signature. If the file does not exist, it has no blocks.
+    """
+    sig = Signature(block_size=block_size, size=0, blocks=[])
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        return sig
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        sig.size = len(data)
+        sig.marker = __choose_marker(data, block_size)
+        marker = bytes([sig.marker])
+        for start in range(0, sig.size, block_size):
+            block = data[start:start + block_size]
+            sig.blocks.append((zlib.adler32(block), hashlib.md5(block).digest()))
+            offset = block.find(marker, 0, block_size - ANCHOR_SIZE + 1) if len(block) == block_size else -1
+            sig.anchors.append((offset, block[offset:offset + ANCHOR_SIZE]) if offset >= 0 else None)
+    return sig
+
+
+def __choose_marker(data, block_size: int) -> int:
+    """ returns the rarest byte value of a sample of the file which is still expected
+    in every block, so that few positions of a changed region need to be looked up
+    """
+    step = max(block_size, len(data) // MARKER_SAMPLES)
+    sample = b''.join(data[start:start + min(block_size, MARKER_SAMPLE_SIZE)]
+                      for start in range(0, len(data), step))
+    counts = [sample.count(value) for value in range(256)]
+    needed = MARKER_MIN_COUNT * len(sample) / max(1, block_size - ANCHOR_SIZE)
+    values = [value for value in range(256) if counts[value] >= needed]
+    if values:
+        return min(values, key=counts.__getitem__)
+    return max(range(256), key=counts.__getitem__)
+
+
+def write_signature(sig: Signature, out):
+    """
+    @sig: Signature returned by get_signature
+    @out: binary file object to write to
+    """
+    anchor_size = ANCHOR_SIZE if sig.anchors else 0
+    out.write(_SIG_HEADER.pack(sig.block_size, sig.size, len(sig.blocks), anchor_size, sig.marker))
+    for ind, (weak, strong) in enumerate(sig.blocks):
+        out.write(_SIG_ENTRY.pack(weak, strong))
+        if anchor_size > 0:
+            offset, anchor = sig.anchors[ind] or (-1, b'')
+            out.write(_ANCHOR_OFFSET.pack(offset) + anchor.ljust(anchor_size, b'\0'))
+
+
+def read_signature(inp) -> Signature:
+    """
+    @inp: binary file object to read from
+    returns a Signature
+    """
+    block_size, size, count, anchor_size, marker = _SIG_HEADER.unpack(__read_exact(inp, _SIG_HEADER.size))
+    sig = Signature(block_size=block_size, size=size, blocks=[], marker=marker)
+    for _ in range(count):
+        sig.blocks.append(_SIG_ENTRY.unpack(__read_exact(inp, _SIG_ENTRY.size)))
+        if anchor_size > 0:
+            offset, = _ANCHOR_OFFSET.unpack(__read_exact(inp, _ANCHOR_OFFSET.size))
+            anchor = __read_exact(inp, anchor_size)
+            sig.anchors.append((offset, anchor) if offset >= 0 else None)
+    return sig
+
+
+def __read_exact(inp, size: int) -> bytes:
+    """ reads exactly size bytes or raises a DeltaError """
+    data = b''
+    while len(data) < size:
+        chunk = inp.read(size - len(data))
+        if not chunk:
+            raise DeltaError('Unexpected end of the delta stream')
+        data += chunk
+    return data
+
+
+def __lookup(table: dict, weak: int, block) -> int:
+    """ returns the index of the old block matching the window or None """
+    strongs = table.get(weak)
+    if strongs is None:
+        return None
+    return strongs.get(hashlib.md5(block).digest())
+
+
+def __search(data, size: int, sig: Signature, table: dict, anchors: dict, start: int) -> int:
+    """ looks for the next old block after a change, whichever it is
+    @start: int, the position in data to search from
+    @anchors: dictionary of anchor to list of tuples of (block index, offset in the block)
+    returns the first position from start where an old block was found or size
+    """
+    marker = bytes([sig.marker])
+    block_size = sig.block_size
+    pos = data.find(marker, start)
+    while pos >= 0:
+        for ind, offset in anchors.get(data[pos:pos + ANCHOR_SIZE], ()):
+            begin = pos - offset
+            if begin < start or begin + block_size > size:
+                continue
+            block = data[begin:begin + block_size]
+            if __lookup(table, zlib.adler32(block), block) is not None:
+                return begin
+        pos = data.find(marker, pos + 1)
+    return size
+
+
+def __find_matches(data, size: int, sig: Signature):
+    """
+    @data: the new file content (a memory map)
+    @size: int, the size of data
+    @sig: the signature of the old file
+    yields tuples of (position, block index) of the blocks of the old file
+        found in data, in order and without overlapping
+    """
+    if not sig.blocks:
+        return
+    table = {}
+    for ind, (weak, strong) in enumerate(sig.blocks):
+        table.setdefault(weak, {}).setdefault(strong, ind)
+    anchors = {}
+    for ind, anchor in enumerate(sig.anchors):
+        if anchor is not None:
+            anchors.setdefault(anchor[1], []).append((ind, anchor[0]))
+
+    block_size = sig.block_size
+    pos = 0
+    found = 0 # the next position where __search found a block, valid while it is after pos
+    while pos + block_size <= size:
+        block = data[pos:pos + block_size]
+        ind = __lookup(table, zlib.adler32(block), block)
+        if ind is not None:
+            yield pos, ind
+            pos += block_size
+            continue
+
+        if found <= pos:
+            found = __search(data, size, sig, table, anchors, pos + 1)
+        # the next blocks start after the inserted or removed data,
+        # or at the next block boundary if this block was changed in place:
+        pos = min(found, pos + block_size)
+
+    # only the last block of the old file can be shorter than block_size:
+    if 0 < sig.tail < block_size and size - sig.tail >= pos:
+        tail = data[size - sig.tail:size]
+        if __lookup(table, zlib.adler32(tail), tail) == len(sig.blocks) - 1:
+            yield size - sig.tail, len(sig.blocks) - 1
+
+
+def get_delta(path: str, sig: Signature):
+    """
+    @path: str, the new version of the file
+    @sig: the signature of the old version of the file
+    yields instructions which are either ('C', first_block, count)
+        to copy blocks from the old file or ('D', data) for literal data
+    """
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        literal_start = 0
+        copy = None # pending (first_block, count)
+        for pos, ind in __find_matches(data, size, sig):
+            if literal_start < pos:
+                if copy is not None:
+                    yield ('C',) + copy
+                    copy = None
+                for start in range(literal_start, pos, MAX_LITERAL):
+                    yield ('D', data[start:min(start + MAX_LITERAL, pos)])
+
+            if copy is not None and copy[0] + copy[1] == ind:
+                copy = (copy[0], copy[1] + 1)
+            else:
+                if copy is not None:
+                    yield ('C',) + copy
+                copy = (ind, 1)
+            literal_start = min(pos + sig.block_size, size)
+
+        if copy is not None:
+            yield ('C',) + copy
+        for start in range(literal_start, size, MAX_LITERAL):
+            yield ('D', data[start:min(start + MAX_LITERAL, size)])
+
+
+def write_delta(path: str, sig: Signature, out) -> int:
+    """
+    @path: str, the new version of the file
+    @sig: the signature of the old version of the file
+    @out: binary file object to write the instructions to
+    returns the number of literal bytes written
+    """
+    literal = 0
+    for op in get_delta(path, sig):
+        if op[0] == 'C':
+            out.write(_COPY + _COPY_ARGS.pack(op[1], op[2]))
+        else:
+            out.write(_DATA + _DATA_ARGS.pack(len(op[1])))
+            out.write(op[1])
+            literal += len(op[1])
+    out.write(_END + file_md5(path))
+    return literal
+
+
+def apply_delta(basis: str, inp, dst: str, block_size: int=BLOCK_SIZE):
+    """
+    @basis: str, the old version of the file. It may not exist.
+    @inp: binary file object to read the instructions from
+    @dst: str, where to write the new version of the file.
+        It can be the same as basis since the result is written
+        to a temporary file first.
+    @block_size: int, the block size used to compute the signature
+    if the result does not match the checksum of the source, it raises a DeltaError
+    """
+    tmp_path = f'{dst}.delta.tmp'
+    md5 = hashlib.md5()
+    old = open(basis, 'rb') if os.path.isfile(basis) else None
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                opcode = __read_exact(inp, 1)
+                if opcode == _COPY:
+                    first, count = _COPY_ARGS.unpack(__read_exact(inp, _COPY_ARGS.size))
+                    if old is None:
+                        raise DeltaError(f'No basis file to copy blocks from: {basis}')
+                    old.seek(first * block_size)
+                    remaining = count * block_size
+                    while remaining > 0:
+                        chunk = old.read(min(remaining, MAX_LITERAL))
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        md5.update(chunk)
+                        remaining -= len(chunk)
+                elif opcode == _DATA:
+                    length, = _DATA_ARGS.unpack(__read_exact(inp, _DATA_ARGS.size))
+                    chunk = __read_exact(inp, length)
+                    out.write(chunk)
+                    md5.update(chunk)
+                elif opcode == _END:
+                    expected = __read_exact(inp, 16)
+                    break
+                else:
+                    raise DeltaError(f'Invalid delta instruction: {opcode}')
+    except BaseException:
+        if old is not None:
+            old.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    if old is not None:
+        old.close()
+    if md5.digest() != expected:
+        os.remove(tmp_path)
+        raise DeltaError(f'checksum mismatch after applying the delta to {dst}')
+    os.replace(tmp_path, dst)
+
+
+def file_md5(path: str) -> bytes:
+    """ returns the md5 digest of the file """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MAX_LITERAL), b''):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def __get_source() -> bytes:
+    """ returns the source code of this module to run it on the remote host """
+    with open(os.path.abspath(__file__), 'rb') as f:
+        return f.read()
+
+
+def __check_exit(stdout, stderr, action: str):
+    """ raises a DeltaError if the remote helper failed """
+    exit_status = stdout.channel.recv_exit_status()
+    if exit_status != 0:
+        raise DeltaError(f'Failed to {action}\n%s' % stderr.read().decode('utf-8', 'replace'))
+
+
+def upload_file(src: str, dst: str, creds, block_size: int=BLOCK_SIZE, throttle=None) -> int:
+    """ uploads a file by only sending the parts that differ from the remote copy
+    @src: str, the local file path
+    @dst: str, the remote file path
+    @creds: ssh credentials
+    @block_size: int, the size of the blocks in bytes
+    @throttle: optional function which takes a number of bytes and waits until they can be sent
+    returns the number of literal bytes sent
+    """
+    from . import executor, bandwidth
+    client = executor.connect(creds)
+    try:
+        _, stdout, stderr = executor.remote_python(client, __get_source(), ['signature', dst, block_size])
+        sig = read_signature(stdout)
+        __check_exit(stdout, stderr, f'compute the signature of {dst}')
+
+        stdin, stdout, stderr = executor.remote_python(client, __get_source(), ['patch', dst, block_size])
+        literal = write_delta(src, sig, stdin if throttle is None else bandwidth.Throttled(stdin, throttle))
+        stdin.flush()
+        stdin.channel.shutdown_write()
+        __check_exit(stdout, stderr, f'patch {dst}')
+    finally:
+        client.close()
+    return literal
+
+
+def download_file(src: str, dst: str, creds, block_size: int=BLOCK_SIZE, throttle=None):
+    """ downloads a file by only receiving the parts that differ from the local copy
+    @src: str, the remote file path
+    @dst: str, the local file path
+    @creds: ssh credentials
+    @block_size: int, the size of the blocks in bytes
+    @throttle: optional function which takes a number of bytes and waits until they can be received
+    """
+    from . import executor, bandwidth
+    client = executor.connect(creds)
+    try:
+        stdin, stdout, stderr = executor.remote_python(client, __get_source(), ['delta', src])
+        write_signature(get_signature(dst, block_size), stdin)
+        stdin.flush()
+        stdin.channel.shutdown_write()
+        apply_delta(dst, stdout if throttle is None else bandwidth.Throttled(stdout, throttle), dst, block_size)
+        __check_exit(stdout, stderr, f'compute the delta of {src}')
+    finally:
+        client.close()
+
+
+def __main(argv: list):
+    """ the entry point of the remote helper
+    signature <path> <block_size>: writes the signature of path to stdout
+    patch <path> <block_size>: applies the delta read from stdin to path
+    delta <path>: reads a signature from stdin and writes the delta of path to stdout
+    """
+    mode, path = argv[0], argv[1]
+    if mode == 'signature':
+        write_signature(get_signature(path, int(argv[2])), sys.stdout.buffer)
+    elif mode == 'patch':
+        apply_delta(path, sys.stdin.buffer, path, int(argv[2]))
+    elif mode == 'delta':
+        write_delta(path, read_signature(sys.stdin.buffer), sys.stdout.buffer)
+    else:
+        raise DeltaError(f'Unknown mode: {mode}')
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    __main(sys.argv[1:])
@@ -1,7 +1,7 @@
 import os
-from multiprocessing.pool import ThreadPool
 from functools import partial
 from urllib import parse, request
+from . import executor, scheduler, tracing
 
 def __download(folder: str, url: str, extension: str=None):
     """
@@ -16,15 +16,20 @@ def __download(folder: str, url: str, extension: str=None):
             extension = f'.{extension}'
         filename = f'{filename}{extension}'
 
-    with request.urlopen(url) as f:
+    with tracing.span('download', host=netloc, url=url) as span, request.urlopen(url) as f:
         with open(os.path.join(folder, filename), 'wb') as output:
-            output.write(f.read())
+            span.set(bytes=output.write(f.read()))
 
-def download(folder: str, urls: list, extension=None, parallelism: int=10):
-    pool = ThreadPool(processes=parallelism)
-    async_results = []
-    for url in urls:
-        async_results.append(pool.apply_async(__download, (folder, url, extension)))
-
-    for res in async_results:
-        res.get()
+def download(folder: str, urls: list, extension=None, parallelism: int=10,
+             priority: int=scheduler.NORMAL):
+    """
+    @folder: where to download to
+    @urls: list of urls
+    @extension: if specified, then you'd add this extension to the filenames
+    @parallelism: int, how many urls to download at the same time
+    @priority: scheduler.HIGH, NORMAL or LOW
+    The downloads of one server count against its per-host limit of the scheduler
+    """
+    executor.run_parallel(partial(__download, folder, extension=extension), urls,
+                          parallelism=parallelism, priority=priority,
+                          host=lambda url: parse.urlsplit(url).netloc)
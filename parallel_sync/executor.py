@@ -5,45 +5,193 @@ It can do operations in parallel batches as well
 """
 import signal
 import re
+import time
+import shlex
+import stat
+import select
 import pathlib
 import logging
+import threading
 import subprocess
-from six import string_types
-import paramiko
+from dataclasses import dataclass
 from . import Credential
-logging.basicConfig(level='INFO')
+from .filelist import FileList
 
 from queue import Queue
 
+REMOTE_PYTHON = 'python3'
+READ_SIZE = 32 * 1024 # bytes read from an ssh channel at a time
+MAX_STDERR = 64 * 1024 # bytes of the end of stderr kept for the error message
+MAX_LINE = 1024 * 1024 # bytes, the longest output line stream_remote accepts
+CAPTURE = 'capture'
+DISCARD = 'discard'
+
+
+class CommandError(Exception):
+    """ raised when a local command fails. returncode is its exit code """
+    def __init__(self, message: str, returncode: int=None):
+        super().__init__(message)
+        self.returncode = returncode
+
+
+class CommandTimeout(CommandError):
+    """ raised when a remote command does not finish in time """
+
+
+@dataclass
+class CommandResult:
+    args: list
+    returncode: int
+    stdout: bytes = None # only if the output was captured
+    stderr: bytes = None
+
 
 def init_worker():
     """ use this Pool initializer to allow keyboard interruption """
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
-def remote(cmd: str, creds: Credential, curr_dir: str=None):
-    """ runs commands on the remote machine in parallel
-    @cmd: str, command to run on remote machine
+def connect(creds: Credential):
+    """
     @creds: ssh credentials
-    @curr_dir(optional): the currenct directory to run the command from
-    returns the output as string
+    returns a connected paramiko.SSHClient
     """
+    import paramiko # imported here so that short invocations start fast
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(**creds.__dict__)
+    try:
+        client.connect(**creds.__dict__)
+    except TimeoutError:
+        raise Exception(f"Failed to connect to {creds.hostname}. Attempt timed out.")
+    return client
+
+
+def remote_python(client, source: bytes, args: list):
+    """ runs a python helper script on the remote machine
+    The script is sent over the stdin of the ssh channel so nothing
+    needs to be installed on the remote host except python3.
+    The rest of stdin is left for the script to read.
+    @client: connected paramiko.SSHClient
+    @source: bytes, the python source code of the helper
+    @args: list of str arguments passed to the helper as sys.argv[1:]
+    returns a tuple of (stdin, stdout, stderr)
+    """
+    loader = f'import sys;exec(compile(sys.stdin.buffer.read({len(source)}),"helper","exec"))'
+    cmd = ' '.join([REMOTE_PYTHON, '-c', shlex.quote(loader)] + [shlex.quote(str(arg)) for arg in args])
+    logging.debug(cmd)
+    stdin, stdout, stderr = client.exec_command(cmd)
+    stdin.write(source)
+    stdin.flush()
+    return stdin, stdout, stderr
+
+
+def run_parallel(func, items, parallelism: int=10, host=None, priority: int=None):
+    """ calls func on every item on the process-wide scheduler
+    Unlike ThreadPool.map, the items are consumed lazily as the workers
+    become free, so a huge iterable is never turned into a list.
+    @func: function which takes one item
+    @items: an iterable of items
+    @parallelism: int, how many items of this call can run at the same time
+    @host: the host the calls run against (or a function of the item), to apply the per-host limit
+    @priority: scheduler.HIGH, NORMAL or LOW
+    If a call fails, no more items are started and its exception is raised
+    """
+    from . import scheduler
+    if priority is None:
+        priority = scheduler.NORMAL
+    scheduler.run(func, items, host=host, parallelism=parallelism, priority=priority)
+
+
+def stream_remote(cmd: str, creds: Credential, timeout: float=None,
+                  chunk_size: int=None, client=None):
+    """ runs a command on the remote machine and yields its output as it arrives.
+    stdout and stderr are drained at the same time, so the command never stalls
+    on a full channel window, and only the end of stderr is kept.
+    @cmd: str, command to run on remote machine
+    @creds: ssh credentials
+    @timeout: float, how many seconds the command can run. None means no limit.
+    @chunk_size: int, if specified, bytes chunks of at most this size are yielded.
+        Otherwise the output lines are yielded as str without the line break.
+    @client: optional connected paramiko.SSHClient to run the command on. It is not closed.
+    raises a CommandError when the command fails, once its output was yielded,
+        or a CommandTimeout if it runs out of time
+    """
+    own_client = client is None
+    if own_client:
+        client = connect(creds)
+    logging.debug(cmd)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    read_size = min(chunk_size or READ_SIZE, READ_SIZE)
+    stderr = bytearray()
+    pending = b'' # the start of a line which did not end yet
+    channel = None
+    try:
+        channel = client.exec_command(cmd)[1].channel
+        while True:
+            if deadline is not None and time.monotonic() > deadline:
+                raise CommandTimeout(f'The following command timed out after {timeout} seconds '
+                                     f'on {creds.hostname}: {cmd}')
+            eof = channel.eof_received # read first, the data before the eof is buffered by then
+            while channel.recv_stderr_ready():
+                stderr += channel.recv_stderr(READ_SIZE)
+                del stderr[:-MAX_STDERR]
+            if channel.recv_ready():
+                data = channel.recv(read_size)
+                if chunk_size is not None:
+                    yield data
+                    continue
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                if len(pending) > MAX_LINE:
+                    raise CommandError(f'An output line of {cmd} is longer than {MAX_LINE} bytes')
+                for line in lines:
+                    yield line.decode('utf-8', 'surrogateescape')
+                continue
+            # the exit status can arrive before the last output, so the end is the end of the streams:
+            if eof and not channel.recv_stderr_ready():
+                break
+            wait = 1.0 if deadline is None else max(0, deadline - time.monotonic())
+            select.select([channel], [], [], min(wait, 1.0))
+
+        if pending and chunk_size is None:
+            yield pending.decode('utf-8', 'surrogateescape')
+        exit_status = channel.recv_exit_status()
+        if exit_status != 0:
+            raise CommandError(f'The following command failed on {creds.hostname}: {cmd}\n'
+                + stderr.decode('utf-8', 'replace'), exit_status)
+    finally:
+        if own_client:
+            client.close()
+        elif channel is not None:
+            channel.close()
+
+
+def remote(cmd: str, creds: Credential, curr_dir: str=None, timeout: float=None):
+    """ runs a command on the remote machine
+    @cmd: str, command to run on remote machine
+    @creds: ssh credentials
+    @curr_dir(optional): the currenct directory to run the command from
+    @timeout: float, how many seconds the command can run. None means no limit.
+    returns the output as bytes. Use stream_remote for commands with a large output.
+    """
     if curr_dir is not None:
         make_dirs_remote({curr_dir}, creds)
         cmd = f'cd "{curr_dir}"; {cmd}'
 
-    logging.debug(cmd)
-    _, stdout, stderr = client.exec_command(cmd)
-    exit_status = stdout.channel.recv_exit_status()
-    
-    if exit_status != 0:
-        raise Exception('Failed to download a file\n%s\n%s' % (stdout.read().encode('utf-8'), stderr.read().encode('utf-8')))
+    output = bytearray()
+    for chunk in stream_remote(cmd, creds, timeout=timeout, chunk_size=READ_SIZE):
+        output += chunk
+    return bytes(output)
 
-    client.close()
-    return stdout.read()
+
+def get_batch_command(cmds: list) -> str:
+    """ returns a shell command which runs the commands at the same time
+    and exits with 1 if any of them failed
+    """
+    cmd = ' '.join(f'({c}) & pid{ind}=$!;' for ind, c in enumerate(cmds))
+    waits = ' '.join(f'wait $pid{ind} || {{ status=1; echo {shlex.quote("Failed: " + c)} >&2; }};'
+                     for ind, c in enumerate(cmds))
+    return f'{cmd} status=0; {waits} exit $status'
 
 
 def run_remote_batch(cmds: list, creds: Credential, curr_dir: str=None, parallelism: int=10):
@@ -52,51 +200,149 @@ def run_remote_batch(cmds: list, creds: Credential, curr_dir: str=None, parallel
     @creds: ssh credentials
     @curr_dir(optional): the currenct directory to run the command from
     @parallelism: int - how many commands to run at the same time
+    raises a CommandError if any of the commands failed
     """
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    if curr_dir is not None:
+        make_dirs_remote({curr_dir}, creds)
+    client = connect(creds)
     try:
-        client.connect(**creds.__dict__)
-    except TimeoutError:
-        raise Exception(f"Failed to connect to {creds.hostname}. Attempt timed out.")
-    
-    ind = 0
-    while ind <len(cmds):
-        cmd = '(%s)' % ') & ('.join(cmds[ind:ind+parallelism])
+        for ind in range(0, len(cmds), parallelism):
+            cmd = get_batch_command(cmds[ind:ind+parallelism])
+            if curr_dir is not None:
+                cmd = f'cd "{curr_dir}"; {cmd}'
+            for _ in stream_remote(cmd, creds, chunk_size=READ_SIZE, client=client):
+                pass # the output is drained so that the commands do not block
+    finally:
+        client.close()
+
+
+def run_remote_parallel(cmds: list, creds: Credential, curr_dir: str=None, parallelism: int=10,
+                        priority: int=None):
+    """ runs commands on the remote machine on the process-wide scheduler,
+    so that the per-host limit and the priority apply to them.
+    The ssh connections are reused, there are at most parallelism of them.
+    @cmds: list of commands
+    @creds: ssh credentials
+    @curr_dir(optional): the currenct directory to run the commands from
+    @parallelism: int - how many commands to run at the same time
+    @priority: scheduler.HIGH, NORMAL or LOW
+    raises a CommandError if any of the commands failed
+    """
+    if curr_dir is not None:
+        make_dirs_remote({curr_dir}, creds)
+    clients = []
+    free = [] # the connections which do not run a command
+    lock = threading.Lock()
+
+    def run(cmd):
+        with lock:
+            client = free.pop() if free else None
+        if client is None:
+            client = connect(creds)
+            with lock:
+                clients.append(client)
         if curr_dir is not None:
-            make_dirs_remote({curr_dir}, creds)
             cmd = f'cd "{curr_dir}"; {cmd}'
+        for _ in stream_remote(cmd, creds, chunk_size=READ_SIZE, client=client):
+            pass # the output is drained so that the command does not block
+        with lock:
+            free.append(client)
 
-        logging.debug(cmd)
-        _, stdout, stderr = client.exec_command(cmd)
-        exit_status = stdout.channel.recv_exit_status()
-        
-        if exit_status != 0:
-            raise Exception('Failed to download a file\n%s\n%s' % (stdout.read().encode('utf-8'), stderr.read().encode('utf-8')))
-
-        ind += parallelism
-    client.close()
+    try:
+        run_parallel(run, cmds, parallelism=parallelism, host=creds.hostname, priority=priority)
+    finally:
+        for client in clients:
+            client.close()
 
 
-def local(cmd: str, tries: int=1):
+def local(cmd, tries: int=1):
     """ runs a command on the local machine
-    @cmd: command to run
+    @cmd: command to run. A str is run by the shell,
+        a list of arguments is run directly without a shell.
     @tries: int - number of times to try the command
     """
+    returncode = None
     for count in range(tries):
         logging.debug(cmd)
-        proc = subprocess.Popen(cmd, shell=True,\
+        proc = subprocess.Popen(cmd, shell=isinstance(cmd, str),\
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         output, err = proc.communicate()
+        returncode = proc.returncode
         if proc.returncode == 0:
-            if not isinstance(output, string_types):
+            if not isinstance(output, str):
                 output = output.decode('utf-8') # python3 returns bytes
             return output
         logging.warning('Command failed: %s', cmd)
         logging.error(err.decode('utf-8'))
         if count < tries:
             logging.info('Re-attempt %s', count + 1)
-    raise Exception(f'The following command failed: {cmd}')
+    raise CommandError(f'The following command failed: {cmd}', returncode)
+
+
+def local_batch(cmds, parallelism: int=10, output=CAPTURE, fail_fast: bool=True,
+                cwd: str=None) -> list:
+    """ runs local commands directly, without a shell, keeping up to parallelism
+    of them running. A new command starts as soon as one finishes.
+    @cmds: iterable of commands, each one a list of arguments. A str is split like a shell would.
+    @parallelism: int - how many commands to run at the same time
+    @output: CAPTURE keeps the stdout and stderr of every command in its result,
+        DISCARD drops them, or a function which is called with (index, line)
+        for every line of output (stdout and stderr merged) as it arrives
+    @fail_fast: bool - if True, the first failure terminates the running commands,
+        no more commands are started and a CommandError is raised.
+        If False, all the commands run and the failures are in the results.
+    @cwd: str - the folder to run the commands in
+    returns a list of CommandResult in the order of cmds
+    """
+    results = {}
+    running = {}
+    lock = threading.Lock()
+    cancelled = threading.Event()
+
+    def run(item):
+        ind, args = item
+        if isinstance(args, str):
+            args = shlex.split(args)
+        if cancelled.is_set():
+            return
+        logging.debug(args)
+        stream = callable(output)
+        pipe = subprocess.DEVNULL if output == DISCARD else subprocess.PIPE
+        try:
+            proc = subprocess.Popen(args, cwd=cwd, stdin=subprocess.DEVNULL, stdout=pipe,
+                stderr=subprocess.STDOUT if stream else pipe)
+        except OSError as e: # the program does not exist
+            returncode, stdout, stderr = 127, None, str(e).encode('utf-8')
+        else:
+            with lock:
+                running[ind] = proc
+                if cancelled.is_set():
+                    proc.terminate()
+            try:
+                if stream:
+                    for line in proc.stdout:
+                        output(ind, line)
+                    proc.wait()
+                    stdout, stderr = None, None
+                else:
+                    stdout, stderr = proc.communicate()
+            finally:
+                with lock:
+                    running.pop(ind)
+            returncode = proc.returncode
+        results[ind] = CommandResult(args, returncode, stdout, stderr)
+        if returncode != 0 and fail_fast and not cancelled.is_set():
+            cancelled.set()
+            with lock:
+                for other in running.values():
+                    other.terminate()
+            message = f'The following command failed: {shlex.join(args)}'
+            if stderr:
+                message += '\n' + stderr.decode('utf-8', 'replace')
+            raise CommandError(message, returncode)
+
+    run_parallel(run, enumerate(cmds), parallelism=parallelism)
+    return [results[ind] for ind in sorted(results)]
 
 
 def make_dirs_remote(folders: set, creds: Credential):
@@ -111,61 +357,68 @@ def make_dirs_remote(folders: set, creds: Credential):
 
 
 
-def find_local(start_dir: str, include: str='*', exclude: list=None) -> list[str]:
+def is_excluded(path: str, exclude: list=None) -> bool:
+    """
+    @path: str, the full path of a file or folder
+    @exclude: list of wild card patterns to exclude files or folders
+    returns bool, whether the path matches one of the exclude patterns
+    """
+    if exclude:
+        for ex in exclude:
+            if re.match(ex.replace('*', '.*'), path):
+                return True
+    return False
+
+
+def find_local(start_dir: str, include: str='*', exclude: list=None) -> tuple:
     """
     @include: a wild card pattern to include files or folders, default is '*'
     @exclude: list of wild card patterns to exclude files or folders
-    returns 2 lists of strings which are folder paths and file paths
+    returns a list of folder paths and a FileList of the file paths with their sizes and times
     """
-    files = []
+    files = FileList()
     folders = []
     root = pathlib.Path(start_dir)
     for path in root.rglob(include):
-        if path.is_file():
+        try:
+            st = path.stat()
+        except OSError: # broken link or removed in the meantime
+            st = None
+        if st is not None and stat.S_ISREG(st.st_mode):
             path = path.absolute().as_posix()
-            if exclude:
-                for ex in exclude:
-                    if re.match(ex.replace('*', '.*'), path):
-                        continue
-            files.append(path)
+            if is_excluded(path, exclude):
+                continue
+            files.append(path, st.st_size, st.st_mtime)
         else: # folder:
             folders.append(path.absolute().as_posix())
     return folders, files
 
 
-def __add_path(path: str, files: list, folders: list):
-    """
-    @path: str, it starts with with 'F: ' or 'D: ' to distinguish file from folders
-    @files: list of files to add to
-    @folders: list of folders to add to
-    """
-    if path[:2] == 'F:':
-        files.append(path[2:].strip())
-    else:
-        folders.append(path[2:].strip())
-    
 def find_remote(start_dir: str, creds: Credential, include: str='*', exclude: list=None):
     """
     @include: a wild card pattern
-    returns 2 lists of strings which are folder paths and file paths
+    returns a list of folder paths and a FileList of the file paths with their sizes and times
     """
-    files = []
+    files = FileList()
     folders = []
-    cmd = 'find %s -type f -name "%s" -exec echo "F: {}" \\; -o -type d -exec echo "D: {}" \\;' % (start_dir, include)
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.connect(**creds.__dict__)
-
-    stdout = client.exec_command(cmd)[1]
-    output = stdout.read().decode('utf-8')
-    paths = list(set(output.splitlines()))
-    if exclude is None or len(exclude) < 1:
-        for path in paths:
-            __add_path(path, files, folders)
-    else:
-        exclude_pat = '|'.join(exclude).replace('*', '.*')
-        for path in paths:
-            path = path.strip()
-            if not re.match(exclude_pat, path):
-                __add_path(path, files, folders)
+    # a missing or unreadable root fails, unlike the paths under it:
+    check = f'[ -e {start_dir} ] && {{ [ ! -d {start_dir} ] || [ -r {start_dir} -a -x {start_dir} ]; }}'\
+        f' || {{ echo "Cannot list {start_dir}" >&2; exit 2; }}; '
+    # one line per path without running a process per path:
+    cmd = f'{check}find {start_dir} -type f -name "{include}" -printf "F %s %T@ %p\\n"'\
+        ' -o -type d -printf "D 0 0 %p\\n"'
+    try:
+        for line in stream_remote(cmd, creds):
+            kind, size, mtime, path = line.split(' ', 3)
+            if is_excluded(path, exclude):
+                continue
+            if kind == 'F':
+                files.append(path, int(size), float(mtime))
+            else:
+                folders.append(path)
+    except CommandError as e:
+        if e.returncode != 1:
+            raise
+        # find exits with 1 when some folders could not be read, the rest is listed:
+        logging.warning('Some paths under %s could not be listed: %s', start_dir, e)
     return folders, files
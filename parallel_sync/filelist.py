@@ -0,0 +1,126 @@
+"""
+This module keeps huge file lists compact in memory.
+Instead of one python string per absolute path, the folder prefixes
+are interned once, the file names are packed in one bytearray and the
+sizes and modification times are stored in array-backed columns.
+A FileList behaves like a read-only sequence of path strings,
+the strings are only created when they are accessed.
+"""
+from array import array
+
+
+class FileList:
+    def __init__(self):
+        self.__folders = [] # interned folder prefixes, ending with /
+        self.__folder_ids = {} # folder prefix -> index in __folders
+        self.__folder_of = array('I') # folder index of every file
+        self.__names = bytearray() # utf-8 encoded file names, back to back
+        self.__name_ends = array('Q') # end offset of every name in __names
+        self.sizes = array('q') # size in bytes, -1 if unknown
+        self.mtimes = array('d') # modification time in epoch seconds, 0 if unknown
+
+    def append(self, path: str, size: int=-1, mtime: float=0.0):
+        """
+        @path: str, the full path of the file. It must use / as separator.
+        @size: int, the size of the file in bytes
+        @mtime: float, the modification time of the file
+        """
+        folder, sep, name = path.rpartition('/')
+        folder += sep
+        folder_id = self.__folder_ids.get(folder)
+        if folder_id is None:
+            folder_id = len(self.__folders)
+            self.__folder_ids[folder] = folder_id
+            self.__folders.append(folder)
+        self.__folder_of.append(folder_id)
+        self.__names += name.encode('utf-8', 'surrogateescape')
+        self.__name_ends.append(len(self.__names))
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+
+    def __len__(self) -> int:
+        return len(self.__name_ends)
+
+    def __path(self, ind: int) -> str:
+        start = self.__name_ends[ind - 1] if ind > 0 else 0
+        name = self.__names[start:self.__name_ends[ind]].decode('utf-8', 'surrogateescape')
+        return self.__folders[self.__folder_of[ind]] + name
+
+    def __getitem__(self, ind: int) -> str:
+        if ind < 0:
+            ind += len(self)
+        if not 0 <= ind < len(self):
+            raise IndexError('FileList index out of range')
+        return self.__path(ind)
+
+    def __iter__(self):
+        for ind in range(len(self)):
+            yield self.__path(ind)
+
+    def entries(self):
+        """ yields tuples of (path, size, mtime) """
+        for ind in range(len(self)):
+            yield self.__path(ind), self.sizes[ind], self.mtimes[ind]
+
+    def extend(self, paths):
+        """
+        @paths: a FileList, whose sizes and times are kept, or an iterable of paths
+        """
+        entries = paths.entries() if isinstance(paths, FileList) else ((path, -1, 0.0) for path in paths)
+        for path, size, mtime in entries:
+            self.append(path, size, mtime)
+
+    def select(self, keep) -> 'FileList':
+        """ returns a new FileList of the files whose flag is true, without creating their path strings.
+        The folder prefixes are shared with this FileList.
+        @keep: a sequence of flags, one per file, such as a bytearray
+        """
+        result = FileList()
+        result.__folders = self.__folders
+        result.__folder_ids = self.__folder_ids
+        for ind, flag in enumerate(keep):
+            if not flag:
+                continue
+            start = self.__name_ends[ind - 1] if ind > 0 else 0
+            result.__folder_of.append(self.__folder_of[ind])
+            result.__names += self.__names[start:self.__name_ends[ind]]
+            result.__name_ends.append(len(result.__names))
+            result.sizes.append(self.sizes[ind])
+            result.mtimes.append(self.mtimes[ind])
+        return result
+
+    def total_size(self) -> int:
+        """ returns the sum of the known sizes in bytes """
+        return sum(size for size in self.sizes if size > 0)
+
+
+class PathPairs:
+    """ a lazy read-only sequence of (source_path, dest_path) tuples.
+    The destination paths are computed from the source paths when they are accessed.
+    """
+    def __init__(self, srcs, get_dst):
+        """
+        @srcs: a sequence of source paths such as a FileList
+        @get_dst: a function which takes a source path and returns its destination path
+        """
+        self.srcs = srcs
+        self.get_dst = get_dst
+
+    def __len__(self) -> int:
+        return len(self.srcs)
+
+    def __getitem__(self, ind: int) -> tuple:
+        src = self.srcs[ind]
+        return src, self.get_dst(src)
+
+    def __iter__(self):
+        for src in self.srcs:
+            yield src, self.get_dst(src)
+
+    def select(self, keep) -> 'PathPairs':
+        """ returns the PathPairs of the sources whose flag is true
+        @keep: a sequence of flags, one per source, such as a bytearray
+        """
+        if isinstance(self.srcs, FileList):
+            return PathPairs(self.srcs.select(keep), self.get_dst)
+        return PathPairs([src for src, flag in zip(self.srcs, keep) if flag], self.get_dst)
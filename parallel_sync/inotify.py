@@ -0,0 +1,142 @@
+"""
+This module is a minimal binding of the Linux inotify API
+which is used to watch a folder tree for changes
+"""
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |\
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+_EVENT = struct.Struct('iIII') # wd, mask, cookie, name length
+_BUFFER_SIZE = 64 * 1024
+
+
+def is_supported() -> bool:
+    """ returns bool, whether inotify is available on this machine """
+    return hasattr(_get_libc(), 'inotify_init1')
+
+
+def _get_libc():
+    if not hasattr(_get_libc, 'libc'):
+        _get_libc.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return _get_libc.libc
+
+
+class Watcher:
+    """ watches a folder and all its sub-folders.
+    New sub-folders are watched as they are created.
+    """
+    def __init__(self, root: str):
+        """
+        @root: str, the folder to watch
+        """
+        if not is_supported():
+            raise OSError('inotify is not supported on this platform')
+        self.__libc = _get_libc()
+        self.__fd = self.__libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.__folders = {} # watch descriptor -> folder path
+        self.add_tree(root)
+
+    def __add_watch(self, folder: str) -> bool:
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return False # the folder was removed in the meantime
+            raise OSError(err, f'inotify_add_watch failed for {folder}')
+        self.__folders[wd] = folder
+        return True
+
+    def __remove_tree(self, folder: str):
+        """ stops watching a folder which was moved away and its sub-folders,
+        so that their watch descriptors are not kept with stale paths
+        """
+        for wd, path in list(self.__folders.items()):
+            if path == folder or path.startswith(folder + os.sep):
+                self.__libc.inotify_rm_watch(self.__fd, wd)
+                del self.__folders[wd]
+
+    @property
+    def folders(self) -> list:
+        """ returns the sorted list of the watched folders """
+        return sorted(self.__folders.values())
+
+    def add_tree(self, folder: str) -> list:
+        """ watches the folder and its sub-folders
+        @folder: str, the folder path
+        returns the list of files which already exist in the tree
+            since they may have been created before the watch was added
+        """
+        files = []
+        for dirpath, _, filenames in os.walk(folder):
+            if self.__add_watch(dirpath):
+                files.extend(os.path.join(dirpath, name) for name in filenames)
+        return files
+
+    def read(self, timeout: float=None) -> list:
+        """
+        @timeout: float, how many seconds to wait for events. None waits forever.
+        returns a list of tuples of (path, mask), empty if the timeout elapsed
+        """
+        ready, _, _ = select.select([self.__fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.__fd, _BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, pos)
+            pos += _EVENT.size
+            name = data[pos:pos + length].rstrip(b'\0')
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            folder = self.__folders.get(wd)
+            if mask & IN_IGNORED:
+                self.__folders.pop(wd, None)
+                continue
+            if folder is None:
+                continue
+            if mask & IN_MOVE_SELF:
+                # a folder moved inside the tree is watched again under its new path first:
+                if not os.path.isdir(folder):
+                    self.__remove_tree(folder)
+                continue
+            path = os.path.join(folder, os.fsdecode(name)) if name else folder
+            events.append((path, mask))
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,181 @@
+"""
+This module is a write-ahead journal of a transfer job so that a job which
+was interrupted (killed, crashed, lost its connection) can be resumed
+by running it again with the same job id.
+
+The journal is a JSON lines file with one record per line:
+    {"t": "job", ...}                    the parameters of the job
+    {"t": "plan", "p": path, "s": size, "m": mtime}   one per source file
+    {"t": "planned"}                     the file list is complete
+    {"t": "done", "p": path}             the file was transferred
+    {"t": "offset", "p": path, "n": bytes}   how much of a large file was written
+    {"t": "phase", "name": name}         a phase of the job (validate, extract) finished
+The file list and the phases are synced to disk when they are written.
+The done records are flushed at once, which survives the death of the process,
+and synced at most every SYNC_INTERVAL seconds. A torn last line is ignored.
+When a job completes, its journal is removed.
+"""
+import os
+import re
+import json
+import time
+import logging
+import threading
+from .filelist import FileList
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.parallel_sync', 'journals')
+SYNC_INTERVAL = 1.0 # seconds
+
+
+class JournalMismatch(ValueError):
+    pass
+
+
+class Journal:
+    """ Example:
+    journal = Journal('nightly-backup')
+    resumed = journal.open({'src': '/tmp/x', 'dst': '/tmp/y'})
+    """
+    def __init__(self, job_id: str, folder: str=None):
+        """
+        @job_id: str, the id of the job. It is used as the file name of the journal.
+        @folder: str, where the journals are kept. Default is ~/.parallel_sync/journals
+        """
+        if not re.fullmatch(r'[\w.-]+', job_id or ''):
+            raise ValueError(f'Invalid job id: {job_id}. Use letters, digits, ".", "_" or "-"')
+        self.job_id = job_id
+        self.path = os.path.join(folder or DEFAULT_DIR, f'{job_id}.jsonl')
+        self.plan = None # FileList of the planned source files
+        self.__done = set() # the paths done by the earlier runs of the job
+        self.__offsets = {}
+        self.__phases = set()
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__synced = 0
+
+    @property
+    def planned(self) -> bool:
+        """ whether the file list of the job is already known """
+        return self.plan is not None
+
+    def open(self, params: dict) -> bool:
+        """ loads the journal of an earlier run of the job if there is one
+        @params: dict, the parameters of the job. An earlier run with different
+            parameters raises a JournalMismatch.
+        returns bool, whether the job is resumed
+        """
+        header = {}
+        plan = FileList()
+        for record in self.__load():
+            kind = record.get('t')
+            if kind == 'job':
+                header = record
+            elif kind == 'plan':
+                plan.append(record['p'], record['s'], record['m'])
+            elif kind == 'planned':
+                self.plan = plan
+            elif kind == 'done':
+                self.__done.add(record['p'])
+                self.__offsets.pop(record['p'], None)
+            elif kind == 'offset':
+                self.__offsets[record['p']] = record['n']
+            elif kind == 'phase':
+                self.__phases.add(record['name'])
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if self.plan is None: # nothing useful was recorded, start over
+            self.__done.clear()
+            self.__offsets.clear()
+            self.__phases.clear()
+            self.__file = open(self.path, 'w', encoding='utf-8')
+            self.__write({'t': 'job', 'job_id': self.job_id, 'params': params}, sync=True)
+            return False
+
+        if header.get('params') != params:
+            raise JournalMismatch(f'The job {self.job_id} was started with different '
+                f'parameters: {header.get("params")}. Remove {self.path} to start over.')
+        self.__file = open(self.path, 'a', encoding='utf-8')
+        if self.__file.tell() > 0:
+            self.__file.write('\n') # ends a line which may have been torn by a crash
+        logging.info('Resuming job %s: %s of %s files are done',
+                     self.job_id, len(self.__done), len(self.plan))
+        return True
+
+    def __load(self):
+        """ yields the records of the journal file """
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue # a line torn by a crash or an empty line
+
+    def __write(self, record: dict, sync: bool=False):
+        with self.__lock:
+            self.__file.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.__file.flush()
+            now = time.monotonic()
+            if sync or now - self.__synced >= SYNC_INTERVAL:
+                os.fsync(self.__file.fileno())
+                self.__synced = now
+
+    def write_plan(self, files):
+        """ records the file list of the job
+        @files: FileList or list of source paths
+        """
+        entries = files.entries() if isinstance(files, FileList) else ((path, -1, 0) for path in files)
+        plan = FileList()
+        with self.__lock:
+            for path, size, mtime in entries:
+                self.__file.write(json.dumps({'t': 'plan', 'p': path, 's': size, 'm': mtime},
+                                             separators=(',', ':')) + '\n')
+                plan.append(path, size, mtime)
+        self.__write({'t': 'planned'}, sync=True)
+        self.plan = plan
+
+    def pending(self) -> FileList:
+        """ returns a FileList of the planned files which are not done """
+        files = FileList()
+        for path, size, mtime in self.plan.entries():
+            if path not in self.__done:
+                files.append(path, size, mtime)
+        return files
+
+    def is_done(self, path: str) -> bool:
+        """ whether an earlier run of the job transferred the file """
+        return path in self.__done
+
+    def done(self, path: str):
+        """ records that a file was transferred """
+        self.__write({'t': 'done', 'p': path})
+
+    def set_offset(self, path: str, offset: int):
+        """ records how many bytes of a large file were written """
+        self.__write({'t': 'offset', 'p': path, 'n': offset})
+
+    def get_offset(self, path: str) -> int:
+        """ returns how many bytes of a large file an earlier run of the job wrote """
+        return self.__offsets.get(path, 0)
+
+    def phase_done(self, name: str) -> bool:
+        return name in self.__phases
+
+    def finish_phase(self, name: str):
+        self.__write({'t': 'phase', 'name': name}, sync=True)
+        self.__phases.add(name)
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+                self.__file.close()
+                self.__file = None
+
+    def remove(self):
+        """ closes and deletes the journal once the job completed """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
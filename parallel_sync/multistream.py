@@ -0,0 +1,256 @@
+"""
+This module transfers one very large file over several ssh connections at once.
+A single scp or rsync process is bound by the speed of one cipher stream
+(one core) and by the TCP window of one connection.
+Here, the file is split into byte ranges which are sent concurrently, each stream
+has its own connection and sftp session and writes its ranges at their offsets
+in a preallocated temporary file next to the destination.
+Every range is verified with md5 once it is written and the whole file is
+verified at the end, before the temporary file is renamed to the destination
+with the permissions and the modification time of the source.
+With a journal, the ranges which were written before an interruption are not sent again,
+otherwise the temporary file is removed when the transfer fails.
+It does not compare the file with an existing destination, so it is meant for
+the files which are missing on the destination (see rsync).
+"""
+import os
+import stat
+import shlex
+import hashlib
+import logging
+import threading
+from queue import Queue, Empty
+from . import Credential, executor, delta
+
+MIN_SIZE = 1024 * 1024 * 1024 # bytes, the files from this size are sent with several streams
+RANGE_SIZE = 128 * 1024 * 1024 # bytes
+CHUNK_SIZE = 1024 * 1024 # bytes read or written at a time
+MAX_STREAMS = 8
+
+
+class MultiStreamError(Exception):
+    pass
+
+
+def is_large(size: int) -> bool:
+    """ returns bool, whether a file of this size is sent with several streams """
+    return size >= MIN_SIZE
+
+
+def get_ranges(size: int, range_size: int=RANGE_SIZE, offset: int=0) -> list:
+    """
+    @size: int, the size of the file
+    @range_size: int, the size of the ranges
+    @offset: int, the ranges before this offset are done already
+    returns a list of tuples of (offset, length)
+    """
+    start = offset - offset % range_size
+    return [(pos, min(range_size, size - pos)) for pos in range(start, size, range_size)]
+
+
+class _Progress:
+    """ records in the journal how much of the file is written without gaps """
+    def __init__(self, path: str, offset: int, journal=None):
+        self.__path = path
+        self.__offset = offset
+        self.__journal = journal
+        self.__done = {} # offset -> length of the ranges written after a gap
+        self.__lock = threading.Lock()
+
+    def done(self, offset: int, length: int):
+        with self.__lock:
+            self.__done[offset] = length
+            moved = False
+            while self.__offset in self.__done:
+                self.__offset += self.__done.pop(self.__offset)
+                moved = True
+            if moved and self.__journal is not None:
+                self.__journal.set_offset(self.__path, self.__offset)
+
+
+def __remote_md5(client, path: str, offset: int=None, length: int=None, creds: Credential=None) -> str:
+    """ returns the md5 hex digest of a remote file or of a byte range of it
+    @client: connected paramiko.SSHClient or None to connect with creds
+    """
+    if offset is None:
+        cmd = f'md5sum {shlex.quote(path)}'
+    else:
+        cmd = f'tail -c +{offset + 1} {shlex.quote(path)} | head -c {length} | md5sum'
+    for line in executor.stream_remote(cmd, creds, client=client):
+        return line.split(' ')[0]
+    raise MultiStreamError(f'No checksum returned for {path}')
+
+
+def __local_md5(path: str, offset: int, length: int) -> str:
+    """ returns the md5 hex digest of a byte range of a local file """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            md5.update(data)
+            length -= len(data)
+    return md5.hexdigest()
+
+
+def __run_streams(creds: Credential, ranges: list, streams: int, send_range, progress: _Progress,
+                  tries: int=1):
+    """ sends the ranges over several connections
+    @send_range: function which takes (client, sftp, offset, length) and returns whether
+        the range was verified
+    """
+    queue = Queue()
+    for item in ranges:
+        queue.put(item)
+
+    def stream(_):
+        client = executor.connect(creds)
+        try:
+            sftp = client.open_sftp()
+            while True:
+                try:
+                    offset, length = queue.get_nowait()
+                except Empty:
+                    return
+                for count in range(tries):
+                    if send_range(client, sftp, offset, length):
+                        break
+                    if count + 1 >= tries:
+                        raise MultiStreamError(f'checksum mismatch for the range {offset}+{length}')
+                    logging.warning('Checksum mismatch for the range %s+%s, sending it again', offset, length)
+                progress.done(offset, length)
+        finally:
+            client.close()
+
+    executor.run_parallel(stream, range(min(streams, len(ranges))), parallelism=streams,
+                          host=creds.hostname)
+
+
+def upload_file(src: str, dst: str, creds: Credential, streams: int=MAX_STREAMS,
+                range_size: int=RANGE_SIZE, tries: int=1, journal=None, throttle=None) -> int:
+    """ uploads a large file over several ssh connections at once
+    @src: str, the local file path
+    @dst: str, the remote file path
+    @creds: ssh credentials
+    @streams: int, how many connections to use
+    @range_size: int, the size of the byte ranges in bytes
+    @tries: int, how many times to send a range which does not match its checksum
+    @journal: optional Journal of the job to resume an interrupted transfer
+    @throttle: optional function which takes a number of bytes and waits until they can be sent
+    returns the number of bytes sent
+    """
+    st = os.stat(src)
+    size = st.st_size
+    tmp_path = f'{dst}.parallel_sync.part'
+    offset = journal.get_offset(src) if journal is not None else 0
+    # the blocks are allocated at once, the data which is already written is kept:
+    executor.remote(f'fallocate -l {size} {shlex.quote(tmp_path)} 2>/dev/null'
+                    f' || truncate -s {size} {shlex.quote(tmp_path)}', creds)
+    try:
+        ranges = __upload_ranges(src, tmp_path, creds, size, offset, streams=streams,
+            range_size=range_size, tries=tries, journal=journal, throttle=throttle)
+    except BaseException:
+        if journal is None: # nothing could resume it
+            executor.remote(f'rm -f {shlex.quote(tmp_path)}', creds)
+        raise
+    executor.remote(f'chmod {stat.S_IMODE(st.st_mode):o} {shlex.quote(tmp_path)}'
+                    f' && touch -m -d @{st.st_mtime} {shlex.quote(tmp_path)}'
+                    f' && mv -f {shlex.quote(tmp_path)} {shlex.quote(dst)}', creds)
+    return sum(length for _, length in ranges)
+
+
+def __upload_ranges(src: str, tmp_path: str, creds: Credential, size: int, offset: int,
+                    streams: int, range_size: int, tries: int, journal, throttle) -> list:
+    """ writes the ranges of src from offset into the remote tmp_path and verifies them
+    returns the list of the ranges sent
+    """
+    ranges = get_ranges(size, range_size, offset)
+    logging.info('Multi-stream upload of %s: %s ranges over %s streams', src, len(ranges), streams)
+
+    def send_range(client, sftp, offset: int, length: int) -> bool:
+        md5 = hashlib.md5()
+        with open(src, 'rb') as local_file, sftp.open(tmp_path, 'r+b') as remote_file:
+            remote_file.set_pipelined(True)
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = local_file.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise MultiStreamError(f'{src} was truncated during the transfer')
+                if throttle is not None:
+                    throttle(len(data))
+                remote_file.write(data)
+                md5.update(data)
+                remaining -= len(data)
+            remote_file.stat() # waits until all the writes are acknowledged
+        return __remote_md5(client, tmp_path, offset, length, creds) == md5.hexdigest()
+
+    __run_streams(creds, ranges, streams, send_range, _Progress(src, offset, journal), tries=tries)
+
+    if __remote_md5(None, tmp_path, creds=creds) != delta.file_md5(src).hex():
+        raise MultiStreamError(f'checksum mismatch for\n{src}\n{tmp_path}')
+    return ranges
+
+
+def download_file(src: str, dst: str, creds: Credential, size: int, streams: int=MAX_STREAMS,
+                  range_size: int=RANGE_SIZE, tries: int=1, journal=None, throttle=None) -> int:
+    """ downloads a large file over several ssh connections at once
+    @src: str, the remote file path
+    @dst: str, the local file path
+    @creds: ssh credentials
+    @size: int, the size of the remote file
+    @streams: int, how many connections to use
+    @range_size: int, the size of the byte ranges in bytes
+    @tries: int, how many times to receive a range which does not match its checksum
+    @journal: optional Journal of the job to resume an interrupted transfer
+    @throttle: optional function which takes a number of bytes and waits until they can be received
+    returns the number of bytes received
+    """
+    tmp_path = f'{dst}.parallel_sync.part'
+    offset = journal.get_offset(src) if journal is not None else 0
+    try:
+        with open(tmp_path, 'ab') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, size)
+            elif f.tell() < size:
+                f.truncate(size)
+        ranges = __download_ranges(src, tmp_path, creds, size, offset, streams=streams,
+            range_size=range_size, tries=tries, journal=journal, throttle=throttle)
+        mode, mtime = executor.remote(f'stat -c "%a %Y" {shlex.quote(src)}', creds).split()
+    except BaseException:
+        if journal is None and os.path.exists(tmp_path): # nothing could resume it
+            os.remove(tmp_path)
+        raise
+    os.chmod(tmp_path, int(mode, 8))
+    os.utime(tmp_path, (float(mtime), float(mtime)))
+    os.replace(tmp_path, dst)
+    return sum(length for _, length in ranges)
+
+
+def __download_ranges(src: str, tmp_path: str, creds: Credential, size: int, offset: int,
+                      streams: int, range_size: int, tries: int, journal, throttle) -> list:
+    """ writes the ranges of the remote src from offset into the local tmp_path and verifies them
+    returns the list of the ranges received
+    """
+    ranges = get_ranges(size, range_size, offset)
+    logging.info('Multi-stream download of %s: %s ranges over %s streams', src, len(ranges), streams)
+
+    def receive_range(client, sftp, offset: int, length: int) -> bool:
+        chunks = [(pos, min(CHUNK_SIZE, offset + length - pos))
+                  for pos in range(offset, offset + length, CHUNK_SIZE)]
+        with sftp.open(src, 'rb') as remote_file, open(tmp_path, 'r+b') as local_file:
+            local_file.seek(offset)
+            for data in remote_file.readv(chunks): # the reads are pipelined
+                if throttle is not None:
+                    throttle(len(data))
+                local_file.write(data)
+        return __remote_md5(client, src, offset, length, creds) == __local_md5(tmp_path, offset, length)
+
+    __run_streams(creds, ranges, streams, receive_range, _Progress(src, offset, journal), tries=tries)
+
+    if __remote_md5(None, src, creds=creds) != delta.file_md5(tmp_path).hex():
+        raise MultiStreamError(f'checksum mismatch for\n{src}\n{tmp_path}')
+    return ranges
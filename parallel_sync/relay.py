@@ -0,0 +1,83 @@
+"""
+This module streams files from one remote host to another
+through the memory of the local machine, without staging them on disk.
+Each worker keeps one sftp session to each host and only holds
+one chunk of a file in memory at a time.
+"""
+import logging
+from . import Credential, executor, bandwidth
+
+CHUNK_SIZE = 1024 * 1024 # bytes
+
+
+def copy_file(src_sftp, dst_sftp, src: str, dst: str, throttle=None) -> int:
+    """
+    @src_sftp, @dst_sftp: paramiko SFTPClient of the source and destination hosts
+    @src: str, the file path on the source host
+    @dst: str, the file path on the destination host
+    @throttle: optional function which takes a number of bytes and waits until they can be sent
+    returns the number of bytes copied
+    """
+    size = 0
+    with src_sftp.open(src, 'rb') as reader, dst_sftp.open(dst, 'wb') as writer:
+        reader.prefetch()
+        writer.set_pipelined(True)
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if throttle is not None:
+                throttle(len(chunk))
+            writer.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def __copy_group(src_creds: Credential, dst_creds: Credential, tries: int, throttle, paths: list) -> int:
+    """ copies a group of files over one pair of connections
+    @paths: list of tuples of (source_path, dest_path)
+    returns the number of bytes copied
+    """
+    if len(paths) < 1:
+        return 0
+    src_client = executor.connect(src_creds)
+    dst_client = executor.connect(dst_creds)
+    total = 0
+    try:
+        src_sftp = src_client.open_sftp()
+        dst_sftp = dst_client.open_sftp()
+        for src, dst in paths:
+            for count in range(tries):
+                try:
+                    total += copy_file(src_sftp, dst_sftp, src, dst, throttle=throttle)
+                    break
+                except (IOError, OSError) as e:
+                    if count + 1 >= tries:
+                        raise
+                    logging.warning('Failed to copy %s: %s', src, e)
+                    logging.info('Re-attempt %s', count + 1)
+    finally:
+        src_client.close()
+        dst_client.close()
+    return total
+
+
+def copy_files(src_creds: Credential, dst_creds: Credential, paths: list,
+               parallelism: int=10, tries: int=1, priority: int=None, bwlimit=None) -> int:
+    """
+    @src_creds, @dst_creds: ssh credentials of the source and destination hosts
+    @paths: list of tuples of (source_path, dest_path)
+    @parallelism: int, how many files to copy at the same time
+    @tries: int, how many times to try each file
+    @priority: scheduler.HIGH, NORMAL or LOW
+    @bwlimit: the bandwidth limit of the job in bytes per second, a bandwidth.TokenBucket or None
+    returns the number of bytes copied
+    """
+    hosts = (src_creds.hostname, dst_creds.hostname)
+    throttle = bandwidth.get_throttle(hosts, bandwidth.get_bucket(bwlimit))
+    groups = [paths[ind::parallelism] for ind in range(min(parallelism, len(paths)))]
+    sizes = []
+    def copy(group):
+        sizes.append(__copy_group(src_creds, dst_creds, tries, throttle, group))
+    executor.run_parallel(copy, groups, parallelism=parallelism, host=hosts, priority=priority)
+    return sum(sizes)
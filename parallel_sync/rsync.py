@@ -4,49 +4,363 @@ from or to a remote host
 """
 import os
 import re
-import hashlib
+import time
+import shlex
+import shutil
+import fnmatch
+import posixpath
 import platform
 import subprocess
-from multiprocessing.pool import ThreadPool
-from functools import partial
+import contextlib
+from functools import partial, lru_cache
 import logging
-from . import Credential, executor
-logging.basicConfig(level='INFO')
+from . import Credential, executor, delta, tracing, relay, scheduler, bandwidth, localcopy, multistream,\
+    dedup as dedup_files, compare as compare_files
+from .journal import Journal
+from .filelist import FileList, PathPairs
+
+TRANSFER_MODES = ['stream', 'direct']
+__DELETED_FOLDER = 'deleted_folder' # the value of a deleted folder in the watch changes
+COMMAND_CHUNK = 1000 # number of transfer commands built at once
 
 
 def upload(src: str, dst: str, creds: Credential,
     tries: int=1, include: list='*', exclude: list=None,
     parallelism: int=10, extract: bool=False,
-    validate: bool=False, additional_params: str='-c'):
+    validate: bool=False, additional_params: str='-c', dedup: str=None, agent: bool=False,
+    priority: int=scheduler.NORMAL, job_id: str=None, journal_dir: str=None, bwlimit=None,
+    compare: str=None):
     """
     @src, @dst: source and destination directories
-    @creds: ssh credentials
+    @creds: ssh credentials. If it is None or the current user on localhost,
+        the files are copied locally without ssh
     @validate: bool - if True, it will perform a checksum comparison after the operation
     @additional_params: str - additional parameters to pass on to rsync
+    @dedup: str - 'link' or 'copy'. If specified, identical files are only transferred once
+        and the duplicates are created on the destination with hard links or copies
+    @agent: bool - if True, a helper agent is started on the remote host to do the bulk
+        operations (listing, creating folders, hashing, extraction) over a single ssh channel
+    @priority: scheduler.HIGH, NORMAL or LOW - how this job is served when
+        other jobs run in the same process
+    @job_id: str - if specified, the progress of the job is journaled and running it
+        again with the same job_id after an interruption resumes it where it stopped
+    @journal_dir: str - where the journals are kept. Default is ~/.parallel_sync/journals
+    @bwlimit: the bandwidth limit of the job in bytes per second, or a bandwidth.TokenBucket
+        whose rate can be changed while the job runs
+    @compare: str - 'stat' or 'checksum'. If specified, the destination files are listed in bulk
+        before the transfer and the files which have the same size and modification time
+        (or md5) are skipped
     """
     __transfer(src, dst, creds, upstream=True,\
         tries=tries, include=include, exclude=exclude, parallelism=parallelism,\
-        extract=extract, validate=validate, additional_params=additional_params)
+        extract=extract, validate=validate, additional_params=additional_params, dedup=dedup, agent=agent,\
+        priority=priority, job_id=job_id, journal_dir=journal_dir, bwlimit=bwlimit, compare=compare)
 
 
 def download(src: str, dst: str, creds: Credential,
     tries: int=1, include: str='*', exclude: list=None,
     parallelism: int=10, extract: bool=False,
-    validate: bool=False, additional_params: str='-c'):
+    validate: bool=False, additional_params: str='-c', dedup: str=None, agent: bool=False,
+    priority: int=scheduler.NORMAL, job_id: str=None, journal_dir: str=None, bwlimit=None,
+    compare: str=None):
     """
     @src, @dst: source and destination directories
-    @creds: ssh credentials
+    @creds: ssh credentials. If it is None or the current user on localhost,
+        the files are copied locally without ssh
     @validate: bool - if True, it will perform a checksum comparison after the operation
     @additional_params: str - additional parameters to pass on to rsync
+    @dedup: str - 'link' or 'copy'. If specified, identical files are only transferred once
+        and the duplicates are created on the destination with hard links or copies
+    @agent: bool - if True, a helper agent is started on the remote host to do the bulk
+        operations (listing, creating folders, hashing, extraction) over a single ssh channel
+    @priority: scheduler.HIGH, NORMAL or LOW - how this job is served when
+        other jobs run in the same process
+    @job_id: str - if specified, the progress of the job is journaled and running it
+        again with the same job_id after an interruption resumes it where it stopped
+    @journal_dir: str - where the journals are kept. Default is ~/.parallel_sync/journals
+    @bwlimit: the bandwidth limit of the job in bytes per second, or a bandwidth.TokenBucket
+        whose rate can be changed while the job runs
+    @compare: str - 'stat' or 'checksum'. If specified, the destination files are listed in bulk
+        before the transfer and the files which have the same size and modification time
+        (or md5) are skipped
     """
     __transfer(src, dst, creds, upstream=False,
         tries=tries, include=include, exclude=exclude, parallelism=parallelism, extract=extract,
-        validate=validate, additional_params=additional_params)
+        validate=validate, additional_params=additional_params, dedup=dedup, agent=agent,
+        priority=priority, job_id=job_id, journal_dir=journal_dir, bwlimit=bwlimit, compare=compare)
+
+
+def transfer(src_creds: Credential, src: str, dst_creds: Credential, dst: str,
+    tries: int=1, include: str='*', exclude: list=None, parallelism: int=10,
+    validate: bool=False, mode: str='stream', additional_params: str='-c',
+    remote_key_filename: str=None, priority: int=scheduler.NORMAL, bwlimit=None):
+    """ copies files from one remote host to another without staging them on the local machine
+    @src_creds: ssh credentials of the source host
+    @src: the file or folder on the source host
+    @dst_creds: ssh credentials of the destination host
+    @dst: the destination folder on the destination host
+    @validate: bool - if True, it will perform a checksum comparison after the operation
+    @mode: str - 'stream' relays the bytes through the memory of the local machine
+        over ssh channels to both hosts.
+        'direct' runs rsync on the source host to push to the destination host,
+        so the source host must be able to ssh to the destination host.
+    @additional_params: str - additional parameters to pass on to rsync in 'direct' mode
+    @remote_key_filename: str - in 'direct' mode, the ssh key file on the source host
+        to connect to the destination host. By default, ssh on the source host uses its own keys.
+    @priority: scheduler.HIGH, NORMAL or LOW
+    @bwlimit: the bandwidth limit of the job in bytes per second or a bandwidth.TokenBucket
+    """
+    if src is None:
+        raise ValueError('src cannot be None')
+
+    if dst is None:
+        raise ValueError('dst cannot be None')
+
+    if mode not in TRANSFER_MODES:
+        raise ValueError(f'Invalid mode: {mode}. It must be one of {TRANSFER_MODES}')
+
+    with tracing.span('remote_transfer', host=src_creds.hostname, dst_host=dst_creds.hostname,
+                      src=src, dst=dst, mode=mode):
+        with tracing.span('find_remote', host=src_creds.hostname, path=src):
+            folder_srcs, srcs = executor.find_remote(src, src_creds, include=include, exclude=exclude)
+
+        folder_dsts = set([__get_dst_path(src, s, dst) for s in folder_srcs if s!=src] + [dst])
+        with tracing.span('make_dirs', host=dst_creds.hostname, count=len(folder_dsts)):
+            executor.make_dirs_remote(folder_dsts, dst_creds)
+
+        if len(srcs) < 1:
+            logging.warning('No source files found to transfer.')
+            return
+
+        paths = [(s_path, __get_dst_path(src, s_path, dst)) for s_path in srcs]
+        with tracing.span('transfer', host=dst_creds.hostname, count=len(paths), parallelism=parallelism) as span:
+            if mode == 'direct':
+                __push_direct(src_creds, dst_creds, paths, tries=tries, parallelism=parallelism,
+                    additional_params=additional_params, remote_key_filename=remote_key_filename,
+                    bwlimit=bandwidth.get_bucket(bwlimit))
+            else:
+                span.set(bytes=relay.copy_files(src_creds, dst_creds, paths,
+                    parallelism=parallelism, tries=tries, priority=priority, bwlimit=bwlimit))
+
+        if validate:
+            with tracing.span('validate_checksums', host=dst_creds.hostname, count=len(paths)):
+                __validate_remote(src_creds, dst_creds, paths)
+
+
+def __push_direct(src_creds: Credential, dst_creds: Credential, paths: list,
+    tries: int=1, parallelism: int=10, additional_params: str='-c', remote_key_filename: str=None,
+    bwlimit: bandwidth.TokenBucket=None):
+    """ runs rsync on the source host to push the files to the destination host
+    @paths: list of tuples of (source_path, dest_path)
+    @bwlimit: the TokenBucket of the job or None. The parallel commands share it evenly.
+    """
+    ssh = f'ssh -p {dst_creds.port} -o StrictHostKeyChecking=no -o ServerAliveInterval=100'
+    if remote_key_filename is not None:
+        ssh = f'{ssh} -i {shlex.quote(remote_key_filename)}'
+    hosts = (src_creds.hostname, dst_creds.hostname)
+    with bandwidth.register_job(hosts, parallelism),\
+            bandwidth.command_rate(hosts, bwlimit, parallelism=parallelism,
+                                   count=min(parallelism, len(paths))) as rate:
+        if rate is not None:
+            additional_params = f'{additional_params} --bwlimit={max(1, int(rate / 1024))}'
+        cmds = [f'rsync {additional_params} -e {shlex.quote(ssh)} {shlex.quote(src)} '
+                f'{dst_creds.username}@{dst_creds.hostname}:"{dst}"' for src, dst in paths]
+        for count in range(tries):
+            try:
+                executor.run_remote_batch(cmds, src_creds, parallelism=parallelism)
+                return
+            except Exception as e:
+                if count + 1 >= tries:
+                    raise
+                logging.warning('Direct transfer failed: %s', e)
+                logging.info('Re-attempt %s', count + 1)
+
+
+def __validate_remote(src_creds: Credential, dst_creds: Credential, paths: list):
+    """ compares the checksums of the files on both remote hosts
+    @paths: list of tuples of (source_path, dest_path)
+    if fails, it raises a CheckSumMismatch
+    """
+    logging.info('Checksum validation...')
+    src_checksums = dedup_files.hash_remote([src for src, _ in paths], src_creds)
+    dst_checksums = dedup_files.hash_remote([dst for _, dst in paths], dst_creds)
+    for src, dst in paths:
+        # hash_remote leaves out the files which are missing or cannot be read
+        if dst not in dst_checksums:
+            raise CheckSumMismatch(f'checksum mismatch for\n{src}\n{dst} (missing or unreadable)')
+        if src_checksums.get(src) != dst_checksums[dst]:
+            raise CheckSumMismatch(f'checksum mismatch for\n{src}\n{dst}')
+        logging.info('Verified: filename=%s checksum=%s', os.path.basename(src), src_checksums[src])
+
+
+def watch(src: str, dst: str, creds: Credential,
+    tries: int=1, include: str='*', exclude: list=None,
+    parallelism: int=10, delete: bool=False, validate: bool=False,
+    additional_params: str='-c', debounce: float=0.5, max_delay: float=5.0, stop=None, bwlimit=None):
+    """ uploads the src folder and then keeps uploading the files which change in it.
+    It uses Linux inotify so only the changed files are pushed, without walking the tree again.
+    @src, @dst: source and destination directories
+    @creds: ssh credentials
+    @include: wild card pattern matched against the file names
+    @exclude: list of wild card patterns to exclude files or folders
+    @delete: bool - if True, files or folders deleted from src are also deleted from dst
+    @validate: bool - if True, it will perform a checksum comparison after each batch
+    @additional_params: str - additional parameters to pass on to rsync
+    @debounce: float - seconds without any new change before a batch is pushed
+    @max_delay: float - seconds after the first change at which a batch is pushed
+        even if the files keep changing
+    @stop: threading.Event - if specified, the watch returns once it is set.
+        Otherwise it runs until it is interrupted.
+    @bwlimit: the bandwidth limit in bytes per second, or a bandwidth.TokenBucket
+        whose rate can be changed while the watch runs
+    """
+    from . import inotify
+    if creds is None:
+        creds = localcopy.get_credentials()
+    if not os.path.isdir(src):
+        raise ValueError(f'src must be a folder: {src}')
+    src = os.path.abspath(src)
+    bwlimit = bandwidth.get_bucket(bwlimit)
+
+    # the watch is started before the initial sync so that no change is missed:
+    with inotify.Watcher(src) as watcher:
+        __transfer(src, dst, creds, upstream=True, tries=tries, include=include,
+            exclude=exclude, parallelism=parallelism, validate=validate,
+            additional_params=additional_params, bwlimit=bwlimit)
+        pending = {}
+        while stop is None or not stop.is_set():
+            changes, overflow = __collect_changes(watcher, debounce, max_delay, stop)
+            if overflow:
+                logging.warning('Watch: too many changes at once, doing a full sync.')
+                # the folders created while the events were dropped are not watched yet:
+                watcher.add_tree(src)
+                __transfer(src, dst, creds, upstream=True, tries=tries, include=include,
+                    exclude=exclude, parallelism=parallelism, validate=validate,
+                    additional_params=additional_params, bwlimit=bwlimit)
+                pending = {}
+                continue
+
+            pending.update(changes)
+            if len(pending) < 1:
+                continue
+            try:
+                __push_changes(src, dst, creds, pending, tries=tries, include=include,
+                    exclude=exclude, parallelism=parallelism, delete=delete,
+                    validate=validate, additional_params=additional_params, bwlimit=bwlimit)
+                pending = {}
+            except Exception as e:
+                # the changes are kept and pushed again with the next batch:
+                logging.error('Watch: failed to push %s changes: %s', len(pending), e)
+
+
+def __collect_changes(watcher, debounce: float, max_delay: float, stop=None) -> tuple:
+    """ waits for changes and coalesces them into one batch
+    @watcher: inotify.Watcher
+    @debounce: float - seconds without any new change before the batch is complete
+    @max_delay: float - seconds after the first change at which the batch is complete
+    @stop: threading.Event - returns an empty batch once it is set
+    returns a tuple of (changes, overflow) where changes is a dictionary of
+        path to True if the file changed or False if it was deleted
+        and overflow is True if the kernel dropped events
+    """
+    from . import inotify
+    changes = {}
+    overflow = False
+    first = None
+    while True:
+        if first is None:
+            if stop is not None and stop.is_set():
+                break
+            timeout = 1.0 # to check the stop event regularly
+        else:
+            timeout = max(0.0, min(debounce, first + max_delay - time.time()))
+
+        events = watcher.read(timeout)
+        if len(events) < 1:
+            if first is not None:
+                break
+            continue
+
+        if first is None:
+            first = time.time()
+        for path, mask in events:
+            if path is None: # IN_Q_OVERFLOW
+                overflow = True
+            elif mask & inotify.IN_ISDIR:
+                if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    for file_path in watcher.add_tree(path):
+                        changes[file_path] = True
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    changes[path] = __DELETED_FOLDER
+            elif mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_ATTRIB):
+                changes[path] = True
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                changes[path] = False
+
+        if time.time() - first >= max_delay:
+            break
+    return changes, overflow
+
+
+def __remove_local(path: str):
+    """ removes a local file or folder if it exists """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def __push_changes(src: str, dst: str, creds: Credential, changes: dict,
+    tries: int=1, include: str='*', exclude: list=None, parallelism: int=10,
+    delete: bool=False, validate: bool=False, additional_params: str='-c',
+    bwlimit: bandwidth.TokenBucket=None):
+    """ uploads the changed files and deletes the deleted ones
+    @src, @dst: source and destination directories
+    @creds: ssh credentials
+    @changes: dictionary of path to True if the file changed, False if it was deleted
+        or __DELETED_FOLDER if it was a folder which was deleted
+    """
+    uploads = []
+    deletes = []
+    for path, changed in sorted(changes.items()):
+        if executor.is_excluded(path, exclude):
+            continue
+        if changed == __DELETED_FOLDER: # include is a pattern of file names, it does not apply to folders
+            if not os.path.lexists(path):
+                deletes.append(path)
+            continue
+        if not fnmatch.fnmatch(os.path.basename(path), include):
+            continue
+        if changed and os.path.isfile(path):
+            uploads.append(path)
+        elif not changed and not os.path.lexists(path):
+            deletes.append(path)
+
+    if len(uploads) > 0:
+        paths = [(path, __get_dst_path(src, path, dst)) for path in uploads]
+        __make_dirs({posixpath.dirname(dst_path) for _, dst_path in paths}, creds, True)
+        __transfer_paths(paths, creds, True, tries=tries, parallelism=parallelism,
+            validate=validate, additional_params=additional_params, bwlimit=bwlimit)
+
+    if delete and len(deletes) > 0:
+        dst_paths = [__get_dst_path(src, path, dst) for path in deletes]
+        if localcopy.is_local(creds):
+            for dst_path in dst_paths:
+                __remove_local(dst_path)
+        else:
+            cmds = [f'rm -rf {shlex.quote(dst_path)}' for dst_path in dst_paths]
+            executor.run_remote_batch(cmds, creds, parallelism=parallelism)
+    else:
+        deletes = []
+
+    logging.info('Watch: uploaded %s files, deleted %s paths', len(uploads), len(deletes))
 
 
 def __transfer(src: str, dst: str, creds: Credential, upstream: bool=True,
     tries: int=1, include: str='*', exclude: list=None, parallelism: int=10, extract: bool=False,
-    validate: bool=False, additional_params: str='-c'):
+    validate: bool=False, additional_params: str='-c', dedup: str=None, agent: bool=False,
+    priority: int=scheduler.NORMAL, job_id: str=None, journal_dir: str=None, bwlimit=None,
+    compare: str=None):
     """
     @src: str path of a file or folder for source
     @dst: path of a file or folder for destination
@@ -59,36 +373,153 @@ def __transfer(src: str, dst: str, creds: Credential, upstream: bool=True,
     @extract: bool - whether to extract tar or zip files after transfer
     @validate: whether to do a checksum validation at the end
     @additional_params: str - additional parameters to pass on to rsync
+    @dedup: str - 'link' or 'copy' to transfer identical files only once
+    @agent: bool - whether to use a remote helper agent for the bulk operations
+    @priority: scheduler.HIGH, NORMAL or LOW
+    @job_id: str - the id of the journal which makes the job resumable
+    @journal_dir: str - where the journals are kept
+    @bwlimit: the bandwidth limit of the job in bytes per second or a bandwidth.TokenBucket
+    @compare: str - 'stat' or 'checksum' to skip the files which are the same on the destination
     """
     if src is None:
         raise ValueError('src cannot be None')
         
     if dst is None:
         raise ValueError('dst cannot be None')
-        
-    srcs = []
-    if upstream and os.path.isfile(src):
-        srcs = [src]
-    else:
-        if upstream: # upload
-            folder_srcs, srcs = executor.find_local(src, include=include, exclude=exclude)
-        else: # download
-            folder_srcs, srcs = executor.find_remote(src, creds, include=include, exclude=exclude)
-
-    folder_dsts = set([__get_dst_path(src, s, dst) for s in folder_srcs if s!=src] + [dst])
-    __make_dirs(folder_dsts, creds, upstream)
-
-    if len(srcs) < 1:
-        logging.warning('No source files found to transfer.')
-        return
 
-    paths = []
-    for s_path in srcs:
-        paths.append((s_path, __get_dst_path(src, s_path, dst)))
+    if creds is None:
+        creds = localcopy.get_credentials()
+    if localcopy.is_local(creds):
+        # both sides are on this machine, the source is listed and read like for an upload:
+        upstream = True
+        agent = False
+
+    journal = None
+    if job_id is not None:
+        journal = Journal(job_id, journal_dir)
+        journal.open({'src': src, 'dst': dst, 'host': creds.hostname, 'upstream': upstream,
+                      'include': include, 'exclude': list(exclude or [])})
+        if '--partial' not in additional_params:
+            # rsync keeps the partially transferred files so that they are resumed:
+            additional_params = f'{additional_params} --partial'
+
+    try:
+        __transfer_job(src, dst, creds, upstream, tries=tries, include=include, exclude=exclude,
+            parallelism=parallelism, extract=extract, validate=validate,
+            additional_params=additional_params, dedup=dedup, agent=agent,
+            priority=priority, journal=journal, bwlimit=bandwidth.get_bucket(bwlimit), compare=compare)
+    finally:
+        if journal is not None:
+            journal.close()
+    if journal is not None:
+        journal.remove()
+
+
+def __transfer_job(src: str, dst: str, creds: Credential, upstream: bool, tries: int=1,
+    include: str='*', exclude: list=None, parallelism: int=10, extract: bool=False,
+    validate: bool=False, additional_params: str='-c', dedup: str=None, agent: bool=False,
+    priority: int=scheduler.NORMAL, journal: Journal=None, bwlimit: bandwidth.TokenBucket=None,
+    compare: str=None):
+    """ runs the job of __transfer
+    @journal: Journal of the job or None. If it already has the file list of the job,
+        the listing is skipped and only the files which are not done are transferred.
+    @bwlimit: the TokenBucket of the job or None
+    @compare: str - 'stat' or 'checksum' to skip the files which are the same on the destination
+    """
+    if compare is not None and compare not in compare_files.MODES:
+        raise ValueError(f'Invalid compare mode: {compare}. It must be one of {compare_files.MODES}')
+    if compare == 'stat' and not localcopy.is_local(creds) and not __keeps_times(additional_params):
+        logging.warning("compare='stat' only skips files whose modification time was kept: "
+                        "pass additional_params with -t or -a (rsync must be installed)")
+    remote_agent = contextlib.nullcontext()
+    if agent:
+        from .agent import RemoteAgent
+        remote_agent = RemoteAgent(creds)
+
+    job = 'upload' if upstream else 'download'
+    with tracing.span(job, host=creds.hostname, src=src, dst=dst), remote_agent as remote_agent:
+        if journal is not None and journal.planned:
+            # the listing and the folders were done by an earlier run of the job:
+            srcs = journal.plan
+        else:
+            folder_srcs = []
+            srcs = []
+            if upstream and os.path.isfile(src):
+                srcs = [src]
+            else:
+                if upstream: # upload
+                    with tracing.span('find_local', path=src):
+                        folder_srcs, srcs = executor.find_local(src, include=include, exclude=exclude)
+                else: # download
+                    with tracing.span('find_remote', host=creds.hostname, path=src):
+                        if remote_agent is not None:
+                            folder_srcs, srcs = remote_agent.walk(src, include=include, exclude=exclude)
+                        else:
+                            folder_srcs, srcs = executor.find_remote(src, creds, include=include, exclude=exclude)
+
+            folder_dsts = set([__get_dst_path(src, s, dst) for s in folder_srcs if s!=src] + [dst])
+            with tracing.span('make_dirs', host=creds.hostname, count=len(folder_dsts)):
+                __make_dirs(folder_dsts, creds, upstream, agent=remote_agent)
+            if journal is not None:
+                journal.write_plan(srcs)
+
+        if len(srcs) < 1:
+            logging.warning('No source files found to transfer.')
+            return
+
+        # the destination paths are computed lazily, they are not kept in memory:
+        get_dst = partial(__get_dst_path, src, dst_dir=dst)
+        paths = PathPairs(srcs, get_dst)
+        done_paths = None
+        if journal is not None:
+            pending = journal.pending()
+            if len(pending) < len(srcs):
+                paths = PathPairs(pending, get_dst)
+                done_paths = PathPairs(srcs, get_dst).select(bytearray(journal.is_done(path) for path in srcs))
+
+        if compare is not None:
+            # one bulk listing of the destination instead of one transfer command per unchanged file:
+            with tracing.span('compare', host=creds.hostname, count=len(paths)) as span:
+                changed, unchanged = compare_files.find_changed(paths.srcs, get_dst, creds, upstream, dst,
+                    mode=compare, parallelism=parallelism, agent=remote_agent)
+                span.set(skipped=len(unchanged))
+            logging.info('%s of %s files are unchanged and skipped', len(unchanged), len(paths))
+            if len(unchanged) > 0:
+                paths = PathPairs(changed, get_dst)
+                done_srcs = FileList()
+                if done_paths is not None:
+                    done_srcs.extend(done_paths.srcs)
+                done_srcs.extend(unchanged)
+                done_paths = PathPairs(done_srcs, get_dst)
+                if journal is not None:
+                    for path in unchanged:
+                        journal.done(path)
+
+        duplicates = None
+        if dedup is not None:
+            if dedup not in dedup_files.MODES:
+                raise ValueError(f'Invalid dedup mode: {dedup}. It must be one of {dedup_files.MODES}')
+            with tracing.span('dedup', host=creds.hostname, count=len(paths)):
+                paths, duplicates = dedup_files.find_duplicates(paths, creds, upstream,
+                    parallelism=parallelism, agent=remote_agent)
+
+        __transfer_paths(paths, creds, upstream,
+            tries=tries, parallelism=parallelism, extract=extract,
+            validate=validate, additional_params=additional_params,
+            duplicates=duplicates, dedup=dedup, agent=remote_agent, priority=priority,
+            journal=journal, done_paths=done_paths, bwlimit=bwlimit)
+
+def __keeps_times(additional_params: str) -> bool:
+    """ returns bool, whether the transfer commands keep the modification times of the files """
+    if not __is_rsync_installed(): # scp and the delta engine do not keep them
+        return False
+    for arg in shlex.split(additional_params or ''):
+        if arg in ('--times', '--archive'):
+            return True
+        if arg.startswith('-') and not arg.startswith('--') and ('t' in arg or 'a' in arg):
+            return True
+    return False
 
-    __transfer_paths(paths, creds, upstream,
-        tries=tries, parallelism=parallelism, extract=extract,
-        validate=validate, additional_params=additional_params)
 
 def __get_dst_path(src: str, src_path:str, dst_dir: str):
     """
@@ -114,20 +545,24 @@ def __get_dst_path(src: str, src_path:str, dst_dir: str):
     return f'{dst_dir}/{postfix}'
 
 
-def __make_dirs(folders: set, creds: Credential, upstream: bool):
+def __make_dirs(folders: set, creds: Credential, upstream: bool, agent=None):
     """
     @folders: set of folder paths
     @creds: ssh credentials
     @upstream: bool, whether to upload or downolad
-    Creates directories on the remote machine
+    @agent: optional remote agent to create all the folders in one request
+    Creates directories on the destination machine
     """
-    if upstream:
-        executor.make_dirs_remote(folders, creds=creds)
-    else:
+    if not upstream or localcopy.is_local(creds):
         for folder in folders:
             os.makedirs(folder, exist_ok=True)
+    elif agent is not None:
+        agent.mkdirs(sorted(folders))
+    else:
+        executor.make_dirs_remote(folders, creds=creds)
 
 
+@lru_cache(maxsize=None)
 def __is_rsync_installed():
     """
     returns bool, whether rsync is installed on the local machine or now
@@ -175,10 +610,169 @@ def __get_transfer_commands(creds: Credential, upstream: bool,
 
 
 
+def __use_delta(src: str, dst: str, upstream: bool) -> bool:
+    """
+    @src, @dst: the source and destination paths of a file
+    @upstream: bool whether it is upload or download
+    returns bool, whether the file is large enough to be sent with the delta engine
+        For downloads, the local destination file is the basis of the delta
+        so it must already exist.
+    """
+    local_path = src if upstream else dst
+    return os.path.isfile(local_path) and os.path.getsize(local_path) >= delta.MIN_SIZE
+
+
+def __delta_transfer(creds: Credential, upstream: bool, tries: int, paths: tuple,
+                     bwlimit: bandwidth.TokenBucket=None):
+    """
+    @creds: ssh Credentials
+    @upstream: bool whether it is upload or download
+    @tries: int, how many times to try
+    @paths: tuple of (source_path, dest_path)
+    @bwlimit: the TokenBucket of the job or None
+    """
+    src, dst = paths
+    throttle = bandwidth.get_throttle(creds.hostname, bwlimit)
+    for count in range(tries):
+        try:
+            with tracing.span('file', host=creds.hostname, src=src, dst=dst, method='delta') as span:
+                if upstream:
+                    literal = delta.upload_file(src, dst, creds, throttle=throttle)
+                    logging.info('Delta upload: filename=%s sent=%s bytes', os.path.basename(src), literal)
+                    span.set(bytes=literal, exit_code=0)
+                else:
+                    delta.download_file(src, dst, creds, throttle=throttle)
+                    span.set(bytes=os.path.getsize(dst), exit_code=0)
+            return
+        except Exception as e:
+            if count + 1 >= tries:
+                raise
+            logging.warning('Delta transfer failed for %s: %s', src, e)
+            logging.info('Re-attempt %s', count + 1)
+
+
+def __run_transfer_command(creds: Credential, upstream: bool, tries: int, item: tuple,
+                           bwlimit: bandwidth.TokenBucket=None, parallelism: int=10):
+    """
+    @creds: ssh Credentials
+    @upstream: bool whether it is upload or download
+    @tries: int, how many times to try
+    @item: tuple of (command, (source_path, dest_path))
+    @bwlimit: the TokenBucket of the job or None
+    @parallelism: int, how many commands of the job run at the same time
+    """
+    cmd, (src, dst) = item
+    args = shlex.split(cmd) # run directly, there is no need of a shell per file
+    with bandwidth.command_rate(creds.hostname, bwlimit, parallelism=parallelism) as rate:
+        args = bandwidth.get_command_args(args, rate)
+        if not tracing.is_enabled():
+            executor.local(args, tries=tries)
+            return
+
+        with tracing.span('file', host=creds.hostname, src=src, dst=dst) as span:
+            executor.local(args, tries=tries)
+            local_path = src if upstream else dst
+            span.set(exit_code=0,
+                     bytes=os.path.getsize(local_path) if os.path.isfile(local_path) else 0)
+
+
+def __iter_transfer_tasks(creds: Credential, upstream: bool, paths, tries: int=1,
+                          additional_params: str='-c', bwlimit: bandwidth.TokenBucket=None,
+                          parallelism: int=10):
+    """
+    @paths: iterable of tuples of (source_path, dest_path)
+    @parallelism: int, how many transfers of the job run at the same time
+    yields one tuple of (source_path, function which transfers it) per file.
+        The commands are built in chunks as the workers consume them,
+        so they never all exist in memory at the same time.
+    """
+    if localcopy.is_local(creds):
+        for src, dst in paths:
+            yield src, partial(localcopy.copy_file, src, dst)
+        return
+
+    # scp would re-send whole files so large files only send their changes:
+    use_delta = not __is_rsync_installed()
+    chunk = []
+    for src, dst in paths:
+        if use_delta and __use_delta(src, dst, upstream):
+            yield src, partial(__delta_transfer, creds, upstream, tries, (src, dst), bwlimit=bwlimit)
+            continue
+        chunk.append((src, dst))
+        if len(chunk) >= COMMAND_CHUNK:
+            yield from __get_command_tasks(creds, upstream, chunk, tries, additional_params, bwlimit, parallelism)
+            chunk = []
+    if len(chunk) > 0:
+        yield from __get_command_tasks(creds, upstream, chunk, tries, additional_params, bwlimit, parallelism)
+
+
+def __get_command_tasks(creds: Credential, upstream: bool, paths: list, tries: int,
+                        additional_params: str, bwlimit: bandwidth.TokenBucket=None,
+                        parallelism: int=10) -> list:
+    """ returns one tuple of (source_path, function which runs its transfer command) per path """
+    cmds = __get_transfer_commands(creds, upstream, paths, additional_params)
+    return [(item[1][0], partial(__run_transfer_command, creds, upstream, tries, item,
+                                 bwlimit=bwlimit, parallelism=parallelism))
+            for item in zip(cmds, paths)]
+
+
+def __split_large_files(paths, upstream: bool, large: list):
+    """ yields the (source_path, dest_path) of the files which are sent by one process each
+    and adds the very large files to large as tuples of (source_path, dest_path, size)
+    @paths: sequence of tuples of (source_path, dest_path). The sizes of the remote
+        files are only known if it is a PathPairs of a FileList.
+    @upstream: bool whether it is upload or download
+    """
+    sizes = None
+    if isinstance(paths, PathPairs) and isinstance(paths.srcs, FileList):
+        sizes = paths.srcs.sizes
+    for ind, (src, dst) in enumerate(paths):
+        size = sizes[ind] if sizes is not None else -1
+        if size < 0 and upstream and os.path.isfile(src):
+            size = os.path.getsize(src)
+        if multistream.is_large(size):
+            large.append((src, dst, size))
+        else:
+            yield src, dst
+
+
+def __use_multistream(src: str, dst: str, creds: Credential, upstream: bool,
+                      journal: Journal=None) -> bool:
+    """ returns bool, whether a very large file is sent with multistream.
+        It is only used when the destination is missing or when an earlier run
+        of the job left some ranges to send.
+    """
+    if journal is not None and journal.get_offset(src) > 0:
+        return True
+    if not upstream:
+        return not os.path.exists(dst)
+    return executor.remote(f'test -e {shlex.quote(dst)} && echo 1 || true', creds).strip() != b'1'
+
+
+def __multistream_transfer(creds: Credential, upstream: bool, paths: tuple, size: int,
+                           parallelism: int=10, tries: int=1, journal: Journal=None,
+                           bwlimit: bandwidth.TokenBucket=None) -> int:
+    """ sends a very large file over several ssh connections at once
+    @paths: tuple of (source_path, dest_path)
+    @size: int, the size of the file
+    returns the number of bytes sent
+    """
+    src, dst = paths
+    streams = min(parallelism, multistream.MAX_STREAMS)
+    throttle = bandwidth.get_throttle(creds.hostname, bwlimit)
+    if upstream:
+        return multistream.upload_file(src, dst, creds, streams=streams, tries=tries,
+                                       journal=journal, throttle=throttle)
+    return multistream.download_file(src, dst, creds, size, streams=streams, tries=tries,
+                                     journal=journal, throttle=throttle)
+
+
 def __transfer_paths(paths: list, creds: Credential, upstream: bool=True, tries: int=1,
-    parallelism: int=10, extract: bool=False, validate: bool=False, additional_params: str='-c'):
+    parallelism: int=10, extract: bool=False, validate: bool=False, additional_params: str='-c',
+    duplicates: list=None, dedup: str='link', agent=None, priority: int=scheduler.NORMAL,
+    journal: Journal=None, done_paths: list=None, bwlimit: bandwidth.TokenBucket=None):
     """
-    @paths: list of tuples of (source_path, dest_path)
+    @paths: sequence of tuples of (source_path, dest_path) such as a list or PathPairs
         note that source_path can be either local or remote
     @creds: ssh Credentials
     @upstream: bool whether it is upload or download
@@ -188,87 +782,192 @@ def __transfer_paths(paths: list, creds: Credential, upstream: bool=True, tries:
     @extract: bool, whether after transfering the file it needs to be extracted
     @validate: bool, whether you want to do a checksum validation after the transfer
     @additional_params: str. You can pass additional rsync parameters. The default is just '-c'
+    @duplicates: list of (source_path, dest_path, canonical_dest_path) of files
+        that are not transferred but created from the already transferred canonical file
+    @dedup: str, 'link' or 'copy', how to create the duplicates
+    @agent: optional remote agent used for the validation and extraction
+    @priority: scheduler.HIGH, NORMAL or LOW
+    @journal: optional Journal where the transferred files and the finished phases are recorded
+    @done_paths: sequence of tuples of (source_path, dest_path) which an earlier run of the job
+        transferred. They are not transferred again but they are validated and extracted.
+    @bwlimit: the TokenBucket of the job or None
     """
-    if len(paths) < 1:
+    if len(paths) < 1 and not done_paths:
         raise ValueError('You did not specify any paths')
 
 
     if creds.hostname in ['', None]:
         raise Exception('The host is not specified.')
 
-    # __make_dirs(paths, creds, upstream)
-    cmds = __get_transfer_commands(creds, upstream, paths, additional_params)
-    pool = ThreadPool(processes=parallelism)
-    func = partial(executor.local, tries=tries)
-    pool.map(func, cmds)
-    pool.close()
-    pool.join()
-
-    if validate and len(paths) > 0:
-        validate_checksums(creds, upstream, parallelism, paths)
-
-    if extract:
-        extract_files(creds, upstream, paths)
+    def run(item):
+        src, task = item
+        task()
+        if journal is not None:
+            journal.done(src)
+
+    with tracing.span('transfer', host=creds.hostname, count=len(paths), parallelism=parallelism),\
+            bandwidth.register_job(creds.hostname, parallelism):
+        large = [] # the very large files, each one is sent over several streams
+        if parallelism > 1 and not localcopy.is_local(creds):
+            pool_paths = __split_large_files(paths, upstream, large)
+        else:
+            pool_paths = paths
+        tasks = __iter_transfer_tasks(creds, upstream, pool_paths, tries, additional_params, bwlimit,
+                                      parallelism=parallelism)
+        executor.run_parallel(run, tasks, parallelism=parallelism,
+                              host=creds.hostname, priority=priority)
+
+        # multistream sends whole files, an existing destination is compared by rsync or the delta engine:
+        existing = [(src, dst) for src, dst, size in large
+                    if not __use_multistream(src, dst, creds, upstream, journal)]
+        if existing:
+            tasks = __iter_transfer_tasks(creds, upstream, existing, tries, additional_params, bwlimit,
+                                          parallelism=parallelism)
+            executor.run_parallel(run, tasks, parallelism=parallelism,
+                                  host=creds.hostname, priority=priority)
+            existing = set(existing)
+
+        for src, dst, size in large:
+            if (src, dst) in existing:
+                continue
+            with tracing.span('file', host=creds.hostname, src=src, dst=dst, method='multistream') as span:
+                span.set(bytes=__multistream_transfer(creds, upstream, (src, dst), size,
+                    parallelism=parallelism, tries=tries, journal=journal, bwlimit=bwlimit), exit_code=0)
+            if journal is not None:
+                journal.done(src)
+
+    remote_dst = upstream and not localcopy.is_local(creds)
+    if duplicates:
+        with tracing.span('dedup_materialise', host=creds.hostname, count=len(duplicates)) as span:
+            span.set(bytes=dedup_files.materialise(duplicates, creds, remote_dst,
+                mode=dedup, parallelism=parallelism))
+        if journal is not None:
+            for src, _, _ in duplicates:
+                journal.done(src)
+        paths = __join_paths(paths, [(src, dst) for src, dst, _ in duplicates])
+
+    if done_paths:
+        paths = __join_paths(paths, done_paths)
+
+    if validate and len(paths) > 0 and not (journal and journal.phase_done('validate')):
+        with tracing.span('validate_checksums', host=creds.hostname, count=len(paths)):
+            validate_checksums(creds, upstream, parallelism, paths, agent=agent, priority=priority)
+        if journal is not None:
+            journal.finish_phase('validate')
+
+    if extract and not (journal and journal.phase_done('extract')):
+        with tracing.span('extract_files', host=creds.hostname):
+            extract_files(creds, remote_dst, paths, agent=agent)
+        if journal is not None:
+            journal.finish_phase('extract')
+
+
+def __join_paths(paths, more):
+    """ returns the paths followed by more
+    @paths, @more: PathPairs or lists of tuples of (source_path, dest_path)
+    The result stays compact PathPairs if paths are PathPairs with the destinations of more.
+    """
+    if not isinstance(paths, PathPairs):
+        return list(paths) + list(more)
+    if isinstance(more, PathPairs) and more.get_dst is paths.get_dst:
+        extra = more.srcs
+    elif all(dst == paths.get_dst(src) for src, dst in more):
+        extra = [src for src, _ in more]
+    else:
+        return list(paths) + list(more)
+    srcs = FileList()
+    srcs.extend(paths.srcs)
+    srcs.extend(extra)
+    return PathPairs(srcs, paths.get_dst)
 
 
-def extract_files(creds, upstream, paths):
+def extract_files(creds, upstream, paths, agent=None):
     """
     :param creds: dictionary
     :param upstream: boolean
     :param paths: list of tuples of (source_path, dest_path)
+    :param agent: optional remote agent to extract all the files in one request
     """
     logging.info('File extraction...')
-    if upstream:  # local=source, remote=dest
+    if upstream and agent is not None:
+        agent.extract([path for _, path in paths if path.endswith('.gz')], gunzip=True)
+
+    elif upstream:  # local=source, remote=dest
         cmds = []
         for _, path in paths:
             if path.endswith('.gz'):
                 cmds.append(f'gunzip "{path}"')
         if len(cmds) > 0:
-            executor.remote_batch(cmds, creds)
+            executor.run_remote_batch(cmds, creds)
 
     else:  # local=dest, remote=source
-        cmds = []
-        for _, path in paths:
-            if path.endswith('.gz'):
-                cmds.append(f'gunzip "{path}"')
-        if len(cmds) > 0:
-            executor.local_batch(cmds)
+        cmds = (['gunzip', path] for _, path in paths if path.endswith('.gz'))
+        executor.local_batch(cmds)
 
 
-def validate_checksums(creds, upstream, parallelism, paths):
+def validate_checksums(creds, upstream, parallelism, paths, agent=None, priority=scheduler.NORMAL):
     """
     :param creds: a dictionary with the ssh credentials
     :param upstream: boolean
     :param paths: is a list of two paths: local path and remote path
+    :param agent: optional remote agent to hash all the remote files in one request
+    :param priority: scheduler.HIGH, NORMAL or LOW
     if fails, it raises an Exception
     """
     logging.info('Checksum validation...')
+    if localcopy.is_local(creds):
+        executor.run_parallel(lambda path: local_checksum_validator([path]), paths,
+                              parallelism=parallelism, priority=priority)
+        return
+
     func = partial(checksum_validator, creds)
     # transform paths to be a pair of local and remote paths:
-    paths2 = []
     if upstream:  # local=source, remote=dest
-        paths2 = [(src, dst) for src, dst in paths]
+        paths2 = ((src, dst) for src, dst in paths)
 
     else:  # local=dest, remote=source
-        paths2 = [(dst, src) for src, dst in paths]
+        paths2 = ((dst, src) for src, dst in paths)
+
+    if agent is not None:
+        __validate_with_agent(agent, parallelism, list(paths2), priority=priority)
+        return
 
-    pool = ThreadPool(processes=parallelism)
-    pool.map(func, paths2)
-    pool.close()
-    pool.join()
+    executor.run_parallel(func, paths2, parallelism=parallelism,
+                          host=creds.hostname, priority=priority)
+
+
+def __validate_with_agent(agent, parallelism: int, paths: list, priority: int=scheduler.NORMAL):
+    """
+    @agent: the remote agent
+    @parallelism: int, how many files to hash at the same time
+    @paths: list of tuples of (local_path, remote_path)
+    if fails, it raises a CheckSumMismatch
+    """
+    remote_checksums = agent.hash([remote_path for _, remote_path in paths], parallelism=parallelism)
+    local_checksums = [None] * len(paths)
+    def hash_local(ind):
+        local_checksums[ind] = delta.file_md5(paths[ind][0]).hex()
+    executor.run_parallel(hash_local, range(len(paths)), parallelism=parallelism, priority=priority)
+    for (local_path, remote_path), checksum in zip(paths, local_checksums):
+        if remote_checksums.get(remote_path) != checksum:
+            raise CheckSumMismatch(f'checksum mismatch for\n{local_path}\n{remote_path}')
+        logging.info('Verified: filename=%s checksum=%s', os.path.basename(local_path), checksum)
 
 
 def checksum_validator(creds, paths):
     """
     :param creds: a dictionary with the ssh credentials
     :param paths: is a list of two paths: local path and remote path
-    if fails, it raises an Exception
+    if fails, it raises a CheckSumMismatch
     """
     local_path, remote_path = paths
-    checksum1 = executor.local(f'md5sum "{local_path}"').split(' ')[0]
-    checksum2 = executor.remote(f'md5sum "{remote_path}"', creds).split(' ')[0]
+    checksum1 = delta.file_md5(local_path).hex()
+    try:
+        checksum2 = executor.remote(f'md5sum "{remote_path}"', creds).decode('utf-8').split(' ')[0]
+    except executor.CommandError as e:
+        raise CheckSumMismatch(f'checksum mismatch for\n{local_path}\n{remote_path} ({e})') from e
     if checksum1 != checksum2:
-        raise Exception('checksum mismatch for %s' % paths)
+        raise CheckSumMismatch(f'checksum mismatch for\n{local_path}\n{remote_path}')
     logging.info('Verified: filename=%s checksum=%s', os.path.basename(local_path), checksum1)
 
 class CheckSumMismatch(Exception):
@@ -279,7 +978,7 @@ def local_checksum_validator(paths: list):
     @paths: list of tuples of (source_path, dest_path)
     """
     for src, dst in paths:
-        checksum1 = hashlib.md5(open(src, 'rb').read()).hexdigest()
-        checksum2 = hashlib.md5(open(dst, 'rb').read()).hexdigest()
+        checksum1 = delta.file_md5(src)
+        checksum2 = delta.file_md5(dst)
         if checksum1 != checksum2:
             raise CheckSumMismatch(f'checksum mismatch for\n{src}\n{dst}')
@@ -0,0 +1,279 @@
+"""
+This module is the process-wide scheduler which runs the tasks of all the
+concurrent jobs (uploads, downloads, wget, url downloads) on one shared
+pool of worker threads.
+- max_workers caps the number of tasks running in the process
+- every host has a cap so that concurrent jobs do not open too many ssh sessions
+  to it (see MaxStartups of sshd). The default cap (per_host) does not lower the
+  parallelism a job asks for, it stops other jobs from adding to it.
+  set_host_limit gives a host a hard cap and per_host=None removes the default one.
+- every job has a cap which is its parallelism
+- jobs with a higher priority are served first and jobs of the same
+  priority are served in turn so they share the workers fairly
+Example:
+    from parallel_sync import scheduler
+    scheduler.configure(max_workers=40, per_host=8)
+    scheduler.set_host_limit('192.168.168.9', 2)
+"""
+import threading
+from collections import deque, Counter
+
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITIES = [HIGH, NORMAL, LOW]
+
+MAX_WORKERS = 32
+PER_HOST = 10
+
+_END = object()
+_FETCH = object() # a task which takes the next item of a job
+_UNCHANGED = object()
+
+
+class _Job:
+    def __init__(self, func, items, host, limit: int, priority: int):
+        self.func = func
+        self.items = iter(items)
+        self.host = host # str, tuple of str, callable taking an item or None
+        self.limit = limit
+        self.priority = priority
+        self.active = 0
+        self.exhausted = False
+        self.errors = []
+        self.peeked = _END # the next item, taken but not started yet
+        self.fetching = False # whether a worker is taking the next item, outside of the lock
+        self.done = threading.Event()
+
+    def get_hosts(self, item) -> tuple:
+        """ returns the tuple of hosts the task of this item runs against """
+        host = self.host(item) if callable(self.host) else self.host
+        if host is None:
+            return ()
+        if isinstance(host, str):
+            return (host,)
+        return tuple(host)
+
+
+class Scheduler:
+    def __init__(self, max_workers: int=MAX_WORKERS, per_host: int=PER_HOST):
+        """
+        @max_workers: int, how many tasks can run at the same time in the process
+        @per_host: int, how many tasks can run at the same time against one host,
+            unless a job has a larger parallelism. None means no cap except for
+            the hosts given one with set_host_limit.
+        """
+        self.max_workers = max_workers
+        self.per_host = per_host
+        self.__host_limits = {}
+        self.__cond = threading.Condition()
+        self.__queues = {priority: deque() for priority in PRIORITIES}
+        self.__host_active = Counter()
+        self.__workers = 0
+        self.__idle = 0
+        self.__running = 0
+        self.__local = threading.local()
+
+    def set_host_limit(self, host: str, limit: int):
+        """
+        @host: str, the host name
+        @limit: int, how many tasks can run at the same time against this host,
+            whatever the parallelism of the jobs. None resets it to the default per_host.
+        """
+        with self.__cond:
+            if limit is None:
+                self.__host_limits.pop(host, None)
+            else:
+                self.__host_limits[host] = limit
+            self.__cond.notify_all()
+
+    def configure(self, max_workers: int=None, per_host=_UNCHANGED):
+        """ changes the limits, the waiting tasks start at once if they were raised
+        @max_workers: int, how many tasks can run at the same time in the process
+        @per_host: int, the default cap of the hosts. None removes it.
+        """
+        with self.__cond:
+            if max_workers is not None:
+                self.max_workers = max_workers
+            if per_host is not _UNCHANGED:
+                self.per_host = per_host
+            waiting = sum(job.limit for queue in self.__queues.values() for job in queue)
+            self.__add_workers(min(self.max_workers, waiting))
+            self.__cond.notify_all()
+
+    def get_host_slots(self, host: str) -> int:
+        """ returns how many tasks can run at the same time against the host at most.
+        Only a hard cap given with set_host_limit is known here,
+        the default cap can be raised by the parallelism of a job.
+        """
+        with self.__cond:
+            limit = self.__host_limits.get(host)
+            return self.max_workers if limit is None else min(limit, self.max_workers)
+
+    def __host_is_full(self, hosts: tuple, job: _Job) -> bool:
+        for host in hosts:
+            limit = self.__host_limits.get(host)
+            if limit is None and self.per_host is not None:
+                limit = max(self.per_host, job.limit)
+            if limit is not None and self.__host_active[host] >= limit:
+                return True
+        return False
+
+    def __add_workers(self, wanted: int):
+        """ starts worker threads until there are wanted of them. It must be called with the lock held. """
+        while self.__workers < wanted:
+            self.__workers += 1
+            threading.Thread(target=self.__work, daemon=True,
+                             name=f'parallel_sync-{self.__workers}').start()
+
+    def __next_task(self):
+        """ returns a tuple of (job, item, hosts) which can start now or None.
+        The item is _FETCH if the next item of the job must be taken first.
+        It must be called with the lock held.
+        """
+        if self.__running >= self.max_workers:
+            return None
+        for priority in PRIORITIES:
+            queue = self.__queues[priority]
+            for _ in range(len(queue)):
+                job = queue[0]
+                queue.rotate(-1) # the next call starts with the next job
+                if job.errors or job.exhausted:
+                    queue.remove(job)
+                    self.__finish_if_idle(job)
+                    continue
+                if job.active >= job.limit or job.fetching:
+                    continue
+                if job.peeked is _END:
+                    # the items can be lazy and slow, they are not taken with the lock held:
+                    job.fetching = True
+                    return job, _FETCH, ()
+                hosts = job.get_hosts(job.peeked)
+                if self.__host_is_full(hosts, job):
+                    continue
+                item = job.peeked
+                job.peeked = _END
+                job.active += 1
+                self.__running += 1
+                for host in hosts:
+                    self.__host_active[host] += 1
+                return job, item, hosts
+        return None
+
+    def __finish_if_idle(self, job: _Job):
+        if job.active == 0:
+            job.done.set()
+
+    def __fetch(self, job: _Job):
+        """ takes the next item of the job """
+        item = _END
+        error = None
+        try:
+            item = next(job.items, _END)
+        except Exception as e:
+            error = e
+        with self.__cond:
+            job.fetching = False
+            job.peeked = item
+            if error is not None:
+                job.errors.append(error)
+            if item is _END:
+                job.exhausted = True
+            if job.errors or job.exhausted:
+                self.__finish_if_idle(job)
+            self.__cond.notify_all()
+
+    def __work(self):
+        self.__local.is_worker = True
+        while True:
+            with self.__cond:
+                task = self.__next_task()
+                while task is None:
+                    self.__idle += 1
+                    self.__cond.wait()
+                    self.__idle -= 1
+                    task = self.__next_task()
+
+            job, item, hosts = task
+            if item is _FETCH:
+                self.__fetch(job)
+                continue
+            error = None
+            try:
+                job.func(item)
+            except Exception as e:
+                error = e
+
+            with self.__cond:
+                job.active -= 1
+                self.__running -= 1
+                for host in hosts:
+                    self.__host_active[host] -= 1
+                if error is not None:
+                    job.errors.append(error)
+                if job.errors or job.exhausted:
+                    self.__finish_if_idle(job)
+                self.__cond.notify_all()
+
+    def map(self, func, items, host=None, parallelism: int=10, priority: int=NORMAL):
+        """ calls func on every item and returns once they are all done.
+        The items are consumed lazily as the workers become free.
+        @func: function which takes one item
+        @items: an iterable of items
+        @host: str, the host the tasks run against, a tuple of hosts if they use
+            several hosts, a function which returns the host(s) of an item,
+            or None if the tasks do not use a host
+        @parallelism: int, the cap of this job, how many of its items can run at the same time
+        @priority: int, HIGH, NORMAL or LOW
+        If a call fails, no more items are started and its exception is raised
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f'Invalid priority: {priority}. It must be one of {PRIORITIES}')
+
+        if getattr(self.__local, 'is_worker', False):
+            # a task started another job. Waiting for other workers could deadlock:
+            for item in items:
+                func(item)
+            return
+
+        job = _Job(func, items, host, max(1, parallelism), priority)
+        with self.__cond:
+            self.__queues[priority].append(job)
+            self.__add_workers(min(self.max_workers, self.__workers - self.__idle + job.limit))
+            self.__cond.notify_all()
+
+        job.done.wait()
+        if job.errors:
+            raise job.errors[0]
+
+
+__scheduler = None
+__lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """ returns the process-wide scheduler """
+    global __scheduler
+    with __lock:
+        if __scheduler is None:
+            __scheduler = Scheduler()
+        return __scheduler
+
+
+def configure(max_workers: int=None, per_host=_UNCHANGED):
+    """ changes the limits of the process-wide scheduler
+    @max_workers: int, how many tasks can run at the same time in the process
+    @per_host: int, the default number of tasks which can run at the same time against one host.
+        None removes the default cap.
+    """
+    get_scheduler().configure(max_workers=max_workers, per_host=per_host)
+
+
+def set_host_limit(host: str, limit: int):
+    """ changes how many tasks can run at the same time against one host """
+    get_scheduler().set_host_limit(host, limit)
+
+
+def run(func, items, host=None, parallelism: int=10, priority: int=NORMAL):
+    """ runs the tasks on the process-wide scheduler, see Scheduler.map """
+    get_scheduler().map(func, items, host=host, parallelism=parallelism, priority=priority)
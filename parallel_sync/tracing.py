@@ -0,0 +1,170 @@
+"""
+This module records spans around the phases of upload/download jobs
+(listing, creating folders, the transfer pool, validation, extraction)
+and around every per-file command, so you can see where the time went.
+
+Spans are only recorded when at least one exporter is registered:
+    from parallel_sync import tracing
+    collector = tracing.MemoryExporter()
+    tracing.add_exporter(collector)
+    rsync.upload(...)
+    print(tracing.summary(collector.spans))
+"""
+import json
+import time
+import socket
+import threading
+import contextlib
+from dataclasses import dataclass, field, asdict
+
+__exporters = []
+__lock = threading.Lock()
+
+
+@dataclass
+class Span:
+    name: str
+    start: float # epoch seconds
+    end: float = None
+    attributes: dict = field(default_factory=dict)
+
+    @property
+    def duration(self) -> float:
+        """ returns the duration in seconds """
+        if self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def set(self, **attributes):
+        """ adds attributes to the span such as host, bytes or exit_code """
+        self.attributes.update(attributes)
+
+
+class MemoryExporter:
+    """ keeps the finished spans in memory """
+    def __init__(self):
+        self.spans = []
+        self.__lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self.__lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self.__lock:
+            self.spans = []
+
+
+class JsonLinesExporter:
+    """ appends the finished spans to a file, one JSON document per line """
+    def __init__(self, path: str):
+        """
+        @path: str, the file to append to
+        """
+        self.path = path
+        self.__lock = threading.Lock()
+
+    def export(self, span: Span):
+        doc = asdict(span)
+        doc['duration'] = span.duration
+        line = json.dumps(doc, default=str)
+        with self.__lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+
+class OpenTelemetryExporter:
+    """ forwards the finished spans to OpenTelemetry.
+    It needs the opentelemetry-api package to be installed.
+    """
+    def __init__(self, tracer_name: str='parallel_sync'):
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            raise ImportError('The opentelemetry-api package is needed for the '
+                              'OpenTelemetryExporter: pip install opentelemetry-api')
+        self.__tracer = trace.get_tracer(tracer_name)
+
+    def export(self, span: Span):
+        attributes = {key: value if isinstance(value, (bool, int, float, str)) else str(value)
+                      for key, value in span.attributes.items() if value is not None}
+        otel_span = self.__tracer.start_span(span.name, start_time=int(span.start * 1e9),
+                                             attributes=attributes)
+        otel_span.end(end_time=int(span.end * 1e9))
+
+
+def add_exporter(exporter):
+    """
+    @exporter: an object with an export(span) method
+    """
+    with __lock:
+        __exporters.append(exporter)
+
+
+def remove_exporter(exporter):
+    with __lock:
+        if exporter in __exporters:
+            __exporters.remove(exporter)
+
+
+def is_enabled() -> bool:
+    """ returns bool, whether any exporter is registered """
+    return len(__exporters) > 0
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """ records a span around the block of code
+    @name: str, the name of the phase or command
+    @attributes: extra attributes of the span such as host or bytes
+    yields the Span so more attributes can be added in the block
+    If the block raises an exception, the error is added to the span.
+    """
+    current = Span(name=name, start=time.time(), attributes=attributes)
+    if not is_enabled():
+        yield current
+        return
+
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=f'{type(e).__name__}: {e}')
+        if 'exit_code' not in current.attributes:
+            current.set(exit_code=getattr(e, 'returncode', None))
+        raise
+    finally:
+        current.end = time.time()
+        current.attributes.setdefault('thread', threading.current_thread().name)
+        current.attributes.setdefault('local_host', socket.gethostname())
+        for exporter in list(__exporters):
+            exporter.export(current)
+
+
+def summary(spans: list) -> str:
+    """
+    @spans: list of finished spans
+    returns a table of the count, total time and bytes per span name
+        and the share of the wall-clock time between the first start and the last end.
+        Per-file spans run in parallel so their total can exceed the wall-clock time.
+    """
+    if len(spans) < 1:
+        return 'No spans were recorded.'
+
+    wall = max(s.end for s in spans) - min(s.start for s in spans)
+    rows = {}
+    for s in spans:
+        row = rows.setdefault(s.name, {'count': 0, 'total': 0.0, 'max': 0.0, 'bytes': 0, 'errors': 0})
+        row['count'] += 1
+        row['total'] += s.duration
+        row['max'] = max(row['max'], s.duration)
+        row['bytes'] += s.attributes.get('bytes') or 0
+        if 'error' in s.attributes:
+            row['errors'] += 1
+
+    lines = [f'{"phase":<24}{"count":>8}{"total(s)":>12}{"max(s)":>10}{"wall%":>8}{"bytes":>16}{"errors":>8}']
+    for name, row in sorted(rows.items(), key=lambda item: -item[1]['total']):
+        share = 100.0 * row['total'] / wall if wall > 0 else 0.0
+        lines.append(f'{name:<24}{row["count"]:>8}{row["total"]:>12.3f}{row["max"]:>10.3f}'
+                     f'{share:>8.1f}{row["bytes"]:>16}{row["errors"]:>8}')
+    lines.append(f'wall-clock: {wall:.3f}s')
+    return '\n'.join(lines)
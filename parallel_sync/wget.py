@@ -2,7 +2,7 @@
 This module manages file operations such as parallel download
 """
 import os
-from . import executor, compression, Credential
+from . import executor, compression, scheduler, Credential
 TIMEOUT = 40
 
 
@@ -16,7 +16,7 @@ def __url_to_filename(url: str):
 
 def download(creds: Credential, target_dir: str, urls: list,
              filenames: list=None, parallelism: int=10, tries: int=3,
-             extract: bool=False, timeout: int=TIMEOUT):
+             extract: bool=False, timeout: int=TIMEOUT, priority: int=scheduler.NORMAL):
     """ downloads large files on a remote machine
     @creds: ssh credentials
     @target_dir: where to download to
@@ -25,6 +25,7 @@ def download(creds: Credential, target_dir: str, urls: list,
         those file names
     @parallelism(default=10): number of parallel processes to use
     @extract: boolean - whether to extract tar or zip files after download
+    @priority: scheduler.HIGH, NORMAL or LOW
     """
     if isinstance(urls, str):
         urls = [urls]
@@ -32,9 +33,6 @@ def download(creds: Credential, target_dir: str, urls: list,
     if not isinstance(urls, list):
         raise ValueError(f'Expected a list of urls. Received {urls}')
 
-    if not os.path.exists(target_dir):
-        os.makedirs(target_dir)
-
     cmds = []
     if filenames is not None and len(filenames) != len(urls):
         raise ValueError('You have specified filenames but the number '\
@@ -52,5 +50,6 @@ def download(creds: Credential, target_dir: str, urls: list,
             if ext is not None:
                 cmd = f'{cmd};cd "{target_dir}";{ext} "{filename}"'
         cmds.append(cmd)
-    
-    executor.run_remote_batch(cmds, creds, curr_dir=target_dir, parallelism=parallelism)
+
+    executor.run_remote_parallel(cmds, creds, curr_dir=target_dir, parallelism=parallelism,
+                                 priority=priority)
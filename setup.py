@@ -35,7 +35,10 @@ setup(
     description='A Parallelized file/url syncing package',
     long_description=__doc__,
     packages=find_packages(),
-    install_requires=['paramiko>=1.15.2', 'six'],
+    install_requires=['paramiko>=1.15.2'],
+    entry_points={
+        'console_scripts': ['parallel-sync=parallel_sync.cli:main'],
+    },
     python_requires='>=3',
     include_package_data=True,
     zip_safe=False,
@@ -0,0 +1,28 @@
+"""
+Fixtures shared by the unittests
+"""
+import subprocess
+from unittest.mock import patch
+import pytest
+from parallel_sync import executor, Credential
+
+
+@pytest.fixture
+def creds() -> Credential:
+    """ ssh credentials of a remote host which is never connected to """
+    return Credential(username='u', hostname='h', key_filename='k')
+
+
+def run_locally(cmd, creds, **kwargs):
+    """ runs a remote command on the local machine and yields its lines like executor.stream_remote """
+    proc = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    yield from proc.stdout.splitlines()
+    if proc.returncode != 0:
+        raise executor.CommandError(proc.stderr, returncode=proc.returncode)
+
+
+@pytest.fixture
+def mock_stream_remote():
+    """ replaces executor.stream_remote with the local shell """
+    with patch('parallel_sync.executor.stream_remote', side_effect=run_locally) as mock:
+        yield mock
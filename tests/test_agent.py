@@ -0,0 +1,124 @@
+"""
+Unittests for the remote helper agent
+"""
+import io
+import os
+import gzip
+import hashlib
+import tarfile
+import threading
+import pytest
+from parallel_sync import agent
+
+
+def __serve(requests):
+    inp = io.BytesIO()
+    for request in requests:
+        agent.write_frame(inp, request)
+    inp.seek(0)
+    out = io.BytesIO()
+    agent.serve(inp, out)
+    out.seek(0)
+    responses = []
+    while True:
+        response = agent.read_frame(out)
+        if response is None:
+            return responses
+        responses.append(response)
+
+
+def test_serve(tmp_path):
+    root = str(tmp_path)
+    responses = __serve([
+        {'op': 'mkdirs', 'args': {'paths': [f'{root}/a/b', f'{root}/c']}},
+        {'op': 'walk', 'args': {'root': root}},
+        {'op': 'unknown'},
+        {'op': 'quit'},
+        {'op': 'mkdirs', 'args': {'paths': [f'{root}/never']}}])
+    assert len(responses) == 4
+    assert responses[0] == {'ok': True, 'result': 2}
+    assert sorted(responses[1]['part']['folders']) == [root, f'{root}/a', f'{root}/a/b', f'{root}/c']
+    assert responses[2] == {'ok': True, 'result': None}
+    assert not responses[3]['ok']
+    assert not os.path.exists(f'{root}/never')
+
+
+def test_walk_include_exclude(tmp_path):
+    for name in ['a.txt', 'b.pyc', 'c.txt']:
+        (tmp_path / name).write_bytes(b'12345')
+    parts = list(agent.walk(str(tmp_path), include='*.txt', exclude=['*c.txt']))
+    assert [(os.path.basename(path), size) for path, size, _ in parts[0]['files']] == [('a.txt', 5)]
+
+
+def test_walk_parts(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, 'WALK_PART', 2)
+    for name in 'abcde':
+        (tmp_path / name).write_bytes(b'x')
+    parts = list(agent.walk(str(tmp_path)))
+    assert [len(part['files']) for part in parts] == [2, 2, 1]
+    assert sum(len(part['folders']) for part in parts) == 1
+
+
+def test_hash_delete_extract(tmp_path):
+    (tmp_path / 'a').write_bytes(b'content')
+    with gzip.open(tmp_path / 'b.gz', 'wb') as f:
+        f.write(b'zipped')
+    checksums = agent.hash_files([str(tmp_path / 'a'), str(tmp_path / 'missing')])
+    assert checksums == {str(tmp_path / 'a'): hashlib.md5(b'content').hexdigest(),
+                         str(tmp_path / 'missing'): None}
+
+    assert agent.extract([str(tmp_path / 'b.gz')]) == 1
+    assert (tmp_path / 'b').read_bytes() == b'zipped'
+    assert agent.delete([str(tmp_path / 'a'), str(tmp_path / 'missing')]) == 1
+    assert not (tmp_path / 'a').exists()
+
+
+def make_tar(path, names):
+    with tarfile.open(path, 'w:gz') as archive:
+        for name in names:
+            info = tarfile.TarInfo(name)
+            info.size = len(name)
+            archive.addfile(info, io.BytesIO(name.encode()))
+
+
+def test_extract_tar(tmp_path):
+    make_tar(tmp_path / 'a.tar.gz', ['x/one', 'two'])
+    assert agent.extract([str(tmp_path / 'a.tar.gz')]) == 1 # the same as tar -zxf
+    assert sorted(os.listdir(tmp_path)) == ['a.tar.gz', 'two', 'x']
+    assert (tmp_path / 'x' / 'one').read_bytes() == b'x/one'
+
+    assert agent.extract([str(tmp_path / 'a.tar.gz')], gunzip=True) == 1 # the same as gunzip
+    assert sorted(os.listdir(tmp_path)) == ['a.tar', 'two', 'x']
+
+
+@pytest.mark.parametrize('has_filter', [True, False])
+def test_extract_unsafe_tar(tmp_path, monkeypatch, has_filter):
+    if not has_filter: # Pythons before the extraction filters
+        monkeypatch.delattr(tarfile, 'data_filter', raising=False)
+    folder = tmp_path / 'folder'
+    folder.mkdir()
+    make_tar(folder / 'a.tar.gz', ['../escaped'])
+    with pytest.raises((ValueError, tarfile.TarError)):
+        agent.extract([str(folder / 'a.tar.gz')])
+    assert not (tmp_path / 'escaped').exists()
+
+
+def test_remote_agent_walk(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent, 'WALK_PART', 2)
+    for name in 'abcde':
+        (tmp_path / name).write_bytes(b'x')
+    inp = io.BytesIO()
+    agent.write_frame(inp, {'op': 'walk', 'args': {'root': str(tmp_path)}})
+    inp.seek(0)
+    out = io.BytesIO()
+    agent.serve(inp, out)
+    out.seek(0)
+
+    client = object.__new__(agent.RemoteAgent) # without the ssh connection
+    client._RemoteAgent__lock = threading.Lock()
+    client._RemoteAgent__stdin = io.BytesIO()
+    client._RemoteAgent__stdout = out
+    folders, files = client.walk(str(tmp_path))
+    assert folders == [str(tmp_path)]
+    assert sorted(os.path.basename(path) for path in files) == list('abcde')
+    assert files.total_size() == 5
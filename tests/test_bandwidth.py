@@ -0,0 +1,110 @@
+"""
+Unittests for the bandwidth limits
+"""
+import io
+import time
+from unittest.mock import patch
+from parallel_sync import bandwidth, relay, scheduler, Credential
+from parallel_sync.bandwidth import TokenBucket
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1024 * 1024, burst=64 * 1024)
+    start = time.monotonic()
+    for _ in range(4):
+        bucket.consume(64 * 1024)
+    elapsed = time.monotonic() - start
+    assert 0.15 < elapsed < 1 # 256K at 1M/s after the burst
+
+    bucket.set_rate(None)
+    start = time.monotonic()
+    bucket.consume(1024 * 1024 * 1024)
+    assert time.monotonic() - start < 0.1
+
+
+def test_command_rates():
+    job = TokenBucket(1024 * 1024)
+    bandwidth.set_host_limit('slow-host', 256 * 1024)
+    scheduler.set_host_limit('slow-host', 4)
+    try:
+        # the commands which can run at the same time never exceed the limits together:
+        assert bandwidth.get_command_rate('fast-host', job, parallelism=4) == 256 * 1024
+        assert bandwidth.get_command_rate('slow-host', job, parallelism=2) == 128 * 1024
+        assert bandwidth.get_command_rate('slow-host', job, parallelism=8) == 64 * 1024 # 4 per host
+        with bandwidth.register_job('slow-host', parallelism=2), bandwidth.register_job('slow-host', parallelism=2):
+            assert bandwidth.get_command_rate(('fast-host', 'slow-host'), parallelism=2) == 64 * 1024
+        assert bandwidth.get_command_args(['rsync', '-c', 'a', 'b'], 512 * 1024) ==\
+            ['rsync', '--bwlimit=512', '-c', 'a', 'b']
+        assert bandwidth.get_command_args(['/usr/bin/scp', 'a', 'b'], 125000) ==\
+            ['/usr/bin/scp', '-l', '1000', 'a', 'b']
+        assert bandwidth.get_command_args(['ssh', 'h'], 1000) == ['ssh', 'h']
+    finally:
+        bandwidth.set_host_limit('slow-host', None)
+        scheduler.set_host_limit('slow-host', None)
+    assert bandwidth.get_command_rate('slow-host', parallelism=4) is None
+
+
+def test_process_limit_split():
+    bandwidth.set_limit(100 * 1024 * 1024)
+    try:
+        # a single job gets the whole limit:
+        assert bandwidth.get_command_rate('h', parallelism=10) == 10 * 1024 * 1024
+        with bandwidth.register_job('h', parallelism=10), bandwidth.register_job('h2', parallelism=10):
+            assert bandwidth.get_command_rate('h', parallelism=10) == 5 * 1024 * 1024
+    finally:
+        bandwidth.set_limit(None)
+
+
+def test_command_reserves_rate():
+    job = TokenBucket(1024 * 1024, burst=64 * 1024)
+    job.consume(64 * 1024) # no tokens left
+    with bandwidth.command_rate('h', job, parallelism=2, count=1) as rate:
+        assert rate == 512 * 1024
+        start = time.monotonic()
+        job.consume(128 * 1024) # at the half of the rate which is left to the job
+        assert time.monotonic() - start > 0.2
+    start = time.monotonic()
+    job.consume(64 * 1024)
+    assert time.monotonic() - start < 0.15
+
+
+class MockSFTP:
+    def __init__(self, files: dict):
+        self.files = files
+
+    def open(self, path, mode):
+        if 'w' in mode:
+            sftp = self
+            class Writer(io.BytesIO):
+                def set_pipelined(self, value):
+                    pass
+                def close(self):
+                    sftp.files[path] = self.getvalue()
+                    super().close()
+            return Writer()
+        class Reader(io.BytesIO):
+            def prefetch(self):
+                pass
+        return Reader(self.files[path])
+
+
+def test_relay_throttle():
+    src = MockSFTP({'/x/a': b'x' * (relay.CHUNK_SIZE * 2)})
+    dst = MockSFTP({})
+    throttled = []
+    relay.copy_file(src, dst, '/x/a', '/y/a', throttle=throttled.append)
+    assert throttled == [relay.CHUNK_SIZE, relay.CHUNK_SIZE]
+    assert dst.files['/y/a'] == src.files['/x/a']
+
+
+@patch('parallel_sync.executor.local')
+@patch('parallel_sync.rsync.__is_rsync_installed')
+def test_upload_bwlimit(mock_is_rsync_installed, mock_local, tmp_path):
+    from parallel_sync import rsync
+    mock_is_rsync_installed.return_value = True
+    (tmp_path / 'a').write_text('a')
+    creds = Credential(username='u', hostname='h', key_filename='k')
+    with patch('parallel_sync.executor.make_dirs_remote'):
+        rsync.upload(str(tmp_path / 'a'), '/dst', creds, bwlimit=2 * 1024 * 1024, parallelism=2)
+    args = mock_local.call_args.args[0]
+    assert args[:2] == ['rsync', '--bwlimit=1024']
@@ -0,0 +1,39 @@
+"""
+Unittests for the command line entry point
+"""
+import json
+from unittest.mock import patch
+from parallel_sync import cli
+
+
+def test_fetch(tmp_path, capsys):
+    src = tmp_path / 'src.txt'
+    src.write_text('hello')
+    code = cli.main(['fetch', str(tmp_path / 'out'), src.as_uri(), '--trace'])
+    output = json.loads(capsys.readouterr().out)
+    assert code == 0
+    assert output['ok'] and output['urls'] == 1
+    assert set(output['phases']) == {'download'}
+    assert output['phases']['download'] >= 0
+    assert (tmp_path / 'out' / 'src.txt').read_text() == 'hello'
+
+
+@patch('parallel_sync.rsync.upload')
+def test_upload(mock_upload, capsys):
+    code = cli.main(['upload', '/src', '/dst', '--host', 'h', '--user', 'u', '--key', 'k',
+                     '--port', '3022', '--exclude', '*.pyc', '--dedup', 'link', '-q'])
+    assert code == 0
+    args, kwargs = mock_upload.call_args
+    assert args[:2] == ('/src', '/dst')
+    assert (args[2].hostname, args[2].port, args[2].key_filename) == ('h', 3022, 'k')
+    assert kwargs['exclude'] == ['*.pyc']
+    assert kwargs['dedup'] == 'link'
+    assert json.loads(capsys.readouterr().out)['ok']
+
+
+@patch('parallel_sync.rsync.download')
+def test_failure(mock_download, capsys):
+    mock_download.side_effect = ValueError('boom')
+    code = cli.main(['download', '/src', '/dst', '--host', 'h', '-q'])
+    assert code == 1
+    assert json.loads(capsys.readouterr().out)['error'] == 'ValueError: boom'
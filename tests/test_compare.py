@@ -0,0 +1,83 @@
+"""
+Unittests for the comparison of the sources with the destination before a transfer
+"""
+import os
+import shutil
+from unittest.mock import patch
+import pytest
+from parallel_sync import compare, executor
+
+
+def make_tree(tmp_path) -> tuple:
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    src.mkdir()
+    dst.mkdir()
+    for name in ['same', 'touched', 'resized', 'edited', 'new']:
+        (src / name).write_text(f'{name} content')
+    shutil.copy2(src / 'same', dst / 'same')
+    shutil.copy(src / 'touched', dst / 'touched')
+    os.utime(dst / 'touched', (0, 0))
+    (dst / 'resized').write_text('resized content, longer')
+    (dst / 'edited').write_text('edited CONTENT')
+    os.utime(dst / 'edited', (os.path.getatime(src / 'edited'), os.path.getmtime(src / 'edited')))
+    return str(src), str(dst)
+
+
+def get_dst(src, dst):
+    return lambda path: f'{dst}/{os.path.basename(path)}'
+
+
+@pytest.mark.parametrize('mode, expected', [('stat', ['edited', 'same']), ('checksum', ['same', 'touched'])])
+def test_find_changed_local(tmp_path, mode, expected):
+    src, dst = make_tree(tmp_path)
+    _, files = executor.find_local(src)
+    changed, unchanged = compare.find_changed(files, get_dst(src, dst), None, True, dst, mode=mode)
+    assert sorted(os.path.basename(path) for path in unchanged) == expected
+    assert len(changed) + len(unchanged) == 5
+    assert set(changed.sizes) == {os.path.getsize(path) for path in changed}
+
+
+def test_find_changed_remote(mock_stream_remote, tmp_path, creds):
+    src, dst = make_tree(tmp_path)
+    srcs = [os.path.join(src, name) for name in sorted(os.listdir(src))]
+    changed, unchanged = compare.find_changed(srcs, get_dst(src, dst + '/'), creds, True, dst + '/',
+                                              mode='checksum')
+    assert sorted(os.path.basename(path) for path in unchanged) == ['same', 'touched']
+    assert mock_stream_remote.call_count == 2 # one listing and one md5sum of the same sizes
+
+
+@patch('parallel_sync.executor.local')
+@patch('parallel_sync.rsync.__is_rsync_installed')
+def test_upload_compare(mock_is_rsync_installed, mock_local, mock_stream_remote, tmp_path, creds):
+    from parallel_sync import rsync
+    mock_is_rsync_installed.return_value = True
+    src, dst = make_tree(tmp_path)
+    with patch('parallel_sync.executor.make_dirs_remote'):
+        rsync.upload(src, dst, creds, compare='stat')
+    sent = sorted(call.args[0][-3].rsplit('/', 1)[-1] for call in mock_local.call_args_list)
+    assert sent == ['new', 'resized', 'touched']
+
+    with pytest.raises(ValueError):
+        rsync.upload(src, dst, creds, compare='mtime')
+
+
+def test_local_upload_twice(tmp_path):
+    from parallel_sync import rsync
+    src, dst = make_tree(tmp_path)
+    rsync.upload(src, dst, None, compare='stat')
+    with patch('parallel_sync.localcopy.copy_file') as mock_copy_file:
+        rsync.upload(src, dst, None, compare='stat') # the copies kept the times
+    assert not mock_copy_file.called
+
+
+@patch('parallel_sync.executor.local')
+@patch('parallel_sync.rsync.__is_rsync_installed')
+def test_compare_stat_warning(mock_is_rsync_installed, mock_local, mock_stream_remote, tmp_path, caplog, creds):
+    from parallel_sync import rsync
+    mock_is_rsync_installed.return_value = True
+    src, dst = make_tree(tmp_path)
+    with patch('parallel_sync.executor.make_dirs_remote'):
+        rsync.upload(src, dst, creds, compare='stat', additional_params='-avz')
+        assert 'compare=' not in caplog.text
+        rsync.upload(src, dst, creds, compare='stat')
+    assert "compare='stat' only skips" in caplog.text
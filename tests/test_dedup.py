@@ -0,0 +1,48 @@
+"""
+Unittests for the deduplication of identical files
+"""
+import os
+from parallel_sync import dedup
+from parallel_sync.filelist import FileList, PathPairs
+
+
+def test_split_duplicates():
+    paths = [('/s/a', '/d/a'), ('/s/b', '/d/b'), ('/s/c', '/d/c'), ('/s/d', '/d/d')]
+    checksums = {'/s/a': 'x', '/s/b': 'y', '/s/c': 'x'}
+    unique, duplicates = dedup.split_duplicates(paths, checksums)
+    assert unique == [('/s/a', '/d/a'), ('/s/b', '/d/b'), ('/s/d', '/d/d')]
+    assert duplicates == [('/s/c', '/d/c', '/d/a')]
+
+
+def test_hash_local_only_same_sizes(tmp_path):
+    for name, content in [('a', b'same'), ('b', b'same'), ('c', b'other content')]:
+        (tmp_path / name).write_bytes(content)
+    paths = [str(tmp_path / name) for name in 'abc']
+    checksums = dedup.hash_local(paths, parallelism=2)
+    assert sorted(checksums) == paths[:2]
+    assert checksums[paths[0]] == checksums[paths[1]]
+
+
+def test_materialise_download(tmp_path):
+    (tmp_path / 'a').write_bytes(b'content')
+    (tmp_path / 'b').write_bytes(b'stale')
+    duplicates = [('/remote/b', str(tmp_path / 'b'), str(tmp_path / 'a')),
+                  ('/remote/c', str(tmp_path / 'c'), str(tmp_path / 'a'))]
+    saved = dedup.materialise(duplicates, None, upstream=False, mode='link')
+    assert saved == 14
+    assert (tmp_path / 'b').read_bytes() == b'content'
+    assert os.path.samefile(tmp_path / 'a', tmp_path / 'c')
+
+
+def test_find_duplicates_download(mock_stream_remote, tmp_path, creds):
+    files = FileList()
+    for name, content in [('a', b'same'), ('b', b'same'), ('c', b'other content')]:
+        (tmp_path / name).write_bytes(content)
+        files.append(str(tmp_path / name), len(content))
+    files.append(str(tmp_path / 'd'), 4) # it cannot be read
+    paths = PathPairs(files, lambda path: '/dst/' + os.path.basename(path))
+    unique, duplicates = dedup.find_duplicates(paths, creds, upstream=False)
+    assert duplicates == [(str(tmp_path / 'b'), '/dst/b', '/dst/a')]
+    assert [os.path.basename(src) for src, _ in unique] == ['a', 'c', 'd']
+    hashed = mock_stream_remote.call_args.args[0]
+    assert str(tmp_path / 'c') not in hashed # its size is unique
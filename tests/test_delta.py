@@ -0,0 +1,121 @@
+"""
+Unittests for the delta transfer engine
+"""
+import io
+import os
+import random
+import time
+import pytest
+from parallel_sync import delta
+
+
+def __write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.mark.parametrize('change', ['same', 'insert', 'remove', 'append', 'new'])
+def test_delta_roundtrip(tmp_path, change):
+    rnd = random.Random(change)
+    old = bytes(rnd.getrandbits(8) for _ in range(50000))
+    new = {'same': old,
+           'insert': old[:1000] + b'inserted' + old[1000:],
+           'remove': old[:2000] + old[7000:],
+           'append': old + b'appended',
+           'new': b'brand new content'}[change]
+    basis, target = str(tmp_path / 'old'), str(tmp_path / 'new')
+    __write(basis, old)
+    __write(target, new)
+
+    buf = io.BytesIO()
+    literal = delta.write_delta(target, delta.get_signature(basis, 1024), buf)
+    if change == 'same':
+        assert literal == 0
+    elif change != 'new':
+        assert literal < 3 * 1024
+
+    buf.seek(0)
+    delta.apply_delta(basis, buf, basis, 1024)
+    with open(basis, 'rb') as f:
+        assert f.read() == new
+
+
+def test_delta_missing_basis(tmp_path):
+    target = str(tmp_path / 'new')
+    __write(target, b'x' * 5000)
+    sig = delta.get_signature(str(tmp_path / 'missing'), 1024)
+    assert sig.blocks == []
+
+    buf = io.BytesIO()
+    assert delta.write_delta(target, sig, buf) == 5000
+    buf.seek(0)
+    delta.apply_delta(str(tmp_path / 'missing'), buf, str(tmp_path / 'out'), 1024)
+    assert os.path.getsize(tmp_path / 'out') == 5000
+
+
+def test_signature_serialization():
+    sig = delta.Signature(block_size=1024, size=1500, blocks=[(1, b'a' * 16), (2, b'b' * 16)])
+    buf = io.BytesIO()
+    delta.write_signature(sig, buf)
+    buf.seek(0)
+    assert delta.read_signature(buf) == sig
+    assert sig.tail == 476
+
+
+def test_apply_delta_corrupt(tmp_path):
+    target = str(tmp_path / 'new')
+    __write(target, b'abc')
+    buf = io.BytesIO()
+    delta.write_delta(target, delta.get_signature(target, 1024), buf)
+    data = buf.getvalue()[:-1] + b'\0'
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(target, io.BytesIO(data), str(tmp_path / 'out'), 1024)
+    assert not os.path.exists(tmp_path / 'out')
+
+
+def test_delta_changed_blocks_fast(tmp_path):
+    rnd = random.Random(0)
+    old = rnd.randbytes(4 * 1024 * 1024)
+    new = bytes(byte ^ 0xff for byte in old[:1024 * 1024]) + old[1024 * 1024:] + b'appended'
+    basis, target = str(tmp_path / 'old'), str(tmp_path / 'new')
+    __write(basis, old)
+    __write(target, new)
+
+    sig = delta.get_signature(basis)
+    buf = io.BytesIO()
+    start = time.monotonic()
+    literal = delta.write_delta(target, sig, buf)
+    assert time.monotonic() - start < 2 # no python loop over every byte
+    assert literal == 1024 * 1024 + len(b'appended')
+
+    sig_buf = io.BytesIO()
+    delta.write_signature(sig, sig_buf)
+    sig_buf.seek(0)
+    assert delta.read_signature(sig_buf) == sig # with the anchors
+    buf.seek(0)
+    delta.apply_delta(basis, buf, basis)
+    with open(basis, 'rb') as f:
+        assert f.read() == new
+
+
+@pytest.mark.parametrize('change', ['insert', 'remove', 'grow'])
+def test_delta_large_shift(tmp_path, change):
+    rnd = random.Random(change)
+    old = rnd.randbytes(8 * 1024 * 1024)
+    added = rnd.randbytes(600 * 1024)
+    new = {'insert': old[:1024 * 1024 + 7] + added + old[1024 * 1024 + 7:],
+           'remove': old[:2 * 1024 * 1024 + 13] + old[3 * 1024 * 1024 + 113:],
+           'grow': added + old + rnd.randbytes(3 * len(old))}[change] # more than twice larger
+    basis, target = str(tmp_path / 'old'), str(tmp_path / 'new')
+    __write(basis, old)
+    __write(target, new)
+
+    buf = io.BytesIO()
+    literal = delta.write_delta(target, delta.get_signature(basis), buf)
+    expected = max(0, len(new) - len(old)) # the unaligned change also costs the blocks around it
+    assert expected <= literal <= expected + 2 * delta.BLOCK_SIZE
+
+    buf.seek(0)
+    delta.apply_delta(basis, buf, basis)
+    with open(basis, 'rb') as f:
+        assert f.read() == new
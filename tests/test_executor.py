@@ -0,0 +1,167 @@
+"""
+Unittests for running local and remote commands
+"""
+import time
+import subprocess
+import pytest
+from unittest.mock import patch, MagicMock
+from parallel_sync import executor
+
+class FakeChannel:
+    """ delivers the stdout chunks and the stderr chunks then exits.
+    Like paramiko, the exit status is ready before the output was all received.
+    """
+    def __init__(self, stdout: list, stderr: list=(), exit_status: int=0, exits: bool=True,
+                 delay: int=0):
+        """ @delay: int, how many times recv_ready is False before the stdout chunks arrive """
+        self.stdout = list(stdout)
+        self.stderr = list(stderr)
+        self.exit_status = exit_status
+        self.exits = exits
+        self.delay = delay
+        self.closed = False
+
+    @property
+    def eof_received(self):
+        return self.exits and not self.stdout and not self.stderr
+
+    def recv_ready(self):
+        if self.delay > 0:
+            self.delay -= 1
+            return False
+        return len(self.stdout) > 0
+
+    def recv(self, size):
+        return self.stdout.pop(0)
+
+    def recv_stderr_ready(self):
+        return len(self.stderr) > 0
+
+    def recv_stderr(self, size):
+        return self.stderr.pop(0)
+
+    def exit_status_ready(self):
+        return self.exits
+
+    def recv_exit_status(self):
+        return self.exit_status
+
+    def close(self):
+        self.closed = True
+
+
+def get_client(channel):
+    client = MagicMock()
+    stdout = MagicMock()
+    stdout.channel = channel
+    client.exec_command.return_value = (None, stdout, None)
+    return client
+
+
+def test_stream_remote_lines(creds):
+    channel = FakeChannel([b'F 3 1.5 /x/a\nF 4 2', b'.5 /x/b\n', b'D 0 0 /x'], [b'warning'])
+    client = get_client(channel)
+    lines = list(executor.stream_remote('find /x', creds, client=client))
+    assert lines == ['F 3 1.5 /x/a', 'F 4 2.5 /x/b', 'D 0 0 /x']
+    assert channel.closed
+    assert not client.close.called
+
+    with patch('parallel_sync.executor.connect') as mock_connect:
+        mock_connect.return_value = get_client(FakeChannel([b'F 3 1.5 /x/a\n', b'D 0 0 /x\n']))
+        folders, files = executor.find_remote('/x', creds)
+        assert folders == ['/x']
+        assert list(files.entries()) == [('/x/a', 3, 1.5)]
+        assert mock_connect.return_value.close.called
+
+
+@patch('parallel_sync.executor.select.select')
+def test_stream_remote_late_output(mock_select, creds):
+    channel = FakeChannel([b'F 3 1.5 /x/a\n', b'F 4 2.5 /x/b\n'], delay=3)
+    lines = list(executor.stream_remote('find /x', creds, client=get_client(channel)))
+    assert lines == ['F 3 1.5 /x/a', 'F 4 2.5 /x/b']
+
+
+@patch('parallel_sync.executor.select.select')
+def test_find_remote_unreadable_folder(mock_select, creds):
+    with patch('parallel_sync.executor.connect') as mock_connect:
+        channel = FakeChannel([b'F 3 1.5 /x/a\n'], [b'find: /x/private: Permission denied'], exit_status=1)
+        mock_connect.return_value = get_client(channel)
+        folders, files = executor.find_remote('/x', creds)
+        assert list(files) == ['/x/a']
+
+        mock_connect.return_value = get_client(FakeChannel([], [b'find: bad option'], exit_status=2))
+        with pytest.raises(executor.CommandError):
+            executor.find_remote('/x', creds)
+
+
+def test_stream_remote_failure(creds):
+    channel = FakeChannel([b'partial'], [b'x' * executor.MAX_STDERR, b'No such file'], exit_status=2)
+    with pytest.raises(executor.CommandError) as error:
+        for _ in executor.stream_remote('md5sum /x', creds, chunk_size=10, client=get_client(channel)):
+            pass
+    assert error.value.returncode == 2
+    assert str(error.value).endswith('No such file')
+    assert len(str(error.value)) < executor.MAX_STDERR + 100
+
+
+@patch('parallel_sync.executor.select.select')
+def test_stream_remote_timeout(mock_select, creds):
+    mock_select.side_effect = lambda *args: time.sleep(0.01)
+    channel = FakeChannel([], exits=False)
+    with pytest.raises(executor.CommandTimeout):
+        list(executor.stream_remote('sleep 100', creds, timeout=0.05, client=get_client(channel)))
+    assert channel.closed
+
+
+def test_local_batch():
+    cmds = [['echo', str(ind)] for ind in range(5)] + ['sh -c "echo oops >&2; exit 3"']
+    results = executor.local_batch(cmds, parallelism=3, fail_fast=False)
+    assert [result.stdout for result in results[:5]] == [f'{ind}\n'.encode() for ind in range(5)]
+    assert results[5].returncode == 3
+    assert results[5].stderr == b'oops\n'
+
+    lines = []
+    executor.local_batch([['echo', 'a'], ['echo', 'b']], output=lambda ind, line: lines.append(line))
+    assert sorted(lines) == [b'a\n', b'b\n']
+
+    start = time.monotonic()
+    with pytest.raises(executor.CommandError) as error:
+        executor.local_batch([['sleep', '10'], ['false']], parallelism=2)
+    assert error.value.returncode == 1
+    assert time.monotonic() - start < 5 # the sleep was terminated
+
+    results = executor.local_batch([['no-such-program']], fail_fast=False)
+    assert results[0].returncode == 127
+
+
+def test_batch_command():
+    cmd = executor.get_batch_command(['true', 'sleep 0.1; exit 3', 'echo ok'])
+    proc = subprocess.run(['sh', '-c', cmd], capture_output=True, text=True)
+    assert proc.returncode == 1
+    assert proc.stdout == 'ok\n'
+    assert proc.stderr == 'Failed: sleep 0.1; exit 3\n'
+    assert subprocess.run(['sh', '-c', executor.get_batch_command(['true', 'true'])]).returncode == 0
+
+
+@patch('parallel_sync.executor.make_dirs_remote')
+@patch('parallel_sync.executor.stream_remote')
+@patch('parallel_sync.executor.connect')
+def test_run_remote_parallel(mock_connect, mock_stream_remote, mock_make_dirs, creds):
+    def run(cmd, creds, client=None, **kwargs):
+        time.sleep(0.01)
+        return iter(())
+    mock_stream_remote.side_effect = run
+    cmds = [f'wget {ind}' for ind in range(20)]
+    executor.run_remote_parallel(cmds, creds, curr_dir='/dst', parallelism=2)
+    assert sorted(call.args[0] for call in mock_stream_remote.call_args_list) ==\
+        sorted(f'cd "/dst"; {cmd}' for cmd in cmds)
+    assert mock_connect.call_count <= 2 # the connections are reused
+    assert mock_connect.return_value.close.called
+
+
+def test_find_remote_missing_root(mock_stream_remote, tmp_path, creds):
+    (tmp_path / 'a').write_text('a')
+    folders, files = executor.find_remote(str(tmp_path), creds)
+    assert list(files) == [str(tmp_path / 'a')]
+    with pytest.raises(executor.CommandError, match='Cannot list'):
+        executor.find_remote(str(tmp_path / 'missing'), creds)
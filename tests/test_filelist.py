@@ -0,0 +1,66 @@
+"""
+Unittests for the compact file list
+"""
+import pytest
+from parallel_sync import executor
+from parallel_sync.filelist import FileList, PathPairs
+
+
+def test_file_list():
+    files = FileList()
+    paths = ['/a/b/c.txt', '/a/b/d.txt', '/a/é.bin', 'relative', '/root']
+    for ind, path in enumerate(paths):
+        files.append(path, size=ind, mtime=ind + 0.5)
+    assert len(files) == 5
+    assert list(files) == paths
+    assert files[1] == '/a/b/d.txt'
+    assert files[-1] == '/root'
+    assert list(files.entries())[2] == ('/a/é.bin', 2, 2.5)
+    assert files.total_size() == 10
+    with pytest.raises(IndexError):
+        files[5]
+
+
+def test_path_pairs():
+    pairs = PathPairs(['/x/a', '/x/b'], lambda path: path.replace('/x', '/y'))
+    assert len(pairs) == 2
+    assert pairs[1] == ('/x/b', '/y/b')
+    assert list(pairs) == [('/x/a', '/y/a'), ('/x/b', '/y/b')]
+
+
+def test_select_extend():
+    files = FileList()
+    for ind, path in enumerate(['/a/x', '/a/y', '/b/z']):
+        files.append(path, size=ind, mtime=ind + 0.5)
+    selected = files.select(bytearray([1, 0, 1]))
+    assert list(selected.entries()) == [('/a/x', 0, 0.5), ('/b/z', 2, 2.5)]
+    selected.extend(['/c/w'])
+    selected.extend(files.select(bytearray([0, 1, 0])))
+    assert list(selected.entries())[2:] == [('/c/w', -1, 0.0), ('/a/y', 1, 1.5)]
+    assert list(files) == ['/a/x', '/a/y', '/b/z']
+
+    pairs = PathPairs(files, lambda path: path.replace('/a', '/d')).select(bytearray([0, 1, 1]))
+    assert isinstance(pairs.srcs, FileList)
+    assert list(pairs) == [('/a/y', '/d/y'), ('/b/z', '/b/z')]
+
+
+def test_find_local(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    (tmp_path / 'sub' / 'a.txt').write_text('abc')
+    (tmp_path / 'b.pyc').write_text('b')
+    folders, files = executor.find_local(str(tmp_path), exclude=['*.pyc'])
+    assert folders == [(tmp_path / 'sub').as_posix()]
+    assert list(files.entries())[0][:2] == ((tmp_path / 'sub' / 'a.txt').as_posix(), 3)
+    assert len(files) == 1
+
+
+def test_run_parallel():
+    results = []
+    executor.run_parallel(results.append, iter(range(100)), parallelism=4)
+    assert sorted(results) == list(range(100))
+
+    def fail(item):
+        if item == 3:
+            raise ValueError('boom')
+    with pytest.raises(ValueError):
+        executor.run_parallel(fail, range(10), parallelism=2)
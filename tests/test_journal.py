@@ -0,0 +1,72 @@
+"""
+Unittests for the job journal which makes the transfers resumable
+"""
+import os
+import pytest
+from unittest.mock import patch
+from parallel_sync import rsync, Credential
+from parallel_sync.journal import Journal, JournalMismatch
+
+
+def test_journal_resume(tmp_path):
+    params = {'src': '/x', 'dst': '/y'}
+    journal = Journal('job-1', str(tmp_path))
+    assert not journal.open(params)
+    journal.write_plan(['/x/a', '/x/b', '/x/c'])
+    journal.done('/x/a')
+    journal.set_offset('/x/c', 4096)
+    journal.close()
+    with open(journal.path, 'a') as f:
+        f.write('{"t":"done","p":"/x/') # torn by a crash
+
+    journal = Journal('job-1', str(tmp_path))
+    assert journal.open(params)
+    assert list(journal.pending()) == ['/x/b', '/x/c']
+    assert journal.is_done('/x/a')
+    assert journal.get_offset('/x/c') == 4096
+    journal.done('/x/b')
+    journal.close()
+
+    journal = Journal('job-1', str(tmp_path))
+    assert journal.open(params)
+    assert list(journal.pending()) == ['/x/c']
+    journal.close()
+
+    with pytest.raises(JournalMismatch):
+        Journal('job-1', str(tmp_path)).open({'src': '/other', 'dst': '/y'})
+
+    with pytest.raises(ValueError):
+        Journal('../job', str(tmp_path))
+
+
+@patch('parallel_sync.executor.local')
+@patch('parallel_sync.rsync.__make_dirs')
+@patch('parallel_sync.rsync.__get_transfer_commands')
+def test_upload_resume(mock_tr_cmd, mock_make_dirs, mock_local, tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    for name in 'abcd':
+        (src / name).write_text(name)
+    creds = Credential(username='u', hostname='h', key_filename='k')
+    mock_tr_cmd.side_effect = lambda creds, upstream, paths, params: [src for src, _ in paths]
+
+    def fail_on_c(args, tries=1):
+        if args[0].endswith('c'):
+            raise Exception('connection lost')
+    mock_local.side_effect = fail_on_c
+    with pytest.raises(Exception):
+        rsync.upload(str(src), '/dst', creds, parallelism=1,
+                     job_id='nightly', journal_dir=str(tmp_path))
+    assert os.path.exists(tmp_path / 'nightly.jsonl')
+    first = [call.args[0][0] for call in mock_local.call_args_list][:-1] # the last one failed
+
+    mock_local.reset_mock()
+    mock_local.side_effect = None
+    with patch('parallel_sync.executor.find_local') as mock_find_local:
+        rsync.upload(str(src), '/dst', creds, parallelism=1,
+                     job_id='nightly', journal_dir=str(tmp_path))
+        assert not mock_find_local.called
+    sent = [call.args[0][0] for call in mock_local.call_args_list]
+    assert str(src / 'c') in sent
+    assert sorted(first + sent) == [str(src / name) for name in 'abcd']
+    assert not os.path.exists(tmp_path / 'nightly.jsonl')
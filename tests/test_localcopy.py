@@ -0,0 +1,45 @@
+"""
+Unittests for the local copy without ssh
+"""
+import os
+import getpass
+from parallel_sync import localcopy, rsync, Credential
+
+
+def test_is_local():
+    assert localcopy.is_local(None)
+    assert localcopy.is_local(Credential(username=getpass.getuser(), hostname='localhost', key_filename='k'))
+    assert not localcopy.is_local(Credential(username='other-user', hostname='127.0.0.1', key_filename='k'))
+    assert not localcopy.is_local(Credential(username=getpass.getuser(), hostname='h', key_filename='k'))
+    # a port forwarded to a virtual machine or a container:
+    assert not localcopy.is_local(Credential(username=getpass.getuser(), hostname='localhost', port=2222,
+                                             key_filename='k'))
+
+
+def test_copy_file(tmp_path):
+    src = tmp_path / 'a.sh'
+    src.write_bytes(os.urandom(300 * 1024))
+    os.chmod(src, 0o750)
+    dst = tmp_path / 'b.sh'
+    dst.write_bytes(b'old')
+    assert localcopy.copy_file(str(src), str(dst)) == 300 * 1024
+    assert dst.read_bytes() == src.read_bytes()
+    assert os.stat(dst).st_mode & 0o777 == 0o750
+    assert sorted(os.listdir(tmp_path)) == ['a.sh', 'b.sh']
+
+
+def test_upload_local(tmp_path):
+    src = tmp_path / 'src'
+    (src / 'sub').mkdir(parents=True)
+    (src / 'sub' / 'a.txt').write_text('a')
+    (src / 'b.txt').write_text('a')
+    (src / 'c.pyc').write_text('c')
+    dst = tmp_path / 'dst'
+    rsync.upload(str(src), str(dst), creds=None, exclude=['*.pyc'], validate=True, dedup='link')
+    assert (dst / 'sub' / 'a.txt').read_text() == 'a'
+    assert os.path.samefile(dst / 'sub' / 'a.txt', dst / 'b.txt')
+    assert not (dst / 'c.pyc').exists()
+
+    creds = Credential(username=getpass.getuser(), hostname='localhost', key_filename='k')
+    rsync.download(str(src / 'b.txt'), str(tmp_path / 'z'), creds)
+    assert (tmp_path / 'z' / 'b.txt').read_text() == 'a'
@@ -0,0 +1,160 @@
+"""
+Unittests for the multi-stream transfer of large files.
+The ssh connections are replaced with local files and local commands.
+"""
+import os
+import subprocess
+import pytest
+from unittest.mock import patch, MagicMock
+from parallel_sync import multistream
+from parallel_sync.journal import Journal
+
+class MockRemoteFile:
+    def __init__(self, path, mode):
+        self.file = open(path, mode)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.file.close()
+
+    def set_pipelined(self, value):
+        pass
+
+    def seek(self, offset):
+        self.file.seek(offset)
+
+    def write(self, data):
+        self.file.write(data)
+
+    def stat(self):
+        self.file.flush()
+
+    def readv(self, chunks):
+        for offset, length in chunks:
+            self.file.seek(offset)
+            yield self.file.read(length)
+
+
+def mock_connect(creds):
+    client = MagicMock()
+    client.open_sftp.return_value.open.side_effect = MockRemoteFile
+    return client
+
+
+def mock_remote(cmd, creds, **kwargs):
+    return subprocess.check_output(cmd, shell=True)
+
+
+def run_locally(func):
+    func = patch('parallel_sync.executor.remote', side_effect=mock_remote)(func)
+    return patch('parallel_sync.executor.connect', side_effect=mock_connect)(func)
+
+
+def test_get_ranges():
+    assert multistream.get_ranges(25, 10) == [(0, 10), (10, 10), (20, 5)]
+    assert multistream.get_ranges(25, 10, offset=15) == [(10, 10), (20, 5)]
+    assert multistream.get_ranges(20, 10, offset=20) == []
+
+
+def test_progress(tmp_path):
+    journal = Journal('job', str(tmp_path))
+    journal.open({})
+    journal.write_plan(['/a'])
+    progress = multistream._Progress('/a', 0, journal)
+    progress.done(10, 10)
+    assert journal.get_offset('/a') == 0 # there is a gap before the range
+    progress.done(0, 10)
+    progress.done(30, 10)
+    journal.close()
+    journal = Journal('job', str(tmp_path))
+    journal.open({})
+    assert journal.get_offset('/a') == 20 # there is a gap after the first two ranges
+    journal.close()
+
+
+@run_locally
+def test_upload_file(mock_remote, mock_connect, mock_stream_remote, tmp_path, creds):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    src.write_bytes(os.urandom(1000))
+    sent = multistream.upload_file(str(src), str(dst), creds, streams=3, range_size=64)
+    assert sent == 1000
+    assert dst.read_bytes() == src.read_bytes()
+    assert not os.path.exists(f'{dst}.parallel_sync.part')
+    assert mock_connect.call_count == 3
+
+
+@run_locally
+def test_download_file_resume(mock_remote, mock_connect, mock_stream_remote, tmp_path, creds):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    data = os.urandom(1000)
+    src.write_bytes(data)
+    part = tmp_path / 'dst.parallel_sync.part'
+    part.write_bytes(data[:500]) # written before an interruption
+    journal = Journal('job', str(tmp_path / 'journals'))
+    journal.open({})
+    journal.write_plan([str(src)])
+    journal.set_offset(str(src), 500)
+    journal.close()
+    journal.open({})
+    throttled = []
+    received = multistream.download_file(str(src), str(dst), creds, 1000, streams=2, range_size=100,
+                                         journal=journal, throttle=throttled.append)
+    journal.close()
+    assert received == 500
+    assert sum(throttled) == 500
+    assert dst.read_bytes() == data
+    journal.open({})
+    assert journal.get_offset(str(src)) == 1000
+    journal.close()
+
+
+@run_locally
+def test_upload_file_failure(mock_remote, mock_connect, mock_stream_remote, tmp_path, creds):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    src.write_bytes(os.urandom(1000))
+    mock_stream_remote.side_effect = lambda *args, **kwargs: iter(['bad'])
+    with pytest.raises(multistream.MultiStreamError):
+        multistream.upload_file(str(src), str(dst), creds, streams=2, range_size=100)
+    assert not os.path.exists(f'{dst}.parallel_sync.part') # no journal could resume it
+    assert not dst.exists()
+
+
+@run_locally
+def test_download_file_keeps_times(mock_remote, mock_connect, mock_stream_remote, tmp_path, creds):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    src.write_bytes(os.urandom(1000))
+    os.chmod(src, 0o640)
+    os.utime(src, (1000000, 1000000))
+    multistream.download_file(str(src), str(dst), creds, 1000, streams=2, range_size=300)
+    assert os.stat(dst).st_mtime == 1000000
+    assert os.stat(dst).st_mode & 0o777 == 0o640
+
+
+@pytest.mark.parametrize('dst_exists', [False, True])
+@patch('parallel_sync.multistream.upload_file')
+@patch('parallel_sync.executor.remote')
+@patch('parallel_sync.executor.local')
+@patch('parallel_sync.rsync.__is_rsync_installed')
+def test_upload_large_file(mock_is_rsync_installed, mock_local, mock_remote, mock_upload_file,
+                           tmp_path, dst_exists, creds):
+    from parallel_sync import rsync
+    mock_is_rsync_installed.return_value = True
+    mock_remote.return_value = b'1\n' if dst_exists else b''
+    mock_upload_file.return_value = 200
+    (tmp_path / 'small').write_bytes(b'x' * 10)
+    (tmp_path / 'large').write_bytes(b'x' * 200)
+    with patch('parallel_sync.multistream.MIN_SIZE', 100),\
+            patch('parallel_sync.executor.make_dirs_remote'):
+        rsync.upload(str(tmp_path), '/dst', creds, parallelism=4)
+    args = ' '.join(' '.join(call.args[0]) for call in mock_local.call_args_list)
+    assert '/dst/small' in args
+    if dst_exists: # rsync compares it with the existing file
+        assert mock_local.call_count == 2 and '/dst/large' in args
+        assert not mock_upload_file.called
+    else:
+        assert mock_local.call_count == 1 and '/dst/large' not in args
+        src, dst, _ = mock_upload_file.call_args.args
+        assert (src, dst) == (str(tmp_path / 'large'), '/dst/large')
+        assert mock_upload_file.call_args.kwargs['streams'] == 4
@@ -2,9 +2,10 @@
 This file has the unittests, to run use this command:
 pytest
 """
-from parallel_sync import rsync, Credential
+import io
+from parallel_sync import rsync, relay, Credential
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
 def test_upload_null_params():
     with pytest.raises(Exception):
@@ -21,6 +22,15 @@ class MockStdOut:
     class Channel:
         def recv_exit_status(self):
             return 0
+        def recv_ready(self):
+            return False
+        def recv_stderr_ready(self):
+            return False
+        def exit_status_ready(self):
+            return True
+        eof_received = True
+        def close(self):
+            pass
     channel = Channel()
     def read(self):
         return ''
@@ -78,3 +88,54 @@ def test_get_transfer_commands_scp_downstream(mock_is_rsync_installed):
     cmds = rsync.__get_transfer_commands(creds, False, paths)
     assert cmds == ['scp -P 3022 -i "k" u@h:"/src/1" "/dst/1"',
                     'scp -P 3022 -i "k" u@h:"/src/2" "/dst/2"']
+
+@patch('parallel_sync.executor.run_remote_batch')
+@patch('parallel_sync.executor.make_dirs_remote')
+@patch('parallel_sync.executor.find_remote')
+def test_transfer_direct(mock_find_remote, mock_make_dirs, mock_remote_batch):
+    src_creds = Credential(username='u', hostname='src', port=22, key_filename='k')
+    dst_creds = Credential(username='v', hostname='dst', port=3022, key_filename='k')
+    mock_find_remote.return_value = (['/x', '/x/d'], ['/x/a', '/x/d/b'])
+    rsync.transfer(src_creds, '/x', dst_creds, '/y', mode='direct', remote_key_filename='/k2')
+    assert mock_make_dirs.call_args[0] == ({'/y', '/y/d'}, dst_creds)
+    cmds, creds = mock_remote_batch.call_args[0]
+    assert creds == src_creds
+    assert cmds == ["rsync -c -e 'ssh -p 3022 -o StrictHostKeyChecking=no -o ServerAliveInterval=100 -i /k2' /x/a v@dst:\"/y/a\"",
+                    "rsync -c -e 'ssh -p 3022 -o StrictHostKeyChecking=no -o ServerAliveInterval=100 -i /k2' /x/d/b v@dst:\"/y/d/b\""]
+
+
+class MockSFTPFile(io.BytesIO):
+    def prefetch(self):
+        pass
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def close(self):
+        self.result = self.getvalue()
+        super().close()
+
+
+def test_relay_copy_file():
+    src = MockSFTPFile(b'x' * (relay.CHUNK_SIZE + 10))
+    dst = MockSFTPFile()
+    src_sftp = MagicMock()
+    src_sftp.open.return_value = src
+    dst_sftp = MagicMock()
+    dst_sftp.open.return_value = dst
+    assert relay.copy_file(src_sftp, dst_sftp, '/x/a', '/y/a') == relay.CHUNK_SIZE + 10
+    dst_sftp.open.assert_called_with('/y/a', 'wb')
+    assert dst.result == b'x' * (relay.CHUNK_SIZE + 10)
+
+
+@patch('parallel_sync.executor.remote')
+def test_validate_missing_destination(mock_remote, mock_stream_remote, tmp_path, creds):
+    from parallel_sync import executor
+    (tmp_path / 'a').write_bytes(b'content')
+    mock_remote.side_effect = executor.CommandError('md5sum: /dst/a: No such file or directory', returncode=1)
+    with pytest.raises(rsync.CheckSumMismatch, match='No such file'):
+        rsync.validate_checksums(creds, True, 2, [(str(tmp_path / 'a'), '/dst/a')])
+
+    # between two remote hosts, the destination files are hashed in one command
+    with pytest.raises(rsync.CheckSumMismatch, match='missing'):
+        rsync.__validate_remote(creds, creds, [(str(tmp_path / 'a'), str(tmp_path / 'b'))])
@@ -0,0 +1,133 @@
+import time
+import threading
+import pytest
+from parallel_sync import scheduler
+from parallel_sync.scheduler import Scheduler
+
+
+class Gauge:
+    """ counts how many tasks run at the same time """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __call__(self, item):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        time.sleep(0.01)
+        with self.lock:
+            self.current -= 1
+
+
+def test_job_limit():
+    gauge = Gauge()
+    Scheduler(max_workers=8).map(gauge, range(20), parallelism=3)
+    assert gauge.peak == 3
+
+
+def test_host_limit():
+    sched = Scheduler(max_workers=8, per_host=4)
+    sched.set_host_limit('host1', 2)
+    gauge = Gauge()
+    threads = [threading.Thread(target=sched.map, args=(gauge, range(10)),
+                                kwargs={'host': 'host1', 'parallelism': 5}) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert gauge.peak == 2
+
+
+def test_priority():
+    sched = Scheduler(max_workers=1)
+    order = []
+    started = threading.Event()
+    release = threading.Event()
+    def block(item):
+        started.set()
+        release.wait()
+    blocker = threading.Thread(target=sched.map, args=(block, [0]))
+    blocker.start()
+    started.wait()
+
+    low = threading.Thread(target=sched.map, args=(order.append, ['low']),
+                           kwargs={'priority': scheduler.LOW})
+    high = threading.Thread(target=sched.map, args=(order.append, ['high']),
+                            kwargs={'priority': scheduler.HIGH})
+    low.start()
+    high.start()
+    time.sleep(0.1) # both jobs are queued
+    release.set()
+    for thread in (blocker, low, high):
+        thread.join()
+    assert order == ['high', 'low']
+
+
+def test_error_and_nested():
+    sched = Scheduler(max_workers=2)
+    def fail(item):
+        if item == 5:
+            raise ValueError('boom')
+    with pytest.raises(ValueError):
+        sched.map(fail, range(100), parallelism=2)
+
+    results = []
+    sched.map(lambda item: sched.map(results.append, range(item)), range(3), parallelism=2)
+    assert sorted(results) == [0, 0, 1]
+
+    with pytest.raises(ValueError):
+        sched.map(results.append, [1], priority=5)
+
+
+def test_slow_items():
+    sched = Scheduler(max_workers=4)
+    def slow_items():
+        yield 0
+        time.sleep(0.5)
+        yield 1
+    slow = threading.Thread(target=sched.map, args=(lambda item: None, slow_items()))
+    slow.start()
+    time.sleep(0.1) # a worker takes the next slow item
+    start = time.time()
+    sched.map(lambda item: None, range(10), parallelism=2)
+    assert time.time() - start < 0.3 # the other job did not wait for the slow generator
+    slow.join()
+
+
+def run_jobs(sched, gauge, parallelisms, host='host1'):
+    threads = [threading.Thread(target=sched.map, args=(gauge, range(parallelism * 2)),
+                                kwargs={'host': host, 'parallelism': parallelism})
+               for parallelism in parallelisms]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_default_host_limit():
+    gauge = Gauge()
+    run_jobs(Scheduler(max_workers=32), gauge, [15]) # a job keeps its own parallelism
+    assert scheduler.PER_HOST < gauge.peak <= 15
+
+    gauge = Gauge()
+    run_jobs(Scheduler(max_workers=32), gauge, [8, 8, 8]) # but concurrent jobs do not add up
+    assert gauge.peak == scheduler.PER_HOST
+
+    gauge = Gauge()
+    sched = Scheduler(max_workers=32)
+    sched.configure(per_host=None)
+    run_jobs(sched, gauge, [8, 8, 8])
+    assert scheduler.PER_HOST < gauge.peak <= 24
+
+
+def test_configure_wakes_workers():
+    sched = Scheduler(max_workers=1)
+    gauge = Gauge()
+    thread = threading.Thread(target=sched.map, args=(gauge, range(40)), kwargs={'parallelism': 4})
+    thread.start()
+    time.sleep(0.05)
+    sched.configure(max_workers=4)
+    thread.join()
+    assert gauge.peak == 4
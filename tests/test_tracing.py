@@ -0,0 +1,60 @@
+"""
+Unittests for the phase tracing
+"""
+import json
+import pytest
+from parallel_sync import tracing
+from parallel_sync.executor import CommandError
+
+
+@pytest.fixture
+def collector():
+    exporter = tracing.MemoryExporter()
+    tracing.add_exporter(exporter)
+    yield exporter
+    tracing.remove_exporter(exporter)
+
+
+def test_span_disabled():
+    assert not tracing.is_enabled()
+    with tracing.span('phase') as span:
+        span.set(bytes=1)
+
+
+def test_span_records(collector):
+    with tracing.span('transfer', host='h') as span:
+        span.set(bytes=10)
+    with pytest.raises(CommandError):
+        with tracing.span('file', host='h'):
+            raise CommandError('failed', 23)
+
+    transfer, failed = collector.spans
+    assert transfer.name == 'transfer'
+    assert transfer.attributes['bytes'] == 10
+    assert transfer.end >= transfer.start
+    assert failed.attributes['exit_code'] == 23
+    assert 'failed' in failed.attributes['error']
+
+
+def test_json_lines_exporter(tmp_path):
+    exporter = tracing.JsonLinesExporter(str(tmp_path / 'spans.jsonl'))
+    tracing.add_exporter(exporter)
+    try:
+        with tracing.span('validate_checksums', count=2):
+            pass
+    finally:
+        tracing.remove_exporter(exporter)
+    doc = json.loads((tmp_path / 'spans.jsonl').read_text())
+    assert doc['name'] == 'validate_checksums'
+    assert doc['attributes']['count'] == 2
+
+
+def test_summary():
+    spans = [tracing.Span('transfer', 0.0, 8.0),
+             tracing.Span('file', 0.0, 4.0, {'bytes': 100}),
+             tracing.Span('file', 4.0, 8.0, {'bytes': 50, 'error': 'x'}),
+             tracing.Span('find_local', 8.0, 10.0)]
+    table = tracing.summary(spans).splitlines()
+    assert table[1].split() == ['transfer', '1', '8.000', '8.000', '80.0', '0', '0']
+    assert table[2].split() == ['file', '2', '8.000', '4.000', '80.0', '150', '1']
+    assert table[-1] == 'wall-clock: 10.000s'
@@ -0,0 +1,129 @@
+"""
+Unittests for the inotify watch mode
+"""
+import os
+import time
+import threading
+import pytest
+from unittest.mock import patch
+from parallel_sync import rsync, inotify, Credential
+
+pytestmark = pytest.mark.skipif(not inotify.is_supported(), reason='inotify is Linux only')
+
+
+def test_collect_changes(tmp_path):
+    (tmp_path / 'old').write_text('x')
+    with inotify.Watcher(str(tmp_path)) as watcher:
+        (tmp_path / 'a.txt').write_text('a')
+        os.makedirs(tmp_path / 'sub')
+        (tmp_path / 'sub' / 'b.txt').write_text('b')
+        os.remove(tmp_path / 'old')
+        changes, overflow = rsync.__collect_changes(watcher, debounce=0.2, max_delay=2)
+    assert not overflow
+    assert changes == {str(tmp_path / 'a.txt'): True,
+                       str(tmp_path / 'sub' / 'b.txt'): True,
+                       str(tmp_path / 'old'): False}
+
+
+@patch('parallel_sync.executor.run_remote_batch')
+@patch('parallel_sync.rsync.__make_dirs')
+@patch('parallel_sync.rsync.__transfer_paths')
+@patch('parallel_sync.rsync.__transfer')
+def test_watch(mock_transfer, mock_transfer_paths, mock_make_dirs, mock_remote_batch, tmp_path):
+    creds = Credential(username='u', hostname='h', port=3022, key_filename='k')
+    (tmp_path / 'gone.txt').write_text('x')
+    stop = threading.Event()
+    thread = threading.Thread(target=rsync.watch, args=(str(tmp_path), '/dst', creds),
+        kwargs={'exclude': ['*.pyc'], 'delete': True, 'debounce': 0.1, 'stop': stop})
+    thread.start()
+    time.sleep(0.3)
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'a.pyc').write_text('a')
+    os.remove(tmp_path / 'gone.txt')
+    time.sleep(0.5)
+    stop.set()
+    thread.join(timeout=5)
+
+    assert mock_transfer.call_count == 1
+    assert mock_transfer_paths.call_args[0][0] == [(str(tmp_path / 'a.txt'), '/dst/a.txt')]
+    assert mock_remote_batch.call_args[0][0] == ["rm -rf /dst/gone.txt"]
+
+
+@patch('parallel_sync.executor.run_remote_batch')
+def test_watch_local_delete(mock_remote_batch, tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    os.makedirs(src / 'sub')
+    (src / 'gone.txt').write_text('x')
+    (src / 'sub' / 'b.txt').write_text('b')
+    stop = threading.Event()
+    thread = threading.Thread(target=rsync.watch, args=(str(src), str(dst), None),
+        kwargs={'delete': True, 'debounce': 0.1, 'stop': stop})
+    thread.start()
+    time.sleep(0.5)
+    assert (dst / 'sub' / 'b.txt').exists()
+    os.remove(src / 'gone.txt')
+    os.remove(src / 'sub' / 'b.txt')
+    os.rmdir(src / 'sub')
+    time.sleep(0.5)
+    stop.set()
+    thread.join(timeout=5)
+
+    assert not mock_remote_batch.called # no ssh for a local destination
+    assert not (dst / 'gone.txt').exists()
+    assert not (dst / 'sub').exists()
+
+
+@patch('parallel_sync.executor.run_remote_batch')
+@patch('parallel_sync.rsync.__transfer_paths')
+def test_push_changes_include(mock_transfer_paths, mock_remote_batch, tmp_path):
+    creds = Credential(username='u', hostname='h', port=3022, key_filename='k')
+    (tmp_path / 'a.log').write_text('a')
+    (tmp_path / 'a.txt').write_text('a')
+    changes = {str(tmp_path / 'a.log'): True, str(tmp_path / 'a.txt'): True,
+               str(tmp_path / 'gone.log'): False, str(tmp_path / 'gone.txt'): False,
+               str(tmp_path / 'logs'): rsync.__DELETED_FOLDER,
+               str(tmp_path / 'tmp.pyc'): rsync.__DELETED_FOLDER}
+    with patch('parallel_sync.rsync.__make_dirs'):
+        rsync.__push_changes(str(tmp_path), '/dst', creds, changes, include='*.log',
+                             exclude=['*.pyc'], delete=True)
+    assert mock_transfer_paths.call_args[0][0] == [(str(tmp_path / 'a.log'), '/dst/a.log')]
+    assert mock_remote_batch.call_args[0][0] == ['rm -rf /dst/gone.log', 'rm -rf /dst/logs']
+
+
+def test_watcher_moved_folder(tmp_path):
+    root = tmp_path / 'root'
+    os.makedirs(root / 'a' / 'b')
+    with inotify.Watcher(str(root)) as watcher:
+        os.rename(root / 'a', tmp_path / 'moved')
+        watcher.read(0.5)
+        assert watcher.folders == [str(root)]
+
+
+@patch('parallel_sync.rsync.__transfer_paths')
+@patch('parallel_sync.rsync.__transfer')
+def test_watch_overflow(mock_transfer, mock_transfer_paths, tmp_path):
+    creds = Credential(username='u', hostname='h', port=3022, key_filename='k')
+    collect_changes = rsync.__collect_changes
+    overflows = []
+    def overflow(watcher, *args, **kwargs):
+        if overflows:
+            return collect_changes(watcher, *args, **kwargs)
+        os.makedirs(tmp_path / 'new')
+        watcher.read(0.2) # the kernel dropped the events, including the new folder
+        overflows.append(True)
+        return {}, True
+
+    stop = threading.Event()
+    with patch('parallel_sync.rsync.__collect_changes', side_effect=overflow),\
+            patch('parallel_sync.rsync.__make_dirs'):
+        thread = threading.Thread(target=rsync.watch, args=(str(tmp_path), '/dst', creds),
+            kwargs={'debounce': 0.1, 'stop': stop})
+        thread.start()
+        time.sleep(0.5)
+        (tmp_path / 'new' / 'a.txt').write_text('a')
+        time.sleep(0.5)
+        stop.set()
+        thread.join(timeout=5)
+
+    assert mock_transfer.call_count == 2 # the initial sync and the full sync after the overflow
+    assert mock_transfer_paths.call_args[0][0] == [(str(tmp_path / 'new' / 'a.txt'), '/dst/new/a.txt')]